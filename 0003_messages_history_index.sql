@@ -0,0 +1,8 @@
+-- Database schema update for DeGeNz Lounge - Index message history by sandbox and time
+
+-- Chain memory is rebuilt from the newest messages of a sandbox, so serve
+-- "WHERE sandbox_id = ? ORDER BY created_at DESC, id DESC LIMIT ?" from one index
+CREATE INDEX IF NOT EXISTS idx_messages_sandbox_id_created_at ON messages(sandbox_id, created_at, id);
+
+-- Covered by the leading column of the index above
+DROP INDEX IF EXISTS idx_messages_sandbox_id;
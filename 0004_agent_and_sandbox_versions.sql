@@ -0,0 +1,66 @@
+-- Database schema update for DeGeNz Lounge - Version agents and sandboxes for cache invalidation
+
+-- Every worker caches chains built from an agent or sandbox together with its
+-- version, and rebuilds them once the version it reads here has moved on
+ALTER TABLE agents ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE sandboxes ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+-- Create function to bump the version of an updated row
+CREATE OR REPLACE FUNCTION bump_version_column()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.version = OLD.version THEN
+        NEW.version = OLD.version + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+-- Create function to bump the version of a sandbox whose agents changed
+CREATE OR REPLACE FUNCTION bump_sandbox_version_on_membership()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE sandboxes SET version = version + 1 WHERE id = OLD.sandbox_id;
+    ELSE
+        UPDATE sandboxes SET version = version + 1 WHERE id = NEW.sandbox_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+-- Create function to bump the version of every sandbox an updated agent is in,
+-- since the manager's prompt lists its agents' names and roles
+CREATE OR REPLACE FUNCTION bump_sandbox_version_on_agent_update()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE sandboxes SET version = version + 1
+    WHERE id IN (SELECT sandbox_id FROM agent_sessions WHERE agent_id = NEW.id);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+-- Create triggers to bump versions
+DROP TRIGGER IF EXISTS bump_agents_version ON agents;
+CREATE TRIGGER bump_agents_version
+    BEFORE UPDATE ON agents
+    FOR EACH ROW
+    EXECUTE PROCEDURE bump_version_column();
+
+DROP TRIGGER IF EXISTS bump_sandboxes_version ON sandboxes;
+CREATE TRIGGER bump_sandboxes_version
+    BEFORE UPDATE ON sandboxes
+    FOR EACH ROW
+    EXECUTE PROCEDURE bump_version_column();
+
+DROP TRIGGER IF EXISTS bump_sandbox_version_on_agent_sessions ON agent_sessions;
+CREATE TRIGGER bump_sandbox_version_on_agent_sessions
+    AFTER INSERT OR DELETE ON agent_sessions
+    FOR EACH ROW
+    EXECUTE PROCEDURE bump_sandbox_version_on_membership();
+
+DROP TRIGGER IF EXISTS bump_sandbox_version_on_agents ON agents;
+CREATE TRIGGER bump_sandbox_version_on_agents
+    AFTER UPDATE ON agents
+    FOR EACH ROW
+    EXECUTE PROCEDURE bump_sandbox_version_on_agent_update();
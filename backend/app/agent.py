@@ -1,10 +1,21 @@
-from sqlalchemy import Column, Integer, String, Text, JSON, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Text, JSON, ForeignKey, DateTime, Boolean, event, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session
 import datetime
 import json
 
-Base = declarative_base()
+# Tables whose rows are versioned, see 0004_agent_and_sandbox_versions.sql
+VERSIONED_TABLES = ('agents', 'sandboxes')
+
+class VersionedModel:
+    """Give the models of versioned tables their version column"""
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__dict__.get('__tablename__') in VERSIONED_TABLES and 'version' not in cls.__dict__:
+            cls.version = Column(Integer, nullable=False, default=1)
+
+Base = declarative_base(cls=VersionedModel)
 
 class Agent(Base):
     __tablename__ = 'agents'
@@ -19,6 +30,7 @@ class Agent(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     user_id = Column(Integer, ForeignKey('users.id'))
+    version = Column(Integer, nullable=False, default=1)  # Bumped on every edit, see bump_version
     
     # Relationships
     user = relationship("User", back_populates="agents")
@@ -36,3 +48,38 @@ class Agent(Base):
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None
         }
+
+def bump_sandbox_versions(connection, sandbox_ids):
+    """Bump the versions of sandboxes whose agents changed, given their ids or a query for them"""
+    sandboxes = Base.metadata.tables['sandboxes']
+    connection.execute(sandboxes.update().where(sandboxes.c.id.in_(sandbox_ids)).values(
+        version=sandboxes.c.version + 1
+    ))
+
+@event.listens_for(Base, 'before_update', propagate=True)
+def bump_version(mapper, connection, target):
+    """Bump the version of an edited row so every worker rebuilds the chains built from it
+    
+    Editing an agent also bumps the sandboxes it is in, since the manager's
+    prompt lists its agents' names and roles. The database triggers in
+    0004_agent_and_sandbox_versions.sql do the same for edits made outside
+    the ORM and leave a version bumped here alone.
+    """
+    table = mapper.local_table
+    if table.name not in VERSIONED_TABLES or not object_session(target).is_modified(
+            target, include_collections=False):
+        return
+    
+    target.version = table.c.version + 1
+    if table.name == 'agents':
+        agent_sessions = Base.metadata.tables['agent_sessions']
+        bump_sandbox_versions(connection, select(agent_sessions.c.sandbox_id).where(
+            agent_sessions.c.agent_id == target.id
+        ))
+
+@event.listens_for(Base, 'after_insert', propagate=True)
+@event.listens_for(Base, 'after_delete', propagate=True)
+def bump_sandbox_version_on_membership(mapper, connection, target):
+    """Bump a sandbox's version when an agent joins or leaves it"""
+    if mapper.local_table.name == 'agent_sessions':
+        bump_sandbox_versions(connection, [target.sandbox_id])
@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify
 from app.models.agent import Agent
+from app.services.prompt_cache import get_prefix_cache, agent_prefix_owner
 
 bp = Blueprint('agents', __name__, url_prefix='/api/agents')
 
@@ -50,6 +51,9 @@ def update_agent(id):
     
     data = request.get_json()
     agent = Agent.update(id, data)
+    
+    # Drop provider-side caches of the old instructions
+    get_prefix_cache().invalidate(agent_prefix_owner(id))
     return jsonify(agent)
 
 @bp.route('/<int:id>', methods=['DELETE'])
@@ -60,4 +64,5 @@ def delete_agent(id):
         return jsonify({"error": "Agent not found"}), 404
     
     Agent.delete(id)
+    get_prefix_cache().invalidate(agent_prefix_owner(id))
     return jsonify({"message": "Agent deleted successfully"}), 200
@@ -1,29 +1,915 @@
 import os
+import re
 import json
+import logging
+import time
+import hashlib
+import datetime
+import queue
+import asyncio
+import itertools
+import threading
+import weakref
+import httpx
 import requests
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import (Dict, List, Optional, Any, Union, Iterable, Iterator, Tuple,
+                    AsyncIterable, AsyncIterator)
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+from app.services.caching import ResponseCache
+from app.services.request_coalescing import SingleFlight
+from app.services.routing import LatencyRouter
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.services.tokenization import get_token_counter
+from app.services.prompt_cache import PrefixCache, get_prefix_cache
+from app.services.context_packing import ContextWindowExceeded
+
+class ConnectionResetRetry(Retry):
+    """Retry policy for LLM calls.
+    
+    Connection failures and resets on a stale keep-alive socket are retried
+    for any method, including POST. Read timeouts are never retried, since
+    the upstream may still be generating (and billing) the first completion.
+    """
+    
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error
+        
+        return super().increment(method=method, url=url, response=response, error=error,
+                                 _pool=_pool, _stacktrace=_stacktrace)
+
+class HTTPSessionPool:
+    """Keep-alive HTTP sessions with one connection pool per provider.
+    
+    Synchronous calls share a requests.Session per provider. Async calls
+    share an httpx.AsyncClient per provider and event loop, since async
+    connections cannot be used from a loop other than the one that opened them.
+    """
+    
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5.0,
+                 read_timeout: float = 120.0, max_retries: int = 2,
+                 backoff_factor: float = 0.1, async_pool_size: int = 256):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.async_pool_size = async_pool_size
+        self._sessions = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+    
+    def get_session(self, provider_name: str) -> requests.Session:
+        """Get the session for a provider, creating it on first use."""
+        with self._lock:
+            session = self._sessions.get(provider_name)
+            if session is None:
+                session = self._create_session()
+                self._sessions[provider_name] = session
+            
+            return session
+    
+    def _create_session(self) -> requests.Session:
+        """Create a session whose adapters keep connections alive."""
+        retry = ConnectionResetRetry(
+            total=None,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=0,
+            redirect=0,
+            allowed_methods=None,
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+            pool_block=False
+        )
+        
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        
+        return session
+    
+    def get_async_client(self, provider_name: str) -> httpx.AsyncClient:
+        """Get the async client for a provider on the running event loop."""
+        loop = asyncio.get_running_loop()
+        
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(provider_name)
+            if client is None:
+                # httpx only retries failed connects, never a sent request
+                transport = httpx.AsyncHTTPTransport(
+                    retries=self.max_retries,
+                    limits=httpx.Limits(
+                        max_connections=self.async_pool_size,
+                        max_keepalive_connections=self.pool_size
+                    )
+                )
+                client = httpx.AsyncClient(
+                    transport=transport,
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+                )
+                clients[provider_name] = client
+            
+            return client
+    
+    def request(self, provider_name: str, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request through the provider's pooled session."""
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        
+        return self.get_session(provider_name).request(method, url, **kwargs)
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get connection reuse and occupancy statistics for every provider session.
+        
+        Each host's pool reports its connections in use, idle and open.
+        Connections opened past pool_size while the pool was full are
+        closed on return and not counted as in use.
+        """
+        with self._lock:
+            sessions = dict(self._sessions)
+        
+        stats = {}
+        for provider_name, session in sessions.items():
+            requests_sent = 0
+            connections_opened = 0
+            hosts = {}
+            
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    
+                    requests_sent += pool.num_requests
+                    connections_opened += pool.num_connections
+                    
+                    # Slots hold an idle connection or None; checked-out connections leave their slot empty
+                    slots = list(pool.pool.queue)
+                    idle = sum(1 for conn in slots if conn is not None)
+                    in_use = max(0, pool.pool.maxsize - len(slots))
+                    hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                        "in_use": in_use,
+                        "idle": idle,
+                        "open": in_use + idle
+                    }
+            
+            stats[provider_name] = {
+                "requests": requests_sent,
+                "connections_opened": connections_opened,
+                "connections_in_use": sum(host["in_use"] for host in hosts.values()),
+                "idle_connections": sum(host["idle"] for host in hosts.values()),
+                "open_connections": sum(host["open"] for host in hosts.values()),
+                "reuse_ratio": 1 - connections_opened / requests_sent if requests_sent else 0.0,
+                "hosts": hosts
+            }
+        
+        return stats
+    
+    def close(self):
+        """Close every session and drop its pooled sockets."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        
+        for session in sessions:
+            session.close()
+    
+    async def aclose(self):
+        """Close the async clients opened on the running event loop."""
+        loop = asyncio.get_running_loop()
+        
+        with self._lock:
+            clients = self._async_clients.pop(loop, {})
+        
+        for client in clients.values():
+            await client.aclose()
+
+_default_http_pool = None
+_default_http_pool_lock = threading.Lock()
+
+def get_default_http_pool() -> HTTPSessionPool:
+    """Get the process-wide pool used by providers not owned by a manager."""
+    global _default_http_pool
+    
+    with _default_http_pool_lock:
+        if _default_http_pool is None:
+            _default_http_pool = HTTPSessionPool()
+        
+        return _default_http_pool
+
+# Set on the thread running one side of a hedged request, so that its streaming
+# response can be closed from another thread as soon as the other side wins
+_hedge_attempt = threading.local()
+
+def _hedge_attempt_lost() -> bool:
+    """Check whether this thread runs a hedged attempt that the other side has beaten."""
+    lost = getattr(_hedge_attempt, "lost", None)
+    return lost is not None and lost()
+
+class RateLimitExceeded(RuntimeError):
+    """Raised when a caller would have to queue longer than the limiter allows."""
+    
+    def __init__(self, key: str, wait: float):
+        super().__init__(f"Rate limit for '{key}' would require waiting {wait:.1f}s")
+        self.key = key
+        self.wait = wait
+
+class TokenBucket:
+    """Token bucket where callers reserve capacity in arrival order.
+    
+    The level may go negative: each reservation is ready once the bucket has
+    refilled past everything reserved before it, so queued callers are served
+    first come, first served without a separate queue.
+    """
+    
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+    
+    def _refill(self, now: float):
+        # While paused, updated_at is in the future and nothing refills
+        if now > self.updated_at:
+            self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+            self.updated_at = now
+    
+    def reserve(self, amount: float, now: float) -> float:
+        """Reserve capacity and return the time at which it is available."""
+        self._refill(now)
+        # A request larger than the bucket waits for a full bucket instead of forever
+        self.level -= min(amount, self.capacity)
+        
+        deficit = max(0.0, -self.level)
+        return max(now, self.updated_at + deficit / self.refill_per_second)
+    
+    def refund(self, amount: float):
+        """Return capacity that was reserved but not used."""
+        self.level = min(self.capacity, self.level + amount)
+    
+    def drain(self, remaining: float, until: float = None):
+        """Match the level the provider reports, pausing refills until it resets."""
+        self.level = min(self.level, remaining)
+        if until is not None and remaining <= 0:
+            self.updated_at = max(self.updated_at, until)
+
+class RateLimiter:
+    """Client-side request and token budget for one provider API key.
+    
+    Callers reserve one request and their estimated tokens before calling
+    the provider, and sleep until both budgets allow it. The budgets follow
+    the provider's rate-limit headers, and a 429 with Retry-After pauses
+    every caller until the provider is ready again.
+    """
+    
+    def __init__(self, key: str, requests_per_minute: int = None,
+                 tokens_per_minute: int = None, max_wait: float = 60.0):
+        self.key = key
+        self.max_wait = max_wait
+        # Retry-After applies even without configured budgets, so requests always have a bucket
+        self.request_bucket = TokenBucket(requests_per_minute or float("inf"), (requests_per_minute or 0) / 60.0)
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "acquired": 0, "waited": 0, "total_wait": 0.0, "max_wait": 0.0,
+            "rejected": 0, "rate_limited": 0
+        }
+    
+    def _reserve(self, tokens: int, max_wait: float = None) -> float:
+        """Reserve budget for a request and return how long to wait for it."""
+        if max_wait is None or (self.max_wait is not None and self.max_wait < max_wait):
+            max_wait = self.max_wait
+        
+        with self._lock:
+            now = time.monotonic()
+            ready_at = max(now, self.paused_until)
+            
+            if self.request_bucket.refill_per_second:
+                ready_at = max(ready_at, self.request_bucket.reserve(1, now))
+            if self.token_bucket is not None:
+                ready_at = max(ready_at, self.token_bucket.reserve(tokens, now))
+            
+            wait = ready_at - now
+            if max_wait is not None and wait > max_wait:
+                # Give the reservation back so callers behind us aren't delayed by it
+                if self.request_bucket.refill_per_second:
+                    self.request_bucket.refund(1)
+                if self.token_bucket is not None:
+                    self.token_bucket.refund(min(tokens, self.token_bucket.capacity))
+                self._stats["rejected"] += 1
+                raise RateLimitExceeded(self.key, wait)
+            
+            self._stats["acquired"] += 1
+            if wait > 0:
+                self._stats["waited"] += 1
+                self._stats["total_wait"] += wait
+                self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+                self._waiting += 1
+            
+            return wait
+    
+    def _done_waiting(self):
+        with self._lock:
+            self._waiting -= 1
+    
+    def acquire(self, tokens: int = 0, max_wait: float = None):
+        """Block until a request of this many tokens fits the budget.
+        
+        A max_wait shorter than the limiter's own bounds this call's wait.
+        """
+        wait = self._reserve(tokens, max_wait)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._done_waiting()
+    
+    async def aacquire(self, tokens: int = 0, max_wait: float = None):
+        """Wait without blocking the event loop until a request fits the budget."""
+        wait = self._reserve(tokens, max_wait)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._done_waiting()
+    
+    def settle(self, reserved_tokens: int, used_tokens: int):
+        """Refund the difference between the estimated and actual token usage."""
+        if self.token_bucket is None or used_tokens >= reserved_tokens:
+            return
+        
+        with self._lock:
+            self.token_bucket.refund(reserved_tokens - used_tokens)
+    
+    def update_from_response(self, status_code: int, headers: Any):
+        """Adapt the budgets to a response's Retry-After and rate-limit headers."""
+        now = time.monotonic()
+        
+        with self._lock:
+            if status_code == 429:
+                self._stats["rate_limited"] += 1
+            
+            retry_after = parse_retry_after(headers.get("retry-after"))
+            if retry_after is None and status_code == 429:
+                # Back off briefly when the provider doesn't say for how long
+                retry_after = 1.0
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            
+            for bucket, kind in ((self.request_bucket, "requests"), (self.token_bucket, "tokens")):
+                if bucket is None:
+                    continue
+                
+                remaining = _first_header(headers, f"x-ratelimit-remaining-{kind}",
+                                          f"anthropic-ratelimit-{kind}-remaining")
+                if remaining is None:
+                    continue
+                
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    continue
+                
+                reset = parse_retry_after(_first_header(headers, f"x-ratelimit-reset-{kind}",
+                                                        f"anthropic-ratelimit-{kind}-reset"))
+                bucket.drain(remaining, now + reset if reset is not None else None)
+                if remaining <= 0 and reset is not None:
+                    self.paused_until = max(self.paused_until, now + reset)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get queue depth and wait time counters."""
+        with self._lock:
+            return {
+                **self._stats,
+                "queue_depth": self._waiting,
+                "avg_wait": self._stats["total_wait"] / self._stats["waited"] if self._stats["waited"] else 0.0,
+                "paused_for": max(0.0, self.paused_until - time.monotonic())
+            }
+
+def _first_header(headers: Any, *names: str) -> Optional[str]:
+    """Get the first of several headers that is present."""
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            return value
+    
+    return None
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After or rate-limit reset header into seconds from now.
+    
+    Accepts seconds ("30"), Go-style durations ("1m30s", "250ms"),
+    HTTP dates and ISO 8601 timestamps.
+    """
+    if not value:
+        return None
+    
+    value = value.strip()
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    match = re.fullmatch(r"(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?", value)
+    if match and any(match.groups()):
+        hours, minutes, seconds, millis = (float(group or 0) for group in match.groups())
+        return hours * 3600 + minutes * 60 + seconds + millis / 1000
+    
+    try:
+        reset_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            reset_at = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=datetime.timezone.utc)
+    
+    return max(0.0, (reset_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+class SSEDecoder:
+    """Incremental decoder for server-sent event lines.
+    
+    Multi-line ``data:`` fields are joined, comments and other fields are
+    ignored, and the OpenAI-style ``[DONE]`` sentinel ends the stream.
+    """
+    
+    def __init__(self):
+        self.data_lines = []
+        self.done = False
+    
+    def decode(self, line: Union[bytes, str]) -> Optional[Dict[str, Any]]:
+        """Feed one line, returning an event once a blank line completes it."""
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        
+        if not line:
+            if not self.data_lines:
+                return None
+            
+            data = "\n".join(self.data_lines)
+            self.data_lines = []
+            
+            if data.strip() == "[DONE]":
+                self.done = True
+                return None
+            
+            return json.loads(data)
+        
+        if not line.startswith(":"):
+            field, _, value = line.partition(":")
+            if field == "data":
+                self.data_lines.append(value[1:] if value.startswith(" ") else value)
+        
+        return None
+
+def iter_sse_events(lines: Iterable[Union[bytes, str]]) -> Iterator[Dict[str, Any]]:
+    """Parse server-sent event lines into decoded JSON payloads."""
+    decoder = SSEDecoder()
+    
+    for line in itertools.chain(lines, [b""]):
+        event = decoder.decode(line)
+        if decoder.done:
+            return
+        
+        if event is not None:
+            yield event
+
+async def aiter_sse_events(lines: AsyncIterable[str]) -> AsyncIterator[Dict[str, Any]]:
+    """Parse server-sent event lines from an async source."""
+    decoder = SSEDecoder()
+    
+    async for line in lines:
+        event = decoder.decode(line)
+        if decoder.done:
+            return
+        
+        if event is not None:
+            yield event
+    
+    event = decoder.decode("")
+    if event is not None:
+        yield event
+
+def _decode_ndjson_line(line: Union[bytes, str]) -> Optional[Dict[str, Any]]:
+    """Decode one newline-delimited JSON line, skipping blank lines."""
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    
+    return json.loads(line) if line.strip() else None
+
+def iter_ndjson_events(lines: Iterable[Union[bytes, str]]) -> Iterator[Dict[str, Any]]:
+    """Parse newline-delimited JSON lines into decoded payloads."""
+    for line in lines:
+        event = _decode_ndjson_line(line)
+        if event is not None:
+            yield event
+
+async def aiter_ndjson_events(lines: AsyncIterable[str]) -> AsyncIterator[Dict[str, Any]]:
+    """Parse newline-delimited JSON lines from an async source."""
+    async for line in lines:
+        event = _decode_ndjson_line(line)
+        if event is not None:
+            yield event
 
 class AIModelProvider(ABC):
     """Abstract base class for AI model providers."""
     
-    @abstractmethod
+    http_pool: Optional[HTTPSessionPool] = None
+    rate_limiter: Optional[RateLimiter] = None
+    
+    # Wire format of streamed responses: "sse" or "ndjson"
+    stream_format = "sse"
+    
+    # Default client-side quotas; None leaves pacing to the provider's rate-limit headers
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    
+    # Prompts one request to a native batch endpoint may carry; 1 means no batch endpoint
+    max_batch_size = 1
+    
+    # Whether system messages can be cached provider-side, and the smallest worth caching
+    supports_prefix_caching = False
+    min_prefix_cache_tokens = 1024
+    
+    def attach_http_pool(self, http_pool: HTTPSessionPool):
+        """Send this provider's requests through the given pool."""
+        self.http_pool = http_pool
+    
+    def attach_rate_limiter(self, rate_limiter: RateLimiter):
+        """Pace this provider's requests with the given limiter."""
+        self.rate_limiter = rate_limiter
+    
+    @property
+    def rate_limit_key(self) -> str:
+        """Identify the quota this provider draws from: its name and API key."""
+        api_key = getattr(self, "api_key", None) or getattr(self, "base_url", "")
+        return f"{self.provider_name}:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}"
+    
+    @staticmethod
+    def _quota_input(prompt: str, system_message: str = None) -> str:
+        """Get all the input a request is billed for: the system message, often the bulk of it, and the prompt."""
+        return f"{system_message}\n{prompt}" if system_message else prompt
+    
+    def _acquire_quota(self, prompt: str, max_tokens: int, model: str = None, system_message: str = None,
+                       max_wait: float = None) -> int:
+        """Wait for room in the rate limit and return the tokens reserved."""
+        if self.rate_limiter is None:
+            return 0
+        
+        tokens = self.get_token_usage(self._quota_input(prompt, system_message), "", model)["prompt_tokens"] \
+            + (max_tokens or 0)
+        self.rate_limiter.acquire(tokens, max_wait)
+        
+        return tokens
+    
+    async def _aacquire_quota(self, prompt: str, max_tokens: int, model: str = None,
+                              system_message: str = None, max_wait: float = None) -> int:
+        """Wait, without blocking the loop, for room in the rate limit."""
+        if self.rate_limiter is None:
+            return 0
+        
+        tokens = self.get_token_usage(self._quota_input(prompt, system_message), "", model)["prompt_tokens"] \
+            + (max_tokens or 0)
+        await self.rate_limiter.aacquire(tokens, max_wait)
+        
+        return tokens
+    
+    def _settle_quota(self, reserved_tokens: int, prompt: str, response: str, model: str = None,
+                      reported: Dict[str, int] = None, system_message: str = None):
+        """Give back reserved tokens the request did not use."""
+        if self.rate_limiter is not None:
+            if reported and "total_tokens" in reported:
+                used = reported["total_tokens"]
+            else:
+                used = self.get_token_usage(self._quota_input(prompt, system_message), response, model)["total_tokens"]
+            self.rate_limiter.settle(reserved_tokens, used)
+    
+    def _release_quota(self, reserved_tokens: int):
+        """Give back the whole reservation of a request that failed before producing anything."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.settle(reserved_tokens, 0)
+    
+    def _parse_usage(self, result: Any) -> Dict[str, int]:
+        """Extract the token counts a response or stream event reports, if any.
+        
+        OpenAI-compatible APIs report a "usage" object; providers with another
+        format override this. Streams may report the counts across several
+        events, so the result can hold only some of the fields.
+        """
+        usage = result.get("usage") if isinstance(result, dict) else None
+        if not usage:
+            return {}
+        
+        return _usage_fields(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+    
+    @staticmethod
+    def _report_usage(usage: Optional[Dict[str, int]], reported: Dict[str, int]):
+        """Copy complete reported token counts into the caller's usage dict."""
+        if usage is None or "prompt_tokens" not in reported or "completion_tokens" not in reported:
+            return
+        
+        usage.update(reported)
+        usage["total_tokens"] = reported["prompt_tokens"] + reported["completion_tokens"]
+    
+    def _check_response(self, response: Union[requests.Response, httpx.Response]):
+        """Feed rate-limit headers to the limiter, then raise for HTTP errors."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.update_from_response(response.status_code, response.headers)
+        
+        response.raise_for_status()
+    
+    def _post(self, url: str, **kwargs) -> requests.Response:
+        """POST through the provider's pooled keep-alive session."""
+        pool = self.http_pool or get_default_http_pool()
+        response = pool.request(self.provider_name, "POST", url, **kwargs)
+        
+        on_stream = getattr(_hedge_attempt, "on_stream", None)
+        if on_stream is not None and kwargs.get("stream"):
+            on_stream(response)
+        
+        return response
+    
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        """GET through the provider's pooled keep-alive session."""
+        pool = self.http_pool or get_default_http_pool()
+        return pool.request(self.provider_name, "GET", url, **kwargs)
+    
+    def _patch(self, url: str, **kwargs) -> requests.Response:
+        """PATCH through the provider's pooled keep-alive session."""
+        pool = self.http_pool or get_default_http_pool()
+        return pool.request(self.provider_name, "PATCH", url, **kwargs)
+    
+    def _delete(self, url: str, **kwargs) -> requests.Response:
+        """DELETE through the provider's pooled keep-alive session."""
+        pool = self.http_pool or get_default_http_pool()
+        return pool.request(self.provider_name, "DELETE", url, **kwargs)
+    
+    def create_prefix_cache(self, prefix: str, model: str = None, ttl: float = 3600) -> Optional[str]:
+        """Cache a system message provider-side and return the handle requests pass as prefix_cache.
+        
+        Providers without supports_prefix_caching return None.
+        """
+        return None
+    
+    def renew_prefix_cache(self, handle: str, ttl: float = 3600):
+        """Extend the lifetime of a cached prefix."""
+        pass
+    
+    def delete_prefix_cache(self, handle: str):
+        """Delete a cached prefix before it expires."""
+        pass
+    
+    def _async_client(self) -> httpx.AsyncClient:
+        """Get the pooled async client for this provider."""
+        pool = self.http_pool or get_default_http_pool()
+        return pool.get_async_client(self.provider_name)
+    
     def generate_text(self, prompt: str, system_message: str = None, 
                      temperature: float = 0.7, max_tokens: int = 1000, 
-                     stream: bool = False, **kwargs) -> str:
-        """Generate text from the model."""
+                     stream: bool = False, model: str = None, 
+                     usage: Dict[str, int] = None, rate_limit_wait: float = None, **kwargs) -> str:
+        """Generate text from the model.
+        
+        If a usage dict is passed, it is filled with the exact token counts
+        the provider reports, when it reports them. A rate_limit_wait bounds
+        how long to wait for the rate limit before raising RateLimitExceeded.
+        """
+        if stream and self.supports_streaming:
+            return "".join(self.stream_text(prompt, system_message, temperature, max_tokens,
+                                            model=model, usage=usage,
+                                            rate_limit_wait=rate_limit_wait, **kwargs))
+        
+        url, headers, payload = self._build_request(prompt, system_message, temperature, max_tokens,
+                                                    stream=False, model=model, **kwargs)
+        
+        reserved = self._acquire_quota(prompt, max_tokens, model, system_message, rate_limit_wait)
+        try:
+            response = self._post(url, headers=headers, json=payload)
+            self._check_response(response)
+            result = response.json()
+        except Exception:
+            self._release_quota(reserved)
+            raise
+        
+        text = self._parse_response(result)
+        reported = self._parse_usage(result)
+        self._report_usage(usage, reported)
+        self._settle_quota(reserved, prompt, text, model, usage, system_message)
+        
+        return text
+    
+    def stream_text(self, prompt: str, system_message: str = None, 
+                    temperature: float = 0.7, max_tokens: int = 1000, 
+                    model: str = None, usage: Dict[str, int] = None, 
+                    rate_limit_wait: float = None, **kwargs) -> Iterator[str]:
+        """Stream generated text from the model as it arrives."""
+        if not self.supports_streaming:
+            yield self.generate_text(prompt, system_message, temperature, max_tokens,
+                                     model=model, usage=usage, rate_limit_wait=rate_limit_wait,
+                                     **kwargs)
+            return
+        
+        url, headers, payload = self._build_request(prompt, system_message, temperature, max_tokens,
+                                                    stream=True, model=model, **kwargs)
+        
+        reserved = self._acquire_quota(prompt, max_tokens, model, system_message, rate_limit_wait)
+        chunks = []
+        reported = {}
+        
+        try:
+            with self._post(url, headers=headers, json=payload, stream=True) as response:
+                self._check_response(response)
+                
+                for event in self._iter_stream_events(response):
+                    reported.update(self._parse_usage(event))
+                    text = self._parse_stream_event(event)
+                    if text:
+                        chunks.append(text)
+                        yield text
+        except Exception:
+            if not chunks:
+                self._release_quota(reserved)
+                reserved = 0
+            raise
+        finally:
+            self._report_usage(usage, reported)
+            self._settle_quota(reserved, prompt, "".join(chunks), model, usage, system_message)
+    
+    async def agenerate_text(self, prompt: str, system_message: str = None, 
+                             temperature: float = 0.7, max_tokens: int = 1000, 
+                             stream: bool = False, model: str = None, 
+                             usage: Dict[str, int] = None, rate_limit_wait: float = None,
+                             **kwargs) -> str:
+        """Generate text from the model without blocking the event loop."""
+        if stream and self.supports_streaming:
+            return "".join([chunk async for chunk in self.astream_text(
+                prompt, system_message, temperature, max_tokens, model=model, usage=usage,
+                rate_limit_wait=rate_limit_wait, **kwargs)])
+        
+        url, headers, payload = self._build_request(prompt, system_message, temperature, max_tokens,
+                                                    stream=False, model=model, **kwargs)
+        
+        reserved = await self._aacquire_quota(prompt, max_tokens, model, system_message, rate_limit_wait)
+        try:
+            response = await self._async_client().post(url, headers=headers, json=payload)
+            self._check_response(response)
+            result = response.json()
+        except Exception:
+            self._release_quota(reserved)
+            raise
+        
+        text = self._parse_response(result)
+        self._report_usage(usage, self._parse_usage(result))
+        self._settle_quota(reserved, prompt, text, model, usage, system_message)
+        
+        return text
+    
+    async def astream_text(self, prompt: str, system_message: str = None, 
+                           temperature: float = 0.7, max_tokens: int = 1000, 
+                           model: str = None, usage: Dict[str, int] = None, 
+                           rate_limit_wait: float = None, **kwargs) -> AsyncIterator[str]:
+        """Stream generated text from the model without blocking the event loop."""
+        if not self.supports_streaming:
+            yield await self.agenerate_text(prompt, system_message, temperature, max_tokens,
+                                            model=model, usage=usage,
+                                            rate_limit_wait=rate_limit_wait, **kwargs)
+            return
+        
+        url, headers, payload = self._build_request(prompt, system_message, temperature, max_tokens,
+                                                    stream=True, model=model, **kwargs)
+        
+        reserved = await self._aacquire_quota(prompt, max_tokens, model, system_message, rate_limit_wait)
+        chunks = []
+        reported = {}
+        
+        try:
+            async with self._async_client().stream("POST", url, headers=headers, json=payload) as response:
+                self._check_response(response)
+                
+                async for event in self._aiter_stream_events(response):
+                    reported.update(self._parse_usage(event))
+                    text = self._parse_stream_event(event)
+                    if text:
+                        chunks.append(text)
+                        yield text
+        except Exception:
+            if not chunks:
+                self._release_quota(reserved)
+                reserved = 0
+            raise
+        finally:
+            self._report_usage(usage, reported)
+            self._settle_quota(reserved, prompt, "".join(chunks), model, usage, system_message)
+    
+    def _iter_stream_events(self, response: requests.Response) -> Iterator[Dict[str, Any]]:
+        """Decode a streaming response body into JSON events."""
+        if self.stream_format == "ndjson":
+            return iter_ndjson_events(response.iter_lines())
+        
+        return iter_sse_events(response.iter_lines())
+    
+    def _aiter_stream_events(self, response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+        """Decode an async streaming response body into JSON events."""
+        if self.stream_format == "ndjson":
+            return aiter_ndjson_events(response.aiter_lines())
+        
+        return aiter_sse_events(response.aiter_lines())
+    
+    def generate_batch(self, prompts: List[str], system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       model: str = None, **kwargs) -> List[str]:
+        """Generate a completion for each prompt with one native batch request."""
+        if len(prompts) > self.max_batch_size:
+            raise ValueError(f"{self.provider_name} accepts at most {self.max_batch_size} prompts per batch")
+        
+        request = self._build_batch_request(prompts, system_message, temperature, max_tokens,
+                                            model=model, **kwargs)
+        if request is None:
+            # Without a batch endpoint max_batch_size is 1, so this is a single completion
+            return [self.generate_text(prompt, system_message, temperature, max_tokens, model=model, **kwargs)
+                    for prompt in prompts]
+        
+        url, headers, payload = request
+        joined = "\n".join(prompts)
+        # The system message is sent once for the whole batch
+        reserved = self._acquire_quota(joined, max_tokens * len(prompts), model, system_message)
+        try:
+            response = self._post(url, headers=headers, json=payload)
+            self._check_response(response)
+            result = response.json()
+        except Exception:
+            self._release_quota(reserved)
+            raise
+        
+        texts = self._parse_batch_response(result, len(prompts))
+        self._settle_quota(reserved, joined, "".join(texts), model, system_message=system_message)
+        
+        return texts
+    
+    def _build_batch_request(self, prompts: List[str], system_message: str = None, 
+                             temperature: float = 0.7, max_tokens: int = 1000, 
+                             model: str = None, 
+                             **kwargs) -> Optional[Tuple[str, Dict[str, str], Dict[str, Any]]]:
+        """Build the URL, headers and payload for a native batch request, or None without one."""
+        return None
+    
+    def _parse_batch_response(self, result: Any, count: int) -> Optional[List[str]]:
+        """Extract the generated text for each prompt from a batch response built by _build_batch_request."""
+        return None
+    
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed event."""
+        return ""
+    
+    @abstractmethod
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a completion request."""
         pass
     
     @abstractmethod
-    def get_available_models(self) -> List[Dict[str, Any]]:
-        """Get list of available models from this provider."""
+    def _parse_response(self, result: Any) -> str:
+        """Extract the generated text from a completion response."""
         pass
     
     @abstractmethod
-    def get_token_usage(self, prompt: str, response: str) -> Dict[str, int]:
-        """Get token usage for a prompt and response."""
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """Get list of available models from this provider."""
         pass
     
+    def get_token_usage(self, prompt: str, response: str, model: str = None) -> Dict[str, int]:
+        """Count the tokens in a prompt and response with the model's tokenizer."""
+        prompt_tokens, completion_tokens = get_token_counter().count_batch(
+            [prompt, response], self.provider_name, model or getattr(self, "default_model", None)
+        )
+        
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    
     @property
     @abstractmethod
     def provider_name(self) -> str:
@@ -45,6 +931,14 @@ class AIModelProvider(ABC):
 class GeminiProvider(AIModelProvider):
     """Provider for Google's Gemini models."""
     
+    # Free tier quota
+    requests_per_minute = 15
+    tokens_per_minute = 1000000
+    
+    # Explicit caching via the cachedContents API
+    supports_prefix_caching = True
+    min_prefix_cache_tokens = 4096
+    
     def __init__(self, api_key: str = None):
         self.api_key = api_key or os.environ.get("GEMINI_API_KEY")
         if not self.api_key:
@@ -58,13 +952,18 @@ class GeminiProvider(AIModelProvider):
         }
         self.default_model = "gemini-flash-2.0"
     
-    def generate_text(self, prompt: str, system_message: str = None, 
-                     temperature: float = 0.7, max_tokens: int = 1000, 
-                     stream: bool = False, model: str = None, **kwargs) -> str:
-        """Generate text using Gemini models."""
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Gemini request."""
         model_endpoint = self.models.get(model or self.default_model)
         
-        url = f"{self.base_url}/{model_endpoint}?key={self.api_key}"
+        if stream:
+            model_endpoint = model_endpoint.replace(":generateContent", ":streamGenerateContent")
+            url = f"{self.base_url}/{model_endpoint}?alt=sse&key={self.api_key}"
+        else:
+            url = f"{self.base_url}/{model_endpoint}?key={self.api_key}"
         
         payload = {
             "contents": [
@@ -81,23 +980,70 @@ class GeminiProvider(AIModelProvider):
             }
         }
         
-        if system_message:
+        if kwargs.get("prefix_cache"):
+            # The cached content already holds the system instruction
+            payload["cachedContent"] = kwargs["prefix_cache"]
+        elif system_message:
             payload["systemInstruction"] = {"parts": [{"text": system_message}]}
         
         headers = {
             "Content-Type": "application/json"
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        return url, headers, payload
+    
+    def create_prefix_cache(self, prefix: str, model: str = None, ttl: float = 3600) -> str:
+        """Store a system instruction as Gemini cached content."""
+        model_name = self.models.get(model or self.default_model).split(":")[0]
+        payload = {
+            "model": model_name,
+            "systemInstruction": {"parts": [{"text": prefix}]},
+            "ttl": f"{int(ttl)}s"
+        }
         
-        result = response.json()
+        response = self._post(f"{self.base_url}/cachedContents?key={self.api_key}",
+                              headers={"Content-Type": "application/json"}, json=payload)
+        self._check_response(response)
         
+        return response.json()["name"]
+    
+    def renew_prefix_cache(self, handle: str, ttl: float = 3600):
+        """Reset the TTL of Gemini cached content."""
+        response = self._patch(f"{self.base_url}/{handle}?updateMask=ttl&key={self.api_key}",
+                               headers={"Content-Type": "application/json"},
+                               json={"ttl": f"{int(ttl)}s"})
+        self._check_response(response)
+    
+    def delete_prefix_cache(self, handle: str):
+        """Delete Gemini cached content."""
+        response = self._delete(f"{self.base_url}/{handle}?key={self.api_key}")
+        if response.status_code != 404:
+            self._check_response(response)
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Gemini response."""
         if "candidates" in result and len(result["candidates"]) > 0:
             return result["candidates"][0]["content"]["parts"][0]["text"]
         
         return ""
     
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed Gemini event."""
+        candidates = event.get("candidates") or [{}]
+        parts = candidates[0].get("content", {}).get("parts", [])
+        
+        return "".join(part.get("text", "") for part in parts)
+    
+    def _parse_usage(self, result: Any) -> Dict[str, int]:
+        """Extract the token counts from a Gemini response or streamed event."""
+        metadata = result.get("usageMetadata") if isinstance(result, dict) else None
+        if not metadata:
+            return {}
+        
+        # Streamed events repeat the running totals, so the last one is exact
+        return _usage_fields(metadata.get("promptTokenCount"), metadata.get("candidatesTokenCount"),
+                             metadata.get("cachedContentTokenCount"))
+    
     def get_available_models(self) -> List[Dict[str, Any]]:
         """Get list of available Gemini models."""
         return [
@@ -124,18 +1070,6 @@ class GeminiProvider(AIModelProvider):
             }
         ]
     
-    def get_token_usage(self, prompt: str, response: str) -> Dict[str, int]:
-        """Estimate token usage for Gemini models."""
-        # Simple estimation: ~4 characters per token
-        prompt_tokens = len(prompt) // 4
-        completion_tokens = len(response) // 4
-        
-        return {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens
-        }
-    
     @property
     def provider_name(self) -> str:
         return "Gemini"
@@ -163,10 +1097,11 @@ class DeepSeekProvider(AIModelProvider):
         }
         self.default_model = "deepseek-chat"
     
-    def generate_text(self, prompt: str, system_message: str = None, 
-                     temperature: float = 0.7, max_tokens: int = 1000, 
-                     stream: bool = False, model: str = None, **kwargs) -> str:
-        """Generate text using DeepSeek models."""
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a DeepSeek request."""
         endpoint = self.models.get(model or self.default_model)
         url = f"{self.base_url}/{endpoint}"
         
@@ -189,16 +1124,22 @@ class DeepSeekProvider(AIModelProvider):
             "Authorization": f"Bearer {self.api_key}"
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        
-        result = response.json()
-        
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a DeepSeek response."""
         if "choices" in result and len(result["choices"]) > 0:
             return result["choices"][0]["message"]["content"]
         
         return ""
     
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed DeepSeek event."""
+        if "choices" in event and len(event["choices"]) > 0:
+            return event["choices"][0].get("delta", {}).get("content") or ""
+        
+        return ""
+    
     def get_available_models(self) -> List[Dict[str, Any]]:
         """Get list of available DeepSeek models."""
         return [
@@ -218,18 +1159,6 @@ class DeepSeekProvider(AIModelProvider):
             }
         ]
     
-    def get_token_usage(self, prompt: str, response: str) -> Dict[str, int]:
-        """Estimate token usage for DeepSeek models."""
-        # Simple estimation: ~4 characters per token
-        prompt_tokens = len(prompt) // 4
-        completion_tokens = len(response) // 4
-        
-        return {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens
-        }
-    
     @property
     def provider_name(self) -> str:
         return "DeepSeek"
@@ -245,6 +1174,9 @@ class DeepSeekProvider(AIModelProvider):
 class HuggingFaceProvider(AIModelProvider):
     """Provider for Hugging Face models."""
     
+    # Text generation accepts a list of inputs and batches them on the server
+    max_batch_size = 8
+    
     def __init__(self, api_key: str = None):
         self.api_key = api_key or os.environ.get("HUGGINGFACE_API_KEY")
         if not self.api_key:
@@ -253,10 +1185,11 @@ class HuggingFaceProvider(AIModelProvider):
         self.base_url = "https://api-inference.huggingface.co/models"
         self.default_model = "mistralai/Mistral-7B-Instruct-v0.2"
     
-    def generate_text(self, prompt: str, system_message: str = None, 
-                     temperature: float = 0.7, max_tokens: int = 1000, 
-                     stream: bool = False, model: str = None, **kwargs) -> str:
-        """Generate text using Hugging Face models."""
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Hugging Face request."""
         model_name = model or self.default_model
         url = f"{self.base_url}/{model_name}"
         
@@ -284,16 +1217,42 @@ class HuggingFaceProvider(AIModelProvider):
             "Content-Type": "application/json"
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        return url, headers, payload
+    
+    def _build_batch_request(self, prompts: List[str], system_message: str = None, 
+                             temperature: float = 0.7, max_tokens: int = 1000, 
+                             model: str = None, 
+                             **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build one Hugging Face request whose inputs are all the prompts."""
+        built = [self._build_request(prompt, system_message, temperature, max_tokens, model=model, **kwargs)
+                 for prompt in prompts]
         
-        result = response.json()
+        url, headers, payload = built[0]
+        payload["inputs"] = [request[2]["inputs"] for request in built]
         
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Hugging Face response."""
         if isinstance(result, list) and len(result) > 0:
             return result[0].get("generated_text", "")
         
         return ""
     
+    def _parse_batch_response(self, result: Any, count: int) -> List[str]:
+        """Extract the generated text for each input of a Hugging Face batch."""
+        if not isinstance(result, list) or len(result) != count:
+            raise ValueError(f"Expected {count} generations from Hugging Face, got {result!r:.200}")
+        
+        texts = []
+        for generations in result:
+            # Each input gets a list of generations, or a bare generation on some models
+            if isinstance(generations, list):
+                generations = generations[0] if generations else {}
+            texts.append(generations.get("generated_text", ""))
+        
+        return texts
+    
     def get_available_models(self) -> List[Dict[str, Any]]:
         """Get list of available Hugging Face models."""
         return [
@@ -320,18 +1279,6 @@ class HuggingFaceProvider(AIModelProvider):
             }
         ]
     
-    def get_token_usage(self, prompt: str, response: str) -> Dict[str, int]:
-        """Estimate token usage for Hugging Face models."""
-        # Simple estimation: ~4 characters per token
-        prompt_tokens = len(prompt) // 4
-        completion_tokens = len(response) // 4
-        
-        return {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens
-        }
-    
     @property
     def provider_name(self) -> str:
         return "Hugging Face"
@@ -355,10 +1302,11 @@ class OpenRouterProvider(AIModelProvider):
         self.base_url = "https://openrouter.ai/api/v1"
         self.default_model = "openai/gpt-3.5-turbo"
     
-    def generate_text(self, prompt: str, system_message: str = None, 
-                     temperature: float = 0.7, max_tokens: int = 1000, 
-                     stream: bool = False, model: str = None, **kwargs) -> str:
-        """Generate text using OpenRouter models."""
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a OpenRouter request."""
         url = f"{self.base_url}/chat/completions"
         
         messages = []
@@ -382,16 +1330,22 @@ class OpenRouterProvider(AIModelProvider):
             "X-Title": "DeGeNz Lounge"  # Required by OpenRouter
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        
-        result = response.json()
-        
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a OpenRouter response."""
         if "choices" in result and len(result["choices"]) > 0:
             return result["choices"][0]["message"]["content"]
         
         return ""
     
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed OpenRouter event."""
+        if "choices" in event and len(event["choices"]) > 0:
+            return event["choices"][0].get("delta", {}).get("content") or ""
+        
+        return ""
+    
     def get_available_models(self) -> List[Dict[str, Any]]:
         """Get list of available OpenRouter models."""
         # This would typically fetch from OpenRouter's API
@@ -420,19 +1374,6 @@ class OpenRouterProvider(AIModelProvider):
             }
         ]
     
-    def get_token_usage(self, prompt: str, response: str) -> Dict[str, int]:
-        """Get token usage from OpenRouter response."""
-        # In a real implementation, this would parse the usage from the API response
-        # For now, we'll use a simple estimation
-        prompt_tokens = len(prompt) // 4
-        completion_tokens = len(response) // 4
-        
-        return {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens
-        }
-    
     @property
     def provider_name(self) -> str:
         return "OpenRouter"
@@ -448,9 +1389,2037 @@ class OpenRouterProvider(AIModelProvider):
 class AnthropicProvider(AIModelProvider):
     """Provider for Anthropic Claude models."""
     
+    # Prompt caching via cache_control breakpoints
+    supports_prefix_caching = True
+    
     def __init__(self, api_key: str = None):
         self.api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
         if not self.api_key:
             raise ValueError("Anthropic API key is required")
-   
-(Content truncated due to size limit. Use line ranges to read in chunks)
\ No newline at end of file
+        
+        self.base_url = "https://api.anthropic.com/v1"
+        self.default_model = "claude-3-haiku-20240307"
+    
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Anthropic Claude request."""
+        url = f"{self.base_url}/messages"
+        
+        payload = {
+            "model": model or self.default_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+        
+        if system_message and kwargs.get("prefix_cache"):
+            payload["system"] = [
+                {"type": "text", "text": system_message, "cache_control": {"type": "ephemeral"}}
+            ]
+        elif system_message:
+            payload["system"] = system_message
+        
+        if stream:
+            payload["stream"] = True
+        
+        headers = {
+            "Content-Type": "application/json",
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01"
+        }
+        
+        return url, headers, payload
+    
+    def create_prefix_cache(self, prefix: str, model: str = None, ttl: float = 3600) -> str:
+        """Mark system messages for caching.
+        
+        Anthropic caches a marked prefix the first time a request sends it
+        and refreshes its lifetime on every hit, so there is nothing to
+        create, renew or delete.
+        """
+        return "ephemeral"
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Anthropic response."""
+        if "content" in result and len(result["content"]) > 0:
+            return result["content"][0]["text"]
+        
+        return ""
+    
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed Anthropic event."""
+        if event.get("type") == "error":
+            raise RuntimeError(f"Anthropic stream error: {event.get('error', {}).get('message', event)}")
+        
+        if event.get("type") == "content_block_delta":
+            return event.get("delta", {}).get("text", "")
+        
+        return ""
+    
+    def _parse_usage(self, result: Any) -> Dict[str, int]:
+        """Extract the token counts from an Anthropic response or streamed event."""
+        if not isinstance(result, dict):
+            return {}
+        
+        if result.get("type") == "message_start":
+            # The prompt is counted when the stream starts, the output when it ends
+            usage = result.get("message", {}).get("usage", {})
+            return self._input_usage(usage)
+        
+        usage = result.get("usage") or {}
+        return {**self._input_usage(usage), **_usage_fields(None, usage.get("output_tokens"))}
+    
+    @staticmethod
+    def _input_usage(usage: Dict[str, Any]) -> Dict[str, int]:
+        """Count cache reads and writes, which input_tokens leaves out, as prompt tokens."""
+        if "input_tokens" not in usage:
+            return {}
+        
+        cached = usage.get("cache_read_input_tokens") or 0
+        prompt_tokens = usage["input_tokens"] + cached + (usage.get("cache_creation_input_tokens") or 0)
+        
+        return _usage_fields(prompt_tokens, None, cached)
+    
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """Get list of available Anthropic models."""
+        return [
+            {
+                "id": "claude-3-opus-20240229",
+                "name": "Claude 3 Opus",
+                "description": "Most powerful Claude model for complex tasks",
+                "context_length": 200000,
+                "pricing": "Pay per token"
+            },
+            {
+                "id": "claude-3-sonnet-20240229",
+                "name": "Claude 3 Sonnet",
+                "description": "Balanced performance and cost",
+                "context_length": 200000,
+                "pricing": "Pay per token"
+            },
+            {
+                "id": "claude-3-haiku-20240307",
+                "name": "Claude 3 Haiku",
+                "description": "Fast and efficient model",
+                "context_length": 200000,
+                "pricing": "Pay per token"
+            }
+        ]
+    
+    @property
+    def provider_name(self) -> str:
+        return "Anthropic"
+    
+    @property
+    def has_free_tier(self) -> bool:
+        return False
+    
+    @property
+    def supports_streaming(self) -> bool:
+        return True
+
+class MistralAIProvider(AIModelProvider):
+    """Provider for Mistral AI models."""
+    
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key or os.environ.get("MISTRAL_API_KEY")
+        if not self.api_key:
+            raise ValueError("Mistral API key is required")
+        
+        self.base_url = "https://api.mistral.ai/v1"
+        self.default_model = "mistral-small-latest"
+    
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Mistral AI request."""
+        url = f"{self.base_url}/chat/completions"
+        
+        messages = []
+        if system_message:
+            messages.append({"role": "system", "content": system_message})
+        
+        messages.append({"role": "user", "content": prompt})
+        
+        payload = {
+            "model": model or self.default_model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+        
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Mistral AI response."""
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        
+        return ""
+    
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed Mistral AI event."""
+        if "choices" in event and len(event["choices"]) > 0:
+            return event["choices"][0].get("delta", {}).get("content") or ""
+        
+        return ""
+    
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """Get list of available Mistral AI models."""
+        return [
+            {
+                "id": "mistral-tiny-latest",
+                "name": "Mistral Tiny",
+                "description": "Fast and cost-effective model",
+                "context_length": 32000,
+                "pricing": "Pay per token, with free tier"
+            },
+            {
+                "id": "mistral-small-latest",
+                "name": "Mistral Small",
+                "description": "Balanced performance and cost",
+                "context_length": 32000,
+                "pricing": "Pay per token, with free tier"
+            },
+            {
+                "id": "mistral-medium-latest",
+                "name": "Mistral Medium",
+                "description": "Advanced reasoning capabilities",
+                "context_length": 32000,
+                "pricing": "Pay per token"
+            },
+            {
+                "id": "mistral-large-latest",
+                "name": "Mistral Large",
+                "description": "Most powerful Mistral model",
+                "context_length": 32000,
+                "pricing": "Pay per token"
+            }
+        ]
+    
+    @property
+    def provider_name(self) -> str:
+        return "Mistral AI"
+    
+    @property
+    def has_free_tier(self) -> bool:
+        return True
+    
+    @property
+    def supports_streaming(self) -> bool:
+        return True
+
+class PerplexityProvider(AIModelProvider):
+    """Provider for Perplexity models."""
+    
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key or os.environ.get("PERPLEXITY_API_KEY")
+        if not self.api_key:
+            raise ValueError("Perplexity API key is required")
+        
+        self.base_url = "https://api.perplexity.ai"
+        self.default_model = "pplx-7b-online"
+    
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Perplexity request."""
+        url = f"{self.base_url}/chat/completions"
+        
+        messages = []
+        if system_message:
+            messages.append({"role": "system", "content": system_message})
+        
+        messages.append({"role": "user", "content": prompt})
+        
+        payload = {
+            "model": model or self.default_model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+        
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Perplexity response."""
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        
+        return ""
+    
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed Perplexity event."""
+        if "choices" in event and len(event["choices"]) > 0:
+            return event["choices"][0].get("delta", {}).get("content") or ""
+        
+        return ""
+    
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """Get list of available Perplexity models."""
+        return [
+            {
+                "id": "pplx-7b-online",
+                "name": "Perplexity 7B Online",
+                "description": "7B parameter model with online search capabilities",
+                "context_length": 4096,
+                "pricing": "Pay per token, with free tier"
+            },
+            {
+                "id": "pplx-70b-online",
+                "name": "Perplexity 70B Online",
+                "description": "70B parameter model with online search capabilities",
+                "context_length": 4096,
+                "pricing": "Pay per token"
+            },
+            {
+                "id": "pplx-7b-chat",
+                "name": "Perplexity 7B Chat",
+                "description": "7B parameter model optimized for chat",
+                "context_length": 4096,
+                "pricing": "Pay per token, with free tier"
+            },
+            {
+                "id": "pplx-70b-chat",
+                "name": "Perplexity 70B Chat",
+                "description": "70B parameter model optimized for chat",
+                "context_length": 4096,
+                "pricing": "Pay per token"
+            }
+        ]
+    
+    @property
+    def provider_name(self) -> str:
+        return "Perplexity"
+    
+    @property
+    def has_free_tier(self) -> bool:
+        return True
+    
+    @property
+    def supports_streaming(self) -> bool:
+        return True
+
+class GrokProvider(AIModelProvider):
+    """Provider for xAI's Grok models."""
+    
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key or os.environ.get("GROK_API_KEY")
+        if not self.api_key:
+            raise ValueError("Grok API key is required")
+        
+        self.base_url = "https://api.grok.x.ai/v1"
+        self.default_model = "grok-1"
+    
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Grok request."""
+        url = f"{self.base_url}/chat/completions"
+        
+        messages = []
+        if system_message:
+            messages.append({"role": "system", "content": system_message})
+        
+        messages.append({"role": "user", "content": prompt})
+        
+        payload = {
+            "model": model or self.default_model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+        
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Grok response."""
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        
+        return ""
+    
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed Grok event."""
+        if "choices" in event and len(event["choices"]) > 0:
+            return event["choices"][0].get("delta", {}).get("content") or ""
+        
+        return ""
+    
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """Get list of available Grok models."""
+        return [
+            {
+                "id": "grok-1",
+                "name": "Grok-1",
+                "description": "xAI's conversational AI with real-time knowledge",
+                "context_length": 8192,
+                "pricing": "Limited access through platform"
+            }
+        ]
+    
+    @property
+    def provider_name(self) -> str:
+        return "Grok"
+    
+    @property
+    def has_free_tier(self) -> bool:
+        return False
+    
+    @property
+    def supports_streaming(self) -> bool:
+        return True
+
+class OllamaProvider(AIModelProvider):
+    """Provider for Ollama self-hosted models."""
+    
+    stream_format = "ndjson"
+    
+    def __init__(self, base_url: str = "http://localhost:11434"):
+        self.base_url = base_url
+        self.default_model = "llama2"
+    
+    def _build_request(self, prompt: str, system_message: str = None, 
+                       temperature: float = 0.7, max_tokens: int = 1000, 
+                       stream: bool = False, model: str = None, 
+                       **kwargs) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """Build the URL, headers and payload for a Ollama request."""
+        url = f"{self.base_url}/api/generate"
+        
+        # Format prompt based on model
+        formatted_prompt = prompt
+        if system_message:
+            formatted_prompt = f"{system_message}\n\n{prompt}"
+        
+        payload = {
+            "model": model or self.default_model,
+            "prompt": formatted_prompt,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+        
+        headers = {
+            "Content-Type": "application/json"
+        }
+        
+        return url, headers, payload
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the generated text from a Ollama response."""
+        return result.get("response", "")
+    
+    def _parse_stream_event(self, event: Dict[str, Any]) -> str:
+        """Extract the text delta from a streamed Ollama event."""
+        if "error" in event:
+            raise RuntimeError(f"Ollama stream error: {event['error']}")
+        
+        return event.get("response", "")
+    
+    def _parse_usage(self, result: Any) -> Dict[str, int]:
+        """Extract the token counts from an Ollama response or final streamed event."""
+        if not isinstance(result, dict):
+            return {}
+        
+        return _usage_fields(result.get("prompt_eval_count"), result.get("eval_count"))
+    
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """Get list of available Ollama models."""
+        try:
+            response = self._get(f"{self.base_url}/api/tags")
+            if response.status_code == 200:
+                models = response.json().get("models", [])
+                return [
+                    {
+                        "id": model["name"],
+                        "name": model["name"].capitalize(),
+                        "description": "Self-hosted model via Ollama",
+                        "context_length": model.get("context_length", 2048),
+                        "pricing": "Free (self-hosted)"
+                    }
+                    for model in models
+                ]
+        except:
+            pass
+        
+        # Fallback to common models
+        return [
+            {
+                "id": "llama2",
+                "name": "Llama 2",
+                "description": "Meta's general purpose model",
+                "context_length": 4096,
+                "pricing": "Free (self-hosted)"
+            },
+            {
+                "id": "mistral",
+                "name": "Mistral",
+                "description": "Efficient open-source model",
+                "context_length": 8192,
+                "pricing": "Free (self-hosted)"
+            },
+            {
+                "id": "codellama",
+                "name": "CodeLlama",
+                "description": "Specialized for code generation",
+                "context_length": 4096,
+                "pricing": "Free (self-hosted)"
+            }
+        ]
+    
+    @property
+    def provider_name(self) -> str:
+        return "Ollama"
+    
+    @property
+    def has_free_tier(self) -> bool:
+        return True
+    
+    @property
+    def supports_streaming(self) -> bool:
+        return True
+
+class _HedgeRace:
+    """Shared state of the attempts racing to answer one hedged request."""
+    
+    def __init__(self):
+        self.winner = None
+        self._results = {}
+        self._errors = {}
+        self._started = []
+        self._closers = {}  # attempt name -> closes its open streaming response
+        self._condition = threading.Condition()
+    
+    def start(self, name: str, target, *args):
+        """Run an attempt on its own thread."""
+        with self._condition:
+            self._started.append(name)
+        
+        threading.Thread(target=target, args=args, daemon=True).start()
+    
+    def watch(self, name: str, response: Any):
+        """Keep a way to cancel an attempt's streaming response, closing it at once if it already lost."""
+        with self._condition:
+            lost = self.winner is not None and self.winner != name
+            if not lost:
+                self._closers[name] = response.close
+        
+        if lost:
+            response.close()
+    
+    def lost(self, name: str) -> bool:
+        """Check whether another attempt won."""
+        with self._condition:
+            return self.winner is not None and self.winner != name
+    
+    def claim_first_token(self, name: str) -> bool:
+        """Claim the win for an attempt that produced a token; False if it already lost.
+        
+        The first claim closes the other attempts' responses, so a loser that
+        is still waiting for its first token stops at once.
+        """
+        losers = []
+        with self._condition:
+            if self.winner is None:
+                self.winner = name
+                losers = [close for other, close in self._closers.items() if other != name]
+                self._closers.clear()
+                self._condition.notify_all()
+            
+            won = self.winner == name
+        
+        for close in losers:
+            try:
+                close()
+            except Exception as e:
+                logging.debug(f"Error closing a hedged request that lost: {str(e)}")
+        
+        return won
+    
+    def finish(self, name: str, result: str = None, error: Exception = None):
+        """Record how an attempt ended."""
+        with self._condition:
+            if error is not None:
+                self._errors[name] = error
+            else:
+                self._results[name] = result
+            self._condition.notify_all()
+    
+    def _all_failed(self) -> bool:
+        return all(name in self._errors for name in self._started)
+    
+    def wait_for_first_token(self, timeout: float) -> bool:
+        """Wait for a first token; False if none arrived in time or every attempt failed."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.winner is not None or self._all_failed(), timeout)
+            return self.winner is not None
+    
+    def result(self) -> str:
+        """Wait for the winning attempt to finish and return its text."""
+        with self._condition:
+            self._condition.wait_for(lambda: (
+                self.winner in self._results or self.winner in self._errors or self._all_failed()
+            ))
+            
+            if self.winner in self._results:
+                return self._results[self.winner]
+            
+            if self.winner is not None:
+                raise self._errors[self.winner]
+            
+            raise self._errors[self._started[0]]
+
+class BatchResult:
+    """The outcome and timings of one request in a generate_many or stream_many batch."""
+    
+    def __init__(self, index: int, provider_name: str = None, model: str = None):
+        self.index = index
+        self.provider_name = provider_name
+        self.model = model
+        self.response = None
+        self.error = None
+        self.queued = 0.0  # seconds spent waiting for a concurrency slot
+        self.latency = None  # seconds from getting a slot to the full response
+        self.time_to_first_token = None
+        self.batched = False  # served by a provider-native batch request
+    
+    @property
+    def ok(self) -> bool:
+        """Whether the request succeeded."""
+        return self.error is None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the result to a dictionary."""
+        return {
+            "index": self.index,
+            "provider": self.provider_name,
+            "model": self.model,
+            "response": self.response,
+            "error": str(self.error) if self.error is not None else None,
+            "queued": self.queued,
+            "latency": self.latency,
+            "time_to_first_token": self.time_to_first_token,
+            "batched": self.batched
+        }
+
+class _ProviderSlots:
+    """Per-provider concurrency limits for the threads of one batch."""
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+    
+    def get(self, provider_name: str) -> threading.Semaphore:
+        """Get the semaphore bounding a provider's concurrent requests."""
+        with self._lock:
+            semaphore = self._semaphores.get(provider_name)
+            if semaphore is None:
+                semaphore = self._semaphores[provider_name] = threading.Semaphore(self.limit)
+            
+            return semaphore
+
+# Arguments of generate_text handled by the manager rather than passed on to providers
+_MANAGER_OPTIONS = ("stream", "provider_name", "model", "use_cache", "coalesce", "sandbox_id",
+                    "hedge", "hedge_budget_tokens", "prefix_cache_key")
+
+def _usage_fields(prompt_tokens: Optional[int], completion_tokens: Optional[int],
+                  cached_tokens: Optional[int] = None) -> Dict[str, int]:
+    """Build a usage dict from whichever token counts are known."""
+    usage = {}
+    if prompt_tokens is not None:
+        usage["prompt_tokens"] = int(prompt_tokens)
+    if completion_tokens is not None:
+        usage["completion_tokens"] = int(completion_tokens)
+    if cached_tokens:
+        # Prompt tokens served from a provider-side prefix cache, included in prompt_tokens
+        usage["cached_tokens"] = int(cached_tokens)
+    
+    return usage
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Check whether an error is an HTTP 429 or a full client-side rate limit queue."""
+    if isinstance(error, RateLimitExceeded):
+        return True
+    
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+def is_provider_failure(error: Exception) -> bool:
+    """Check whether an error shows the provider is unhealthy: a transport error, a timeout or a 5xx.
+    
+    Rejected requests (4xx), rate limits and client-side errors come from
+    one caller's request, so they must not open the circuit for everyone.
+    """
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError,
+                              ReadTimeoutError, ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+class AIModelManager:
+    """Manager class for handling multiple AI model providers.
+    
+    Pass provider_name="auto" to let the latency router pick the fastest
+    healthy provider for a request.
+    
+    Each provider has a circuit breaker, and a failed or refused request is
+    retried on the providers in its fallback chain (set_fallback_chain), so
+    calls to a dead endpoint fail over immediately instead of timing out.
+    A provider with a fallback waits at most fallback_rate_limit_wait for
+    its rate limit; only the last one in the chain waits rate_limit_max_wait.
+    """
+    
+    AUTO_PROVIDER = "auto"
+    
+    def __init__(self, http_pool: HTTPSessionPool = None, max_concurrency: int = 64,
+                 response_cache: ResponseCache = None, coalesce_requests: bool = True,
+                 router: LatencyRouter = None, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0, rate_limit_max_wait: float = 60.0,
+                 fallback_rate_limit_wait: float = 1.0,
+                 hedge_percentile: float = 95.0, hedge_min_samples: int = 20,
+                 hedge_budget_tokens: int = None, hedge_budget_fraction: float = 0.1,
+                 prefix_cache: PrefixCache = None):
+        self.providers = {}
+        self.default_provider = None
+        self.http_pool = http_pool or HTTPSessionPool()
+        self.response_cache = response_cache
+        self.single_flight = SingleFlight() if coalesce_requests else None
+        self.router = router or LatencyRouter()
+        self._model_catalog = {}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.circuit_breakers = {}
+        self.fallback_chains = {}
+        self.rate_limit_max_wait = rate_limit_max_wait
+        self.fallback_rate_limit_wait = fallback_rate_limit_wait
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget_tokens = hedge_budget_tokens
+        self.hedge_budget_fraction = hedge_budget_fraction
+        # Shared by default so that editing an agent invalidates its prefixes for every manager
+        self.prefix_cache = prefix_cache or get_prefix_cache()
+        self._hedge_stats = {"hedged": 0, "skipped": 0, "primary_won": 0, "backup_won": 0,
+                             "requested_tokens": 0, "hedged_tokens": 0}
+        self._lock = threading.Lock()
+        self.rate_limiters = {}  # rate limit key -> RateLimiter, shared by providers using one API key
+        self.max_concurrency = max_concurrency
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._in_flight = {}
+        self.usage_stats = {
+            "total_tokens": 0,
+            "providers": {}
+        }
+    
+    def register_provider(self, provider: AIModelProvider, is_default: bool = False):
+        """Register a new provider."""
+        self.providers[provider.provider_name] = provider
+        provider.attach_http_pool(self.http_pool)
+        self._model_catalog.pop(provider.provider_name, None)
+        self.circuit_breakers[provider.provider_name] = CircuitBreaker(
+            provider.provider_name,
+            failure_threshold=self.failure_threshold,
+            reset_timeout=self.reset_timeout
+        )
+        
+        rate_limiter = self.rate_limiters.get(provider.rate_limit_key)
+        if rate_limiter is None:
+            rate_limiter = self.rate_limiters[provider.rate_limit_key] = RateLimiter(
+                provider.rate_limit_key,
+                requests_per_minute=provider.requests_per_minute,
+                tokens_per_minute=provider.tokens_per_minute,
+                max_wait=self.rate_limit_max_wait
+            )
+        provider.attach_rate_limiter(rate_limiter)
+        
+        if is_default or self.default_provider is None:
+            self.default_provider = provider.provider_name
+        
+        # Initialize usage stats for this provider
+        self.usage_stats["providers"][provider.provider_name] = {
+            "total_tokens": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "requests": 0
+        }
+    
+    def get_provider(self, provider_name: str = None) -> AIModelProvider:
+        """Get a provider by name, or the default provider if none specified."""
+        if provider_name is None:
+            provider_name = self.default_provider
+        
+        if provider_name not in self.providers:
+            raise ValueError(f"Provider '{provider_name}' not registered")
+        
+        return self.providers[provider_name]
+    
+    def set_default_provider(self, provider_name: str):
+        """Set the default provider."""
+        if provider_name not in self.providers:
+            raise ValueError(f"Provider '{provider_name}' not registered")
+        
+        self.default_provider = provider_name
+    
+    def get_all_providers(self) -> Dict[str, AIModelProvider]:
+        """Get all registered providers."""
+        return self.providers
+    
+    def get_all_models(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Get all available models from all providers."""
+        models = {}
+        for provider_name, provider in self.providers.items():
+            models[provider_name] = provider.get_available_models()
+        
+        return models
+    
+    def get_free_tier_providers(self) -> Dict[str, AIModelProvider]:
+        """Get all providers with free tiers."""
+        return {
+            name: provider 
+            for name, provider in self.providers.items() 
+            if provider.has_free_tier
+        }
+    
+    def _get_model_info(self, provider: AIModelProvider, model: str) -> Optional[Dict[str, Any]]:
+        """Look up a model in the provider's catalog, which is fetched once."""
+        catalog = self._model_catalog.get(provider.provider_name)
+        if catalog is None:
+            try:
+                catalog = {info["id"]: info for info in provider.get_available_models()}
+            except Exception:
+                # Self-hosted providers may be unreachable; treat their models as unknown
+                catalog = {}
+            self._model_catalog[provider.provider_name] = catalog
+        
+        return catalog.get(model)
+    
+    def route(self, prompt: str = "", max_tokens: int = 0, streaming: bool = False,
+              free_tier_only: bool = False, min_context_length: int = None,
+              candidates: List[Tuple[str, str]] = None, sandbox_id: str = None,
+              pin: bool = False) -> Tuple[str, str]:
+        """Pick the fastest healthy (provider_name, model) for a request.
+        
+        By default each provider is represented by its default model. Only
+        models whose context window fits the prompt and max_tokens, and
+        providers with the required capabilities, are considered. A sandbox
+        pinned with pin_sandbox (or routed with pin=True) keeps using the
+        same provider while it stays healthy.
+        """
+        if min_context_length is None:
+            min_context_length = get_token_counter().count(prompt) + max_tokens
+        
+        if candidates is None:
+            candidates = [
+                (provider_name, getattr(provider, "default_model", None))
+                for provider_name, provider in self.providers.items()
+            ]
+        
+        eligible = []
+        for provider_name, model in candidates:
+            provider = self.providers.get(provider_name)
+            if provider is None:
+                continue
+            if streaming and not provider.supports_streaming:
+                continue
+            if free_tier_only and not provider.has_free_tier:
+                continue
+            
+            info = self._get_model_info(provider, model) or {}
+            if info.get("context_length", min_context_length) < min_context_length:
+                continue
+            
+            eligible.append((provider_name, model))
+        
+        # Skip providers whose circuit is open, unless that leaves nothing to choose from
+        available = [
+            candidate for candidate in eligible
+            if self.circuit_breakers[candidate[0]].state != CircuitBreaker.OPEN
+        ]
+        
+        return self.router.choose(available or eligible, streaming=streaming,
+                                  pin_key=sandbox_id, pin=pin)
+    
+    def get_context_window(self, provider_name: str = None, model: str = None) -> Optional[int]:
+        """Get a model's context length in tokens, if its catalog lists it."""
+        provider = self.get_provider(provider_name)
+        info = self._get_model_info(provider, model or getattr(provider, "default_model", None)) or {}
+        
+        return info.get("context_length")
+    
+    def _check_context_window(self, provider: AIModelProvider, model: str, prompt: str,
+                              system_message: str, max_tokens: int) -> Optional[ContextWindowExceeded]:
+        """Get the error to report if a request can't fit the model's window, else None.
+        
+        Oversized requests are rejected here rather than by the provider
+        after a round-trip; a fallback with a larger window may still take them.
+        """
+        context_length = (self._get_model_info(provider, model) or {}).get("context_length")
+        if context_length is None:
+            return None
+        
+        prompt_tokens, system_tokens = get_token_counter().count_batch(
+            [prompt, system_message or ""], provider.provider_name, model
+        )
+        required = prompt_tokens + system_tokens + (max_tokens or 0)
+        if required <= context_length:
+            return None
+        
+        return ContextWindowExceeded(model, required, context_length)
+    
+    def _resolve_provider(self, provider_name: str, model: str, prompt: str, max_tokens: int,
+                          streaming: bool, sandbox_id: str) -> Tuple[AIModelProvider, str]:
+        """Resolve the provider and model for a request, routing "auto" requests."""
+        if provider_name == self.AUTO_PROVIDER:
+            provider_name, routed_model = self.route(
+                prompt=prompt,
+                max_tokens=max_tokens,
+                streaming=streaming,
+                sandbox_id=sandbox_id
+            )
+            model = model or routed_model
+        
+        provider = self.get_provider(provider_name)
+        
+        return provider, model or getattr(provider, "default_model", None)
+    
+    def pin_sandbox(self, sandbox_id: str, provider_name: str, model: str = None):
+        """Route every "auto" request for a sandbox to one provider."""
+        if provider_name not in self.providers:
+            raise ValueError(f"Provider '{provider_name}' not registered")
+        
+        self.router.pin(sandbox_id, provider_name, model)
+    
+    def unpin_sandbox(self, sandbox_id: str):
+        """Let "auto" requests for a sandbox use any provider again."""
+        self.router.unpin(sandbox_id)
+    
+    def set_rate_limit(self, provider_name: str, requests_per_minute: int = None,
+                       tokens_per_minute: int = None):
+        """Replace the request and token budgets of a provider's API key."""
+        provider = self.get_provider(provider_name)
+        rate_limiter = RateLimiter(
+            provider.rate_limit_key,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_wait=self.rate_limit_max_wait
+        )
+        self.rate_limiters[provider.rate_limit_key] = rate_limiter
+        provider.attach_rate_limiter(rate_limiter)
+    
+    def set_fallback_chain(self, provider_name: str, fallbacks: List[str]):
+        """Set the providers to try, in order, when a provider fails."""
+        for name in [provider_name] + list(fallbacks):
+            if name not in self.providers:
+                raise ValueError(f"Provider '{name}' not registered")
+        
+        self.fallback_chains[provider_name] = [name for name in fallbacks if name != provider_name]
+    
+    def _attempt_order(self, provider: AIModelProvider, model: str) -> List[Tuple[AIModelProvider, str]]:
+        """List the provider and its fallbacks, each with the model to request."""
+        attempts = [(provider, model)]
+        for name in self.fallback_chains.get(provider.provider_name, []):
+            fallback = self.providers[name]
+            # Model names are provider specific, so fallbacks use their own default
+            attempts.append((fallback, getattr(fallback, "default_model", None)))
+        
+        return attempts
+    
+    def _rate_limit_wait(self, attempts: List[Tuple[AIModelProvider, str]], index: int) -> Optional[float]:
+        """Get how long an attempt may wait for its rate limit.
+        
+        Only the last provider in the chain waits up to rate_limit_max_wait;
+        earlier ones give up quickly so that the next one is tried instead.
+        """
+        return self.fallback_rate_limit_wait if index < len(attempts) - 1 else None
+    
+    def _record_outcome(self, provider: AIModelProvider, model: str, started: float,
+                        first_token_at: float = None, error: Exception = None,
+                        completed: bool = True):
+        """Feed the latency and outcome of an upstream call to the router."""
+        self.router.record(
+            provider.provider_name,
+            model,
+            latency=time.monotonic() - started if completed and error is None else None,
+            time_to_first_token=first_token_at - started if first_token_at is not None else None,
+            error=error is not None and not is_rate_limit_error(error),
+            rate_limited=error is not None and is_rate_limit_error(error)
+        )
+    
+    def _request_key(self, provider: AIModelProvider, prompt: str, system_message: str,
+                     temperature: float, max_tokens: int, model: str,
+                     params: Dict[str, Any]) -> str:
+        """Build the key identifying a request for caching and coalescing."""
+        return ResponseCache.make_key(
+            provider.provider_name,
+            model or getattr(provider, "default_model", None),
+            system_message,
+            prompt,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **params
+        )
+    
+    def _use_response_cache(self, temperature: float, use_cache: bool) -> bool:
+        """Check whether a request may be served from and stored in the response cache."""
+        return use_cache and self.response_cache is not None and self.response_cache.is_cacheable(temperature)
+    
+    def generate_text(self, prompt: str, system_message: str = None, 
+                     temperature: float = 0.7, max_tokens: int = 1000, 
+                     stream: bool = False, provider_name: str = None, 
+                     model: str = None, use_cache: bool = True, 
+                     coalesce: bool = True, sandbox_id: str = None, 
+                     hedge: bool = False, hedge_budget_tokens: int = None, 
+                     **kwargs) -> str:
+        """Generate text using the specified provider and model.
+        
+        Identical concurrent requests share one upstream call unless
+        coalesce is False. With hedge set, a backup request goes to a second
+        provider if the first is slower than usual (see _generate_hedged).
+        """
+        provider, model = self._resolve_provider(provider_name, model, prompt, max_tokens,
+                                                 False, sandbox_id)
+        request_key = self._request_key(provider, prompt, system_message, temperature,
+                                        max_tokens, model, kwargs)
+        
+        cache_key = request_key if self._use_response_cache(temperature, use_cache) else None
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        if hedge:
+            generate = lambda *args: self._generate_hedged(*args, budget_tokens=hedge_budget_tokens)
+        else:
+            generate = self._generate_with_fallback
+        
+        if coalesce and self.single_flight is not None:
+            response = self.single_flight.do(
+                ("generate", request_key), generate, provider,
+                prompt, system_message, temperature, max_tokens, stream, model, kwargs
+            )
+        else:
+            response = generate(provider, prompt, system_message, temperature,
+                                max_tokens, stream, model, kwargs)
+        
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response)
+        
+        return response
+    
+    @staticmethod
+    def _record_error(breaker: CircuitBreaker, error: Exception):
+        """Count an error against a provider's circuit only if the provider itself failed."""
+        if is_provider_failure(error):
+            breaker.record_failure()
+        else:
+            # A rejected or rate-limited request says nothing about the provider's health
+            breaker.release()
+    
+    def _generate_with_fallback(self, provider: AIModelProvider, prompt: str, system_message: str,
+                                temperature: float, max_tokens: int, stream: bool, model: str,
+                                params: Dict[str, Any]) -> str:
+        """Call the provider, failing over along its fallback chain."""
+        error = None
+        attempts = self._attempt_order(provider, model)
+        for index, (attempt_provider, attempt_model) in enumerate(attempts):
+            too_long = self._check_context_window(attempt_provider, attempt_model, prompt,
+                                                  system_message, max_tokens)
+            if too_long is not None:
+                error = error or too_long
+                continue
+            
+            breaker = self.circuit_breakers[attempt_provider.provider_name]
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                error = error or e
+                continue
+            
+            try:
+                response = self._generate_upstream(attempt_provider, prompt, system_message,
+                                                   temperature, max_tokens, stream,
+                                                   attempt_model, params,
+                                                   self._rate_limit_wait(attempts, index))
+            except Exception as e:
+                self._record_error(breaker, e)
+                error = e
+                continue
+            
+            breaker.record_success()
+            return response
+        
+        raise error
+    
+    def _hedge_delay(self, provider: AIModelProvider, model: str) -> Optional[float]:
+        """Get how long to wait for a first token before sending a backup request."""
+        metrics = self.router.get_model_metrics(provider.provider_name, model)
+        if metrics is None or metrics.samples < self.hedge_min_samples:
+            # Without enough history a slow request can't be told from a normal one
+            return None
+        
+        return (metrics.time_to_first_token_percentile(self.hedge_percentile) or
+                metrics.latency_percentile(self.hedge_percentile))
+    
+    def _generate_hedged(self, provider: AIModelProvider, prompt: str, system_message: str,
+                         temperature: float, max_tokens: int, stream: bool, model: str,
+                         params: Dict[str, Any], budget_tokens: int = None) -> str:
+        """Race a backup request against a slow primary request.
+        
+        The primary request is streamed. If it has not produced a first token
+        within hedge_percentile of its recent times to first token, a backup
+        request is streamed from the fastest other provider. Whichever
+        produces a first token first wins and the other's connection is
+        closed at once, cancelling its completion.
+        
+        A backup asks for the same max_tokens, so the answer is never cut
+        short; the budget decides whether to send one at all. Backups may
+        add at most hedge_budget_fraction to the tokens requested by hedged
+        calls, and none is sent for a request estimated to cost more than
+        budget_tokens (hedge_budget_tokens by default).
+        """
+        delay = self._hedge_delay(provider, model)
+        if delay is None:
+            return self._generate_with_fallback(provider, prompt, system_message, temperature,
+                                                max_tokens, stream, model, params)
+        
+        cost = provider.get_token_usage(prompt, "", model)["prompt_tokens"] + max_tokens
+        if budget_tokens is None:
+            budget_tokens = self.hedge_budget_tokens
+        with self._lock:
+            self._hedge_stats["requested_tokens"] += cost
+        
+        race = _HedgeRace()
+        race.start("primary", self._run_hedge_attempt, race, "primary", provider, prompt,
+                   system_message, temperature, max_tokens, model, params)
+        
+        if race.wait_for_first_token(delay):
+            return race.result()
+        
+        with self._lock:
+            affordable = (budget_tokens is None or cost <= budget_tokens) and (
+                self._hedge_stats["hedged_tokens"] + cost <=
+                self._hedge_stats["requested_tokens"] * self.hedge_budget_fraction
+            )
+        
+        backup = None
+        if affordable:
+            try:
+                backup_name, backup_model = self.route(
+                    prompt=prompt,
+                    max_tokens=max_tokens,
+                    streaming=True,
+                    candidates=[
+                        (name, getattr(other, "default_model", None))
+                        for name, other in self.providers.items()
+                        if name != provider.provider_name
+                    ]
+                )
+                backup = (self.providers[backup_name], backup_model)
+            except ValueError:
+                pass
+        
+        if backup is None:
+            with self._lock:
+                self._hedge_stats["skipped"] += 1
+            return race.result()
+        
+        with self._lock:
+            self._hedge_stats["hedged"] += 1
+            self._hedge_stats["hedged_tokens"] += cost
+        
+        race.start("backup", self._run_hedge_attempt, race, "backup", backup[0], prompt,
+                   system_message, temperature, max_tokens, backup[1], params)
+        
+        try:
+            return race.result()
+        finally:
+            if race.winner is not None:
+                with self._lock:
+                    self._hedge_stats[f"{race.winner}_won"] += 1
+    
+    def _run_hedge_attempt(self, race: "_HedgeRace", name: str, provider: AIModelProvider,
+                           prompt: str, system_message: str, temperature: float,
+                           max_tokens: int, model: str, params: Dict[str, Any]):
+        """Stream one side of a hedged request, stopping if the other side wins."""
+        breaker = self.circuit_breakers[provider.provider_name]
+        chunks = []
+        _hedge_attempt.on_stream = lambda response: race.watch(name, response)
+        _hedge_attempt.lost = lambda: race.lost(name)
+        
+        try:
+            breaker.before_call()
+            # The other side of the race covers for this one, so don't queue long for quota
+            stream = self._stream_upstream(provider, prompt, system_message, temperature,
+                                           max_tokens, model, params, self.fallback_rate_limit_wait)
+            try:
+                for chunk in stream:
+                    if not race.claim_first_token(name):
+                        # Closing the stream drops the connection, cancelling the upstream completion
+                        break
+                    chunks.append(chunk)
+            finally:
+                stream.close()
+        except CircuitOpenError as e:
+            race.finish(name, error=e)
+            return
+        except Exception as e:
+            # A loser whose connection was closed under it did not fail, but gives back its trial call
+            if race.lost(name):
+                breaker.release()
+            else:
+                self._record_error(breaker, e)
+            race.finish(name, error=e)
+            return
+        finally:
+            _hedge_attempt.on_stream = None
+            _hedge_attempt.lost = None
+        
+        if race.lost(name):
+            breaker.release()
+        else:
+            breaker.record_success()
+        race.finish(name, result="".join(chunks))
+    
+    def _generate_upstream(self, provider: AIModelProvider, prompt: str, system_message: str,
+                           temperature: float, max_tokens: int, stream: bool, model: str,
+                           params: Dict[str, Any], rate_limit_wait: float = None) -> str:
+        """Call the provider and record its usage and latency."""
+        params, cache_owner = self._use_prefix_cache(provider, model, system_message, params)
+        started = time.monotonic()
+        reported = {}
+        try:
+            response = provider.generate_text(
+                prompt=prompt,
+                system_message=system_message,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=stream,
+                model=model,
+                usage=reported,
+                rate_limit_wait=rate_limit_wait,
+                **params
+            )
+        except Exception as e:
+            self._record_outcome(provider, model, started, error=e)
+            self._prefix_cache_failed(provider, model, cache_owner, e)
+            raise
+        
+        self._record_outcome(provider, model, started)
+        
+        # Update usage statistics
+        self._account_usage(provider, prompt, response, model, reported)
+        
+        return response
+    
+    def stream_text(self, prompt: str, system_message: str = None, 
+                    temperature: float = 0.7, max_tokens: int = 1000, 
+                    provider_name: str = None, model: str = None, 
+                    coalesce: bool = True, sandbox_id: str = None, 
+                    **kwargs) -> Iterator[str]:
+        """Stream text from the specified provider and model as it is generated.
+        
+        Identical concurrent streams share one upstream stream unless
+        coalesce is False; late joiners replay the chunks already received.
+        """
+        provider, model = self._resolve_provider(provider_name, model, prompt, max_tokens,
+                                                 True, sandbox_id)
+        
+        if coalesce and self.single_flight is not None:
+            request_key = self._request_key(provider, prompt, system_message, temperature,
+                                            max_tokens, model, kwargs)
+            yield from self.single_flight.stream(
+                ("stream", request_key),
+                lambda: self._stream_with_fallback(provider, prompt, system_message, temperature,
+                                                   max_tokens, model, kwargs)
+            )
+        else:
+            yield from self._stream_with_fallback(provider, prompt, system_message, temperature,
+                                                  max_tokens, model, kwargs)
+    
+    def _stream_with_fallback(self, provider: AIModelProvider, prompt: str, system_message: str,
+                              temperature: float, max_tokens: int, model: str,
+                              params: Dict[str, Any]) -> Iterator[str]:
+        """Stream from the provider, failing over until the first chunk arrives.
+        
+        Once part of a reply has been sent, another provider cannot take over,
+        so later errors are raised to the caller.
+        """
+        error = None
+        attempts = self._attempt_order(provider, model)
+        for index, (attempt_provider, attempt_model) in enumerate(attempts):
+            too_long = self._check_context_window(attempt_provider, attempt_model, prompt,
+                                                  system_message, max_tokens)
+            if too_long is not None:
+                error = error or too_long
+                continue
+            
+            breaker = self.circuit_breakers[attempt_provider.provider_name]
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                error = error or e
+                continue
+            
+            started_streaming = False
+            try:
+                for chunk in self._stream_upstream(attempt_provider, prompt, system_message,
+                                                   temperature, max_tokens, attempt_model, params,
+                                                   self._rate_limit_wait(attempts, index)):
+                    started_streaming = True
+                    yield chunk
+            except GeneratorExit:
+                # The consumer stopped reading; the provider itself was working
+                breaker.record_success()
+                raise
+            except Exception as e:
+                self._record_error(breaker, e)
+                if started_streaming:
+                    raise
+                error = e
+                continue
+            
+            breaker.record_success()
+            return
+        
+        raise error
+    
+    def _stream_upstream(self, provider: AIModelProvider, prompt: str, system_message: str,
+                         temperature: float, max_tokens: int, model: str,
+                         params: Dict[str, Any], rate_limit_wait: float = None) -> Iterator[str]:
+        """Stream from the provider and record its usage and latency."""
+        params, cache_owner = self._use_prefix_cache(provider, model, system_message, params)
+        chunks = []
+        reported = {}
+        started = time.monotonic()
+        first_token_at = None
+        
+        try:
+            for chunk in provider.stream_text(
+                prompt=prompt,
+                system_message=system_message,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                model=model,
+                usage=reported,
+                rate_limit_wait=rate_limit_wait,
+                **params
+            ):
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                chunks.append(chunk)
+                yield chunk
+            
+            # A cancelled hedge attempt ends early without it being the provider's doing
+            self._record_outcome(provider, model, started, first_token_at, completed=not _hedge_attempt_lost())
+        except GeneratorExit:
+            # The consumer stopped early, so only the time to first token is meaningful
+            self._record_outcome(provider, model, started, first_token_at, completed=False)
+            raise
+        except Exception as e:
+            if _hedge_attempt_lost():
+                self._record_outcome(provider, model, started, first_token_at, completed=False)
+                raise
+            self._record_outcome(provider, model, started, first_token_at, error=e)
+            self._prefix_cache_failed(provider, model, cache_owner, e)
+            raise
+        finally:
+            # Account for whatever was generated, even if the consumer stopped early
+            if chunks:
+                self._account_usage(provider, prompt, "".join(chunks), model, reported)
+    
+    @asynccontextmanager
+    async def _async_slot(self, provider_name: str):
+        """Hold one of the provider's async concurrency slots."""
+        semaphores = self._async_semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(provider_name)
+        if semaphore is None:
+            semaphore = semaphores[provider_name] = asyncio.Semaphore(self.max_concurrency)
+        
+        async with semaphore:
+            self._in_flight[provider_name] = self._in_flight.get(provider_name, 0) + 1
+            try:
+                yield
+            finally:
+                self._in_flight[provider_name] -= 1
+    
+    async def agenerate_text(self, prompt: str, system_message: str = None, 
+                             temperature: float = 0.7, max_tokens: int = 1000, 
+                             stream: bool = False, provider_name: str = None, 
+                             model: str = None, use_cache: bool = True, 
+                             coalesce: bool = True, sandbox_id: str = None, **kwargs) -> str:
+        """Generate text asynchronously, bounded by the provider's concurrency limit."""
+        provider, model = self._resolve_provider(provider_name, model, prompt, max_tokens,
+                                                 False, sandbox_id)
+        request_key = self._request_key(provider, prompt, system_message, temperature,
+                                        max_tokens, model, kwargs)
+        
+        cache_key = request_key if self._use_response_cache(temperature, use_cache) else None
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        if coalesce and self.single_flight is not None:
+            response = await self.single_flight.ado(
+                ("generate", request_key),
+                lambda: self._agenerate_with_fallback(provider, prompt, system_message, temperature,
+                                                      max_tokens, stream, model, kwargs)
+            )
+        else:
+            response = await self._agenerate_with_fallback(provider, prompt, system_message,
+                                                           temperature, max_tokens, stream,
+                                                           model, kwargs)
+        
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response)
+        
+        return response
+    
+    async def _agenerate_with_fallback(self, provider: AIModelProvider, prompt: str,
+                                       system_message: str, temperature: float, max_tokens: int,
+                                       stream: bool, model: str, params: Dict[str, Any]) -> str:
+        """Call the provider asynchronously, failing over along its fallback chain."""
+        error = None
+        attempts = self._attempt_order(provider, model)
+        for index, (attempt_provider, attempt_model) in enumerate(attempts):
+            too_long = self._check_context_window(attempt_provider, attempt_model, prompt,
+                                                  system_message, max_tokens)
+            if too_long is not None:
+                error = error or too_long
+                continue
+            
+            breaker = self.circuit_breakers[attempt_provider.provider_name]
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                error = error or e
+                continue
+            
+            try:
+                response = await self._agenerate_upstream(attempt_provider, prompt, system_message,
+                                                          temperature, max_tokens, stream,
+                                                          attempt_model, params,
+                                                          self._rate_limit_wait(attempts, index))
+            except Exception as e:
+                self._record_error(breaker, e)
+                error = e
+                continue
+            
+            breaker.record_success()
+            return response
+        
+        raise error
+    
+    async def _agenerate_upstream(self, provider: AIModelProvider, prompt: str, system_message: str,
+                                  temperature: float, max_tokens: int, stream: bool, model: str,
+                                  params: Dict[str, Any], rate_limit_wait: float = None) -> str:
+        """Call the provider asynchronously and record its usage and latency."""
+        params, cache_owner = await self._ause_prefix_cache(provider, model, system_message, params)
+        
+        async with self._async_slot(provider.provider_name):
+            # Time from when a slot is free, so queueing here doesn't count against the provider
+            started = time.monotonic()
+            reported = {}
+            try:
+                response = await provider.agenerate_text(
+                    prompt=prompt,
+                    system_message=system_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=stream,
+                    model=model,
+                    usage=reported,
+                    rate_limit_wait=rate_limit_wait,
+                    **params
+                )
+            except Exception as e:
+                self._record_outcome(provider, model, started, error=e)
+                self._prefix_cache_failed(provider, model, cache_owner, e)
+                raise
+        
+        self._record_outcome(provider, model, started)
+        
+        self._account_usage(provider, prompt, response, model, reported)
+        
+        return response
+    
+    async def astream_text(self, prompt: str, system_message: str = None, 
+                           temperature: float = 0.7, max_tokens: int = 1000, 
+                           provider_name: str = None, model: str = None, 
+                           sandbox_id: str = None, **kwargs) -> AsyncIterator[str]:
+        """Stream text asynchronously, bounded by the provider's concurrency limit.
+        
+        Like stream_text, this fails over along the fallback chain until the
+        first chunk arrives.
+        """
+        provider, model = self._resolve_provider(provider_name, model, prompt, max_tokens,
+                                                 True, sandbox_id)
+        
+        error = None
+        attempts = self._attempt_order(provider, model)
+        for index, (attempt_provider, attempt_model) in enumerate(attempts):
+            too_long = self._check_context_window(attempt_provider, attempt_model, prompt,
+                                                  system_message, max_tokens)
+            if too_long is not None:
+                error = error or too_long
+                continue
+            
+            breaker = self.circuit_breakers[attempt_provider.provider_name]
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                error = error or e
+                continue
+            
+            started_streaming = False
+            try:
+                async for chunk in self._astream_upstream(attempt_provider, prompt, system_message,
+                                                          temperature, max_tokens, attempt_model,
+                                                          kwargs, self._rate_limit_wait(attempts, index)):
+                    started_streaming = True
+                    yield chunk
+            except GeneratorExit:
+                breaker.record_success()
+                raise
+            except Exception as e:
+                self._record_error(breaker, e)
+                if started_streaming:
+                    raise
+                error = e
+                continue
+            
+            breaker.record_success()
+            return
+        
+        raise error
+    
+    async def _astream_upstream(self, provider: AIModelProvider, prompt: str, system_message: str,
+                                temperature: float, max_tokens: int, model: str,
+                                params: Dict[str, Any],
+                                rate_limit_wait: float = None) -> AsyncIterator[str]:
+        """Stream from the provider asynchronously and record its usage and latency."""
+        params, cache_owner = await self._ause_prefix_cache(provider, model, system_message, params)
+        chunks = []
+        reported = {}
+        
+        async with self._async_slot(provider.provider_name):
+            started = time.monotonic()
+            first_token_at = None
+            try:
+                async for chunk in provider.astream_text(
+                    prompt=prompt,
+                    system_message=system_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    model=model,
+                    usage=reported,
+                    rate_limit_wait=rate_limit_wait,
+                    **params
+                ):
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    chunks.append(chunk)
+                    yield chunk
+                
+                self._record_outcome(provider, model, started, first_token_at)
+            except GeneratorExit:
+                self._record_outcome(provider, model, started, first_token_at, completed=False)
+                raise
+            except Exception as e:
+                self._record_outcome(provider, model, started, first_token_at, error=e)
+                self._prefix_cache_failed(provider, model, cache_owner, e)
+                raise
+            finally:
+                if chunks:
+                    self._account_usage(provider, prompt, "".join(chunks), model, reported)
+    
+    def get_concurrency_stats(self) -> Dict[str, Dict[str, int]]:
+        """Get in-flight async requests per provider against the concurrency limit."""
+        return {
+            provider_name: {
+                "in_flight": self._in_flight.get(provider_name, 0),
+                "limit": self.max_concurrency
+            }
+            for provider_name in self.providers
+        }
+    
+    def _use_prefix_cache(self, provider: AIModelProvider, model: str, system_message: str,
+                          params: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+        """Replace a prefix_cache_key parameter with the provider's handle for the system message.
+        
+        Callers pass prefix_cache_key to mark the system message as a stable
+        prefix owned by, for example, an agent (see prompt_cache). Returns
+        the parameters to send and the owner whose cached prefix is used.
+        """
+        owner = params.get("prefix_cache_key")
+        if owner is None:
+            return params, None
+        
+        params = {key: value for key, value in params.items() if key != "prefix_cache_key"}
+        handle = self.prefix_cache.get(provider, model, owner, system_message)
+        if handle is None:
+            return params, None
+        
+        params["prefix_cache"] = handle
+        return params, owner
+    
+    async def _ause_prefix_cache(self, provider: AIModelProvider, model: str, system_message: str,
+                                 params: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+        """Like _use_prefix_cache, creating or renewing the cache off the event loop."""
+        if params.get("prefix_cache_key") is None:
+            return params, None
+        
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._use_prefix_cache, provider, model, system_message, params
+        )
+    
+    def _prefix_cache_failed(self, provider: AIModelProvider, model: str, owner: Optional[str],
+                             error: Exception):
+        """Drop a cached prefix the provider rejected, e.g. because another worker deleted it."""
+        status = getattr(getattr(error, "response", None), "status_code", None)
+        if owner is not None and status in (400, 403, 404):
+            self.prefix_cache.discard(provider, model, owner)
+    
+    def _account_usage(self, provider: AIModelProvider, prompt: str, response: str,
+                       model: str, reported: Dict[str, int]):
+        """Record the provider's reported usage, or count the tokens if it reported none."""
+        if "total_tokens" in reported:
+            usage = reported
+        else:
+            usage = provider.get_token_usage(prompt, response, model)
+        self._update_usage_stats(provider.provider_name, usage)
+    
+    def _update_usage_stats(self, provider_name: str, usage: Dict[str, int]):
+        """Update usage statistics."""
+        provider_stats = self.usage_stats["providers"][provider_name]
+        
+        provider_stats["total_tokens"] += usage["total_tokens"]
+        provider_stats["prompt_tokens"] += usage["prompt_tokens"]
+        provider_stats["completion_tokens"] += usage["completion_tokens"]
+        provider_stats["cached_tokens"] += usage.get("cached_tokens", 0)
+        provider_stats["requests"] += 1
+        
+        self.usage_stats["total_tokens"] += usage["total_tokens"]
+    
+    def get_usage_stats(self) -> Dict[str, Any]:
+        """Get current usage statistics."""
+        return self.usage_stats
+    
+    def reset_usage_stats(self):
+        """Reset usage statistics."""
+        for provider_name in self.usage_stats["providers"]:
+            self.usage_stats["providers"][provider_name] = {
+                "total_tokens": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "requests": 0
+            }
+        
+        self.usage_stats["total_tokens"] = 0
+    
+    @classmethod
+    def from_environment(cls, http_pool: HTTPSessionPool = None) -> "AIModelManager":
+        """Create a manager with every provider whose API key is configured."""
+        manager = cls(
+            http_pool=http_pool,
+            response_cache=ResponseCache.from_environment(),
+            failure_threshold=int(os.environ.get("AI_CIRCUIT_FAILURE_THRESHOLD", 5)),
+            reset_timeout=float(os.environ.get("AI_CIRCUIT_RESET_TIMEOUT", 30)),
+            rate_limit_max_wait=float(os.environ.get("AI_RATE_LIMIT_MAX_WAIT", 60)),
+            fallback_rate_limit_wait=float(os.environ.get("AI_FALLBACK_RATE_LIMIT_WAIT", 1))
+        )
+        
+        provider_classes = [
+            ("GEMINI_API_KEY", GeminiProvider),
+            ("DEEPSEEK_API_KEY", DeepSeekProvider),
+            ("HUGGINGFACE_API_KEY", HuggingFaceProvider),
+            ("OPENROUTER_API_KEY", OpenRouterProvider),
+            ("ANTHROPIC_API_KEY", AnthropicProvider),
+            ("MISTRAL_API_KEY", MistralAIProvider),
+            ("PERPLEXITY_API_KEY", PerplexityProvider),
+            ("GROK_API_KEY", GrokProvider)
+        ]
+        
+        for env_var, provider_class in provider_classes:
+            if os.environ.get(env_var):
+                provider = provider_class(os.environ.get(env_var))
+                manager.register_provider(provider)
+                
+                # e.g. GEMINI_RPM and GEMINI_TPM override the default quota
+                prefix = env_var[:-len("_API_KEY")]
+                if os.environ.get(f"{prefix}_RPM") or os.environ.get(f"{prefix}_TPM"):
+                    manager.set_rate_limit(
+                        provider.provider_name,
+                        requests_per_minute=int(os.environ.get(f"{prefix}_RPM") or 0) or None,
+                        tokens_per_minute=int(os.environ.get(f"{prefix}_TPM") or 0) or None
+                    )
+        
+        if os.environ.get("OLLAMA_URL"):
+            manager.register_provider(OllamaProvider(os.environ.get("OLLAMA_URL")))
+        
+        # Each provider in the chain falls back to the ones after it
+        chain = [
+            name.strip()
+            for name in os.environ.get("AI_FALLBACK_CHAIN", "Gemini,DeepSeek,Ollama").split(",")
+            if name.strip() in manager.providers
+        ]
+        for index, provider_name in enumerate(chain):
+            manager.set_fallback_chain(provider_name, chain[index + 1:])
+        
+        return manager
+    
+    def get_hedging_stats(self) -> Dict[str, int]:
+        """Get how often hedged requests sent a backup, which side won and the tokens backups cost."""
+        with self._lock:
+            return dict(self._hedge_stats)
+    
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get queue depth, wait times and 429 counts for each provider."""
+        return {
+            name: provider.rate_limiter.get_stats()
+            for name, provider in self.providers.items()
+            if provider.rate_limiter is not None
+        }
+    
+    def get_circuit_breaker_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the circuit state and call counters for each provider."""
+        return {name: breaker.get_stats() for name, breaker in self.circuit_breakers.items()}
+    
+    def get_routing_metrics(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Get the live latency, error and 429 metrics used for routing."""
+        return self.router.get_metrics()
+    
+    def get_routing_decisions(self, limit: int = None) -> List[Dict[str, Any]]:
+        """Get recent routing decisions and the scores behind them."""
+        return self.router.get_decisions(limit)
+    
+    def get_prefix_cache_stats(self) -> Dict[str, Any]:
+        """Get counters of the provider-side prompt prefix caches."""
+        return self.prefix_cache.get_stats()
+    
+    def get_coalescing_stats(self) -> Optional[Dict[str, int]]:
+        """Get how many requests went upstream and how many were coalesced."""
+        return self.single_flight.get_stats() if self.single_flight else None
+    
+    def get_response_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Get response cache counters, or None if caching is disabled."""
+        return self.response_cache.get_stats() if self.response_cache else None
+    
+    def get_http_pool_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get connection reuse and occupancy statistics for each provider's pool."""
+        return self.http_pool.get_stats()
+    
+    def close(self):
+        """Release pooled connections held for the registered providers."""
+        self.http_pool.close()
+    
+    async def aclose(self):
+        """Release async connections opened on the running event loop."""
+        await self.http_pool.aclose()
+    
+    @staticmethod
+    def _batch_requests(batch: List[Union[str, Dict[str, Any]]],
+                        defaults: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Turn batch requests into generate_text arguments, applying the defaults."""
+        return [{**defaults, **({"prompt": request} if isinstance(request, str) else request)}
+                for request in batch]
+    
+    def _batch_key(self, provider: AIModelProvider, request: Dict[str, Any]) -> Optional[Tuple]:
+        """Key of the requests that can share a native batch request with this one, if any."""
+        if provider.max_batch_size <= 1 or request.get("stream") or request.get("hedge"):
+            return None
+        
+        params = {key: value for key, value in request.items()
+                  if key not in _MANAGER_OPTIONS and key != "prompt"}
+        
+        return provider.provider_name, request["model"], json.dumps(params, sort_keys=True, default=str)
+    
+    def generate_many(self, batch: List[Union[str, Dict[str, Any]]], concurrency: int = None,
+                      use_batch_endpoints: bool = True, **defaults) -> List[BatchResult]:
+        """Generate text for many requests concurrently.
+        
+        Each request is a prompt or a dict of generate_text arguments, and
+        defaults apply to all of them. At most concurrency requests
+        (max_concurrency by default) run at once per provider. Results come
+        back in input order, with a failed request's error in its result
+        rather than raised. Requests to a provider with a native batch
+        endpoint that share their settings are sent together.
+        """
+        batch = self._batch_requests(batch, defaults)
+        results = []
+        single = []
+        batches = {}
+        
+        for index, request in enumerate(batch):
+            result = BatchResult(index)
+            results.append(result)
+            try:
+                provider, model = self._resolve_provider(request.get("provider_name"), request.get("model"),
+                                                         request["prompt"], request.get("max_tokens", 1000),
+                                                         False, request.get("sandbox_id"))
+            except Exception as e:
+                result.error = e
+                continue
+            
+            result.provider_name, result.model = provider.provider_name, model
+            request.update(provider_name=provider.provider_name, model=model)
+            
+            key = self._batch_key(provider, request) if use_batch_endpoints else None
+            if key is None:
+                single.append((provider.provider_name, [index]))
+            else:
+                batches.setdefault(key, []).append(index)
+        
+        units = single
+        for key, indexes in batches.items():
+            size = self.providers[key[0]].max_batch_size
+            units.extend((key[0], indexes[start:start + size]) for start in range(0, len(indexes), size))
+        
+        if not units:
+            return results
+        
+        slots = _ProviderSlots(concurrency or self.max_concurrency)
+        submitted = time.monotonic()
+        
+        def run(provider_name: str, indexes: List[int]):
+            with slots.get(provider_name):
+                for index in indexes:
+                    results[index].queued = time.monotonic() - submitted
+                
+                if len(indexes) == 1:
+                    self._generate_one(batch[indexes[0]], results[indexes[0]])
+                else:
+                    self._generate_native_batch(self.providers[provider_name],
+                                                [batch[index] for index in indexes],
+                                                [results[index] for index in indexes])
+        
+        # Enough threads for every provider to use all of its slots at once
+        max_workers = min(len(units), slots.limit * len({provider_name for provider_name, _ in units}))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generate-many") as executor:
+            for future in [executor.submit(run, *unit) for unit in units]:
+                future.result()
+        
+        return results
+    
+    def _generate_one(self, request: Dict[str, Any], result: BatchResult):
+        """Serve one batch request through generate_text, recording its outcome."""
+        started = time.monotonic()
+        try:
+            result.response = self.generate_text(**request)
+        except Exception as e:
+            result.error = e
+        result.latency = time.monotonic() - started
+    
+    def _generate_native_batch(self, provider: AIModelProvider, batch: List[Dict[str, Any]],
+                               results: List[BatchResult]):
+        """Serve requests with one native batch request, or one by one if it fails."""
+        first = batch[0]
+        system_message = first.get("system_message")
+        temperature = first.get("temperature", 0.7)
+        max_tokens = first.get("max_tokens", 1000)
+        model = first["model"]
+        params = {key: value for key, value in first.items() if key not in _MANAGER_OPTIONS and
+                  key not in ("prompt", "system_message", "temperature", "max_tokens")}
+        
+        started = time.monotonic()
+        pending = []
+        for request, result in zip(batch, results):
+            cache_key = None
+            if self._use_response_cache(temperature, request.get("use_cache", True)):
+                cache_key = self._request_key(provider, request["prompt"], system_message, temperature,
+                                              max_tokens, model, params)
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    result.response = cached
+                    result.latency = time.monotonic() - started
+                    continue
+            pending.append((request, result, cache_key))
+        
+        if not pending:
+            return
+        
+        breaker = self.circuit_breakers[provider.provider_name]
+        try:
+            breaker.before_call()
+            try:
+                texts = provider.generate_batch([request["prompt"] for request, _, _ in pending],
+                                                system_message, temperature, max_tokens, model=model, **params)
+            except Exception as e:
+                self._record_error(breaker, e)
+                raise
+        except Exception:
+            # Retrying individually gives each request its fallback chain and its own error
+            for request, result, _ in pending:
+                self._generate_one(request, result)
+            return
+        
+        breaker.record_success()
+        # A batch takes longer than any one request, so it is not fed to the latency router
+        latency = time.monotonic() - started
+        
+        for (request, result, cache_key), text in zip(pending, texts):
+            result.response = text
+            result.latency = latency
+            result.batched = True
+            self._account_usage(provider, request["prompt"], text, model, {})
+            if cache_key is not None:
+                self.response_cache.set(cache_key, text)
+    
+    def stream_many(self, batch: List[Union[str, Dict[str, Any]]], concurrency: int = None,
+                    **defaults) -> Iterator[Tuple[int, Union[str, BatchResult]]]:
+        """Stream many requests concurrently, interleaving their chunks.
+        
+        Requests and defaults are given as for generate_many, with
+        stream_text arguments. Yields (index, chunk) as chunks arrive from
+        any request, and (index, BatchResult) once a request has finished,
+        holding its full text or error and its timings. Closing the iterator
+        stops the streams that are still running.
+        """
+        batch = self._batch_requests(batch, defaults)
+        if not batch:
+            return
+        
+        slots = _ProviderSlots(concurrency or self.max_concurrency)
+        events = queue.Queue()
+        cancelled = threading.Event()
+        submitted = time.monotonic()
+        
+        def run(index: int, request: Dict[str, Any]):
+            result = BatchResult(index)
+            chunks = []
+            try:
+                provider, model = self._resolve_provider(request.pop("provider_name", None),
+                                                         request.pop("model", None), request["prompt"],
+                                                         request.get("max_tokens", 1000), True,
+                                                         request.get("sandbox_id"))
+                result.provider_name, result.model = provider.provider_name, model
+                
+                with slots.get(provider.provider_name):
+                    if cancelled.is_set():
+                        return
+                    
+                    started = time.monotonic()
+                    result.queued = started - submitted
+                    stream = self.stream_text(provider_name=provider.provider_name, model=model, **request)
+                    try:
+                        for chunk in stream:
+                            if result.time_to_first_token is None:
+                                result.time_to_first_token = time.monotonic() - started
+                            chunks.append(chunk)
+                            events.put((index, chunk))
+                            if cancelled.is_set():
+                                return
+                    finally:
+                        stream.close()
+                    
+                    result.latency = time.monotonic() - started
+                result.response = "".join(chunks)
+            except Exception as e:
+                result.error = e
+            
+            events.put((index, result))
+        
+        # stream_text has no cache or hedging, so drop those options
+        for request in batch:
+            for option in ("stream", "use_cache", "hedge", "hedge_budget_tokens"):
+                request.pop(option, None)
+        
+        max_workers = min(len(batch), slots.limit * max(len(self.providers), 1))
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stream-many")
+        try:
+            for index, request in enumerate(batch):
+                executor.submit(run, index, request)
+            
+            remaining = len(batch)
+            while remaining:
+                index, event = events.get()
+                if isinstance(event, BatchResult):
+                    remaining -= 1
+                yield index, event
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False)
+    
+    def find_best_free_provider(self, prompt: str = "", max_tokens: int = 0,
+                                streaming: bool = False, sandbox_id: str = None) -> Optional[str]:
+        """Find the fastest healthy free provider that can serve the request."""
+        try:
+            provider_name, _ = self.route(
+                prompt=prompt,
+                max_tokens=max_tokens,
+                streaming=streaming,
+                free_tier_only=True,
+                sandbox_id=sandbox_id
+            )
+        except ValueError:
+            return None
+        
+        return provider_name
+
+# Example usage
+if __name__ == "__main__":
+    # Initialize manager
+    manager = AIModelManager()
+    
+    # Register providers (with mock API keys for example)
+    try:
+        manager.register_provider(GeminiProvider("MOCK_API_KEY"), is_default=True)
+        manager.register_provider(DeepSeekProvider("MOCK_API_KEY"))
+        manager.register_provider(HuggingFaceProvider("MOCK_API_KEY"))
+        manager.register_provider(OpenRouterProvider("MOCK_API_KEY"))
+        manager.register_provider(AnthropicProvider("MOCK_API_KEY"))
+        manager.register_provider(MistralAIProvider("MOCK_API_KEY"))
+        manager.register_provider(PerplexityProvider("MOCK_API_KEY"))
+        manager.register_provider(GrokProvider("MOCK_API_KEY"))
+        
+        # Only register Ollama if it's available
+        try:
+            ollama = OllamaProvider()
+            # Test connection
+            ollama.get_available_models()
+            manager.register_provider(ollama)
+        except:
+            print("Ollama not available, skipping")
+        
+        # Print available models
+        models = manager.get_all_models()
+        for provider, provider_models in models.items():
+            print(f"\n{provider} Models:")
+            for model in provider_models:
+                print(f"  - {model['name']}: {model['description']}")
+        
+        # Print free tier providers
+        free_providers = manager.get_free_tier_providers()
+        print("\nFree Tier Providers:")
+        for provider in free_providers:
+            print(f"  - {provider}")
+    
+    except ValueError as e:
+        print(f"Error: {e}")
+        print("This is expected in the example as we're using mock API keys.")
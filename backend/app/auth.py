@@ -36,6 +36,8 @@ def login():
     
     # TODO: Implement user authentication with database
     # For now, return a mock response with a token
+    # Sockets opened after logging in read the user from the session
+    session['user_id'] = 1
     return jsonify({
         "id": 1,
         "username": "user1",
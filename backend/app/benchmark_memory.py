@@ -0,0 +1,104 @@
+"""Compare conversation memory strategies over a long conversation.
+
+Each strategy sees the same simulated conversation. After every turn
+the history sent with the next prompt is measured: its tokens, summed
+over the conversation as a proxy for cost, the time save_context spends
+pruning, and the memory the kept history holds.
+
+    python -m app.services.benchmark_memory --turns 500
+"""
+import time
+import random
+import argparse
+import statistics
+
+from app.services.caching import approximate_size
+from app.services.tokenization import get_token_counter
+from app.services.conversation_memory import SUMMARY_PREFIX, create_memory_strategy, message_text
+
+class _Message:
+    """A chat message with the fields memory strategies read."""
+    
+    def __init__(self, type: str, content: str):
+        self.type = type
+        self.content = content
+
+def _conversation(turns: int, seed: int = 0):
+    """Build a reproducible conversation of human and AI messages."""
+    rng = random.Random(seed)
+    words = ["agent", "plan", "deploy", "budget", "review", "latency", "schema", "token", "cache", "market"]
+    for turn in range(turns):
+        question = " ".join(rng.choice(words) for _ in range(rng.randint(8, 40)))
+        answer = " ".join(rng.choice(words) for _ in range(rng.randint(40, 200)))
+        yield _Message("human", f"Turn {turn}: {question}?")
+        yield _Message("ai", answer)
+
+def _summarize(delay: float):
+    """Stand-in summarizer that takes delay seconds, like a model call would."""
+    def summarize(summary, lines):
+        time.sleep(delay)
+        return f"{len(lines)} more messages about {lines[-1][:60]}"
+    return summarize
+
+def run(name: str, turns: int, summary_delay: float, **options):
+    """Run one strategy over the conversation and return its measurements."""
+    if name == "summary":
+        options["summarize"] = _summarize(summary_delay)
+    strategy = create_memory_strategy(name, **options)
+    
+    counter = get_token_counter()
+    messages = []
+    prompt_tokens = 0
+    latencies = []
+    for message in _conversation(turns):
+        messages.append(message)
+        if message.type != "ai":
+            continue
+        
+        started = time.perf_counter()
+        messages = strategy.prune(messages)
+        latencies.append(time.perf_counter() - started)
+        
+        history = [message_text(kept) for kept in messages]
+        if strategy.summary:
+            history.insert(0, f"{SUMMARY_PREFIX}{strategy.summary}")
+        prompt_tokens += counter.count("\n".join(history))
+    
+    if hasattr(strategy, "wait"):
+        strategy.wait()
+    
+    latencies.sort()
+    return {
+        "strategy": name,
+        "kept_messages": len(messages),
+        "final_history_tokens": counter.count("\n".join(message_text(kept) for kept in messages)),
+        "total_prompt_tokens": prompt_tokens,
+        "mean_prune_ms": statistics.mean(latencies) * 1000,
+        "p99_prune_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "history_bytes": approximate_size([message.content for message in messages])
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--max-tokens", type=int, default=4000)
+    parser.add_argument("--summary-delay", type=float, default=0.2,
+                        help="seconds each simulated summary call takes")
+    args = parser.parse_args()
+    
+    results = [
+        run("buffer", args.turns, args.summary_delay),
+        run("last_k", args.turns, args.summary_delay, k=args.k),
+        run("token_window", args.turns, args.summary_delay, max_tokens=args.max_tokens),
+        run("summary", args.turns, args.summary_delay, max_tokens=args.max_tokens)
+    ]
+    
+    columns = list(results[0])
+    print("  ".join(f"{column:>20}" for column in columns))
+    for result in results:
+        print("  ".join(f"{value:>20.2f}" if isinstance(value, float) else f"{value:>20}"
+                        for value in result.values()))
+
+if __name__ == "__main__":
+    main()
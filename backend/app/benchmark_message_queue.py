@@ -0,0 +1,136 @@
+"""Compare per-message commits with write-behind message persistence.
+
+Several threads, like request handlers, each save a stream of messages
+to a messages table in a SQLite file. "sync" commits every message on
+the calling thread, as SandboxManager does by default; "write_behind"
+queues them and returns at once; "durable" queues them and waits until
+the batch holding them is committed. Reported are throughput and the
+time each save holds up its caller.
+    
+    python -m app.services.benchmark_message_queue --threads 8 --messages 250
+"""
+import os
+import time
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import threading
+import statistics
+
+from app.services.message_queue import WriteBehindQueue
+
+SCHEMA = """
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sandbox_id INTEGER NOT NULL,
+    sender_type VARCHAR(20) NOT NULL,
+    sender_id INTEGER,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP
+);
+CREATE INDEX idx_messages_sandbox_id_created_at ON messages(sandbox_id, created_at, id);
+"""
+
+INSERT = "INSERT INTO messages (sandbox_id, sender_type, sender_id, content, created_at) VALUES "
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+    connection.execute("PRAGMA synchronous=FULL")
+    return connection
+
+def _row(thread: int, index: int):
+    return (thread, "user" if index % 2 == 0 else "agent", thread,
+            f"Message {index} from sandbox {thread}. " * 8, datetime.datetime.utcnow().isoformat())
+
+def _write_batch(connection: sqlite3.Connection):
+    """Insert a batch of rows with one multi-row INSERT and commit."""
+    def write(rows):
+        for start in range(0, len(rows), 150):  # SQLite allows 999 parameters per statement
+            chunk = rows[start:start + 150]
+            connection.execute(INSERT + ", ".join(["(?, ?, ?, ?, ?)"] * len(chunk)),
+                               [value for row in chunk for value in row])
+        connection.commit()
+    return write
+
+def run(mode: str, threads: int, messages: int, max_delay: float):
+    """Save messages from every thread in one mode and return its measurements."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "messages.db")
+    setup = _connect(path)
+    setup.executescript(SCHEMA)
+    setup.close()
+    
+    queue = None
+    if mode != "sync":
+        # Durable callers are waiting, so their batches are written without lingering
+        queue = WriteBehindQueue(_write_batch(_connect(path)), max_delay=max_delay if mode == "write_behind" else 0)
+    
+    latencies = []
+    latencies_lock = threading.Lock()
+    
+    def sender(thread: int):
+        connection = _connect(path) if queue is None else None
+        own = []
+        for index in range(messages):
+            started = time.perf_counter()
+            if queue is None:
+                connection.execute(INSERT + "(?, ?, ?, ?, ?)", _row(thread, index))
+                connection.commit()
+            else:
+                written = queue.put(_row(thread, index))
+                if mode == "durable":
+                    written.result()
+            own.append(time.perf_counter() - started)
+        with latencies_lock:
+            latencies.extend(own)
+    
+    started = time.perf_counter()
+    workers = [threading.Thread(target=sender, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if queue is not None:
+        queue.close()
+    elapsed = time.perf_counter() - started
+    
+    check = _connect(path)
+    count, = check.execute("SELECT COUNT(*) FROM messages").fetchone()
+    # Every sandbox's messages must be stored in the order they were sent
+    ordered = all(
+        [int(content.split()[1].rstrip(".")) for content, in check.execute(
+            "SELECT content FROM messages WHERE sandbox_id = ? ORDER BY id", (thread,))] == list(range(messages))
+        for thread in range(threads)
+    )
+    check.close()
+    
+    latencies.sort()
+    return {
+        "mode": mode,
+        "messages": count,
+        "ordered": ordered,
+        "messages_per_s": count / elapsed,
+        "mean_save_ms": statistics.mean(latencies) * 1000,
+        "p99_save_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "batches": queue.get_stats()["batches"] if queue is not None else count
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=250, help="messages saved by each thread")
+    parser.add_argument("--max-delay", type=float, default=0.01,
+                        help="seconds the write_behind writer waits for a batch to fill")
+    args = parser.parse_args()
+    
+    results = [run(mode, args.threads, args.messages, args.max_delay) for mode in ("sync", "write_behind", "durable")]
+    
+    columns = list(results[0])
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print("  ".join(f"{value:>16.2f}" if isinstance(value, float) else f"{str(value):>16}"
+                        for value in result.values()))
+
+if __name__ == "__main__":
+    main()
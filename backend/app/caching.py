@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+def approximate_size(obj: Any, _seen: set = None) -> int:
+    """Approximate the memory held by an object and everything it references."""
+    if _seen is None:
+        _seen = set()
+    
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    
+    size = sys.getsizeof(obj, 0)
+    
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+    
+    if isinstance(obj, dict):
+        size += sum(approximate_size(k, _seen) + approximate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, _seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += approximate_size(vars(obj), _seen)
+    
+    return size
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count and approximate size.
+    
+    Entries expire ``ttl`` seconds after they are written, or after they were
+    last read when ``refresh_on_access`` is set (an idle timeout).
+    """
+    
+    def __init__(self, max_entries: int = 1024, max_bytes: int = None, ttl: float = None,
+                 sizeof: Callable[[Any], int] = approximate_size,
+                 refresh_on_access: bool = False,
+                 on_evict: Callable[[Any, Any], None] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.refresh_on_access = refresh_on_access
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+    
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Get a value, marking it most recently used."""
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return default
+            
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                evicted.append(self._remove(key))
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                value = default
+            else:
+                self._entries.move_to_end(key)
+                if self.refresh_on_access and self.ttl is not None:
+                    self._entries[key] = (value, size, time.monotonic() + self.ttl)
+                self._stats["hits"] += 1
+        
+        self._notify_evicted(evicted)
+        return value
+    
+    def set(self, key: Any, value: Any):
+        """Store a value, evicting least recently used entries to fit."""
+        size = self.sizeof(value) if self.sizeof else 0
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        
+        with self._lock:
+            # Replacing a value is not an eviction, so on_evict is not called
+            if key in self._entries:
+                self._remove(key)
+            
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            evicted = self._evict_to_fit()
+        
+        self._notify_evicted(evicted)
+    
+    def update_size(self, key: Any) -> bool:
+        """Re-measure a value that grew or shrank in place, evicting entries to fit.
+        
+        Returns whether the key was present. Unlike get, this does not count
+        as a lookup or change the entry's recency or expiry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            
+            value, size, expires_at = entry
+            new_size = self.sizeof(value) if self.sizeof else 0
+            self._entries[key] = (value, new_size, expires_at)
+            self._bytes += new_size - size
+            evicted = self._evict_to_fit()
+        
+        self._notify_evicted(evicted)
+        return True
+    
+    def delete(self, key: Any) -> bool:
+        """Remove a key, returning whether it was present."""
+        with self._lock:
+            if key not in self._entries:
+                return False
+            evicted = [self._remove(key)]
+        
+        self._notify_evicted(evicted)
+        return True
+    
+    def purge_expired(self) -> int:
+        """Drop every expired entry, returning how many were removed."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, _, expires_at) in self._entries.items()
+                       if expires_at is not None and expires_at <= now]
+            evicted = [self._remove(key) for key in expired]
+            self._stats["expirations"] += len(evicted)
+        
+        self._notify_evicted(evicted)
+        return len(evicted)
+    
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            evicted = [self._remove(key) for key in list(self._entries)]
+        
+        self._notify_evicted(evicted)
+    
+    def keys(self):
+        """Get a snapshot of the cached keys, least recently used first."""
+        with self._lock:
+            return list(self._entries)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hit, miss and eviction counters plus current size."""
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "avg_entry_bytes": self._bytes // len(self._entries) if self._entries else 0,
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0
+            }
+    
+    def _evict_to_fit(self):
+        """Evict least recently used entries while over a bound, holding the lock."""
+        evicted = []
+        while self._entries and (
+            len(self._entries) > self.max_entries or
+            (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._entries))
+            evicted.append(self._remove(oldest))
+            self._stats["evictions"] += 1
+        
+        return evicted
+    
+    def _remove(self, key: Any):
+        """Remove an entry while holding the lock and return it for on_evict."""
+        value, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        return key, value
+    
+    def _notify_evicted(self, evicted):
+        """Run the eviction callback outside the lock."""
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+    
+    def __contains__(self, key: Any) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+class DiskCache:
+    """SQLite-backed cache tier shared by every worker on the host."""
+    
+    def __init__(self, path: str, ttl: float = None):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+    
+    def get(self, key: str) -> Optional[str]:
+        """Get a value if it exists and has not expired."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            
+            if row is None:
+                return None
+            
+            value, expires_at = row
+            if expires_at is not None and expires_at <= time.time():
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            
+            return value
+    
+    def set(self, key: str, value: str):
+        """Store a value, replacing any previous one."""
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+    
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+    
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+class ResponseCache:
+    """Opt-in cache of model completions for AIModelManager.
+    
+    Only requests at or below ``max_temperature`` are cached, since sampling
+    at higher temperatures is expected to produce a different answer each time.
+    """
+    
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 3600, max_temperature: float = 0.3, disk_path: str = None):
+        self.max_temperature = max_temperature
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+                               sizeof=lambda value: sys.getsizeof(value))
+        self.disk = DiskCache(disk_path, ttl=ttl) if disk_path else None
+        self._disk_hits = 0
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_environment(cls) -> Optional["ResponseCache"]:
+        """Create a cache from AI_RESPONSE_CACHE* settings, or None if disabled."""
+        if os.environ.get("AI_RESPONSE_CACHE", "").lower() not in ("1", "true", "yes"):
+            return None
+        
+        return cls(
+            max_entries=int(os.environ.get("AI_RESPONSE_CACHE_MAX_ENTRIES", 1024)),
+            ttl=float(os.environ.get("AI_RESPONSE_CACHE_TTL", 3600)),
+            max_temperature=float(os.environ.get("AI_RESPONSE_CACHE_MAX_TEMPERATURE", 0.3)),
+            disk_path=os.environ.get("AI_RESPONSE_CACHE_PATH") or None
+        )
+    
+    def is_cacheable(self, temperature: float) -> bool:
+        """Check whether a request at this temperature may be cached."""
+        return temperature is not None and temperature <= self.max_temperature
+    
+    @staticmethod
+    def make_key(provider_name: str, model: Optional[str], system_message: Optional[str],
+                 prompt: str, **params) -> str:
+        """Build a stable key from the request and its sampling parameters."""
+        key_data = {
+            "provider": provider_name,
+            "model": model,
+            "system_message": system_message,
+            "prompt": prompt,
+            "params": params
+        }
+        encoded = json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")
+        
+        return hashlib.sha256(encoded).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Look a key up in memory, then on disk."""
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            return value
+        
+        value = self.disk.get(key)
+        if value is not None:
+            with self._lock:
+                self._disk_hits += 1
+            self.memory.set(key, value)
+        
+        return value
+    
+    def set(self, key: str, value: str):
+        """Store a completion in every tier."""
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+    
+    def clear(self):
+        """Remove every cached completion."""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hit and miss counters for the cache."""
+        stats = self.memory.get_stats()
+        with self._lock:
+            disk_hits = self._disk_hits
+        
+        # Memory misses that were served from disk are still cache hits
+        stats["disk_hits"] = disk_hits
+        stats["hits"] += disk_hits
+        stats["misses"] -= disk_hits
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        
+        return stats
@@ -0,0 +1,110 @@
+import time
+import threading
+from typing import Any, Dict
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is refused because the provider's circuit is open."""
+    
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit for '{name}' is open; retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Stop calling a provider that keeps failing.
+    
+    The circuit is closed while calls succeed. After ``failure_threshold``
+    consecutive failures it opens and refuses calls for ``reset_timeout``
+    seconds. It then goes half-open and lets ``half_open_max_calls`` trial
+    calls through: a success closes it again, a failure re-opens it.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_calls = 0
+        self._lock = threading.Lock()
+        self._stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+    
+    @property
+    def state(self) -> str:
+        """Get the current state, moving from open to half-open once the timeout passes."""
+        with self._lock:
+            return self._current_state()
+    
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_calls = 0
+        return self._state
+    
+    def before_call(self):
+        """Reserve a call, raising CircuitOpenError if the circuit refuses it."""
+        with self._lock:
+            state = self._current_state()
+            
+            if state == self.CLOSED:
+                return
+            
+            if state == self.HALF_OPEN and self._trial_calls < self.half_open_max_calls:
+                self._trial_calls += 1
+                return
+            
+            self._stats["rejected"] += 1
+            if state == self.OPEN:
+                retry_after = self.reset_timeout - (time.monotonic() - self._opened_at)
+            else:
+                # Trial calls are still running; they decide when the circuit closes
+                retry_after = 0.0
+        
+        raise CircuitOpenError(self.name, max(retry_after, 0.0))
+    
+    def release(self):
+        """Give back a call reserved by before_call that ended without showing whether the provider works."""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trial_calls > 0:
+                self._trial_calls -= 1
+    
+    def record_success(self):
+        """Record a successful call, closing the circuit."""
+        with self._lock:
+            self._stats["successes"] += 1
+            self._failures = 0
+            self._state = self.CLOSED
+    
+    def record_failure(self):
+        """Record a failed call, opening the circuit if it is tripped."""
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._stats["opened"] += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+    
+    def reset(self):
+        """Close the circuit and forget past failures."""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the circuit state and call counters."""
+        with self._lock:
+            return {
+                **self._stats,
+                "state": self._current_state(),
+                "consecutive_failures": self._failures
+            }
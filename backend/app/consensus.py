@@ -0,0 +1,95 @@
+import re
+import threading
+from itertools import combinations
+from typing import Any, Dict, List, Optional
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+# Words that negate a claim; \w+ splits every "n't" contraction into a stem and "t"
+NEGATIONS = frozenset({
+    "not", "t", "no", "never", "none", "nothing", "nobody", "nowhere", "neither", "nor", "cannot",
+    "without", "unsafe", "unlikely"
+})
+
+def normalize(text: str) -> List[str]:
+    """Split text into casefolded words, ignoring punctuation, spacing and case."""
+    return _WORD.findall(text.casefold())
+
+def shingles(text: str, size: int = 3) -> set:
+    """Get the set of runs of size consecutive words in a text; shorter texts are one shingle."""
+    words = normalize(text)
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[start:start + size]) for start in range(len(words) - size + 1)}
+
+def claims(text: str) -> tuple:
+    """Get what two wordings of one answer must share: its number of negations and its numbers."""
+    negations = sum(1 for word in normalize(text) if word in NEGATIONS)
+    return negations, frozenset(_NUMBER.findall(text))
+
+def similarity(a: set, b: set) -> float:
+    """Jaccard similarity of two shingle sets: 1.0 for the same text, 0.0 for nothing in common."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+class Consensus:
+    """Whether responses agree, and if so the one that stands for them all."""
+    
+    def __init__(self, agreed: bool, merged: Optional[str], similarity: float):
+        self.agreed = agreed
+        self.merged = merged
+        self.similarity = similarity  # Of the least similar pair
+
+class ConsensusDetector:
+    """Tell apart responses that say the same thing from ones that need resolving.
+    
+    Responses agree when every pair of them shares at least threshold of
+    their word shingles (Jaccard similarity), so near-duplicates that
+    only differ in wording here and there agree while answers that share a
+    template but reach different conclusions don't. A "not" or a changed
+    figure flips an answer while barely moving its Jaccard similarity, so
+    a pair that differs in its number of negations or in the numbers it
+    states never agrees. With the handful of responses agents give, exact
+    Jaccard is cheaper than MinHash sketches.
+    Agreeing responses are merged into the one most similar to the rest,
+    the longest on a tie, so the same responses always give the same answer.
+    """
+    
+    def __init__(self, threshold: float = 0.8, shingle_size: int = 3):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self._lock = threading.Lock()
+        self._stats = {"checks": 0, "agreed": 0, "escalated": 0}
+    
+    def check(self, responses: List[str]) -> Consensus:
+        """Check whether responses agree and merge them if they do."""
+        sets = [shingles(response, self.shingle_size) for response in responses]
+        stated = [claims(response) for response in responses]
+        scores = [0.0] * len(responses)
+        lowest = 1.0
+        for i, j in combinations(range(len(responses)), 2):
+            score = similarity(sets[i], sets[j]) if stated[i] == stated[j] else 0.0
+            scores[i] += score
+            scores[j] += score
+            lowest = min(lowest, score)
+        
+        agreed = bool(responses) and lowest >= self.threshold
+        merged = None
+        if agreed:
+            best = max(range(len(responses)), key=lambda index: (scores[index], len(responses[index]), -index))
+            merged = responses[best]
+        
+        with self._lock:
+            self._stats["checks"] += 1
+            self._stats["agreed" if agreed else "escalated"] += 1
+        
+        return Consensus(agreed, merged, lowest)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get how often responses agreed and skipped resolution, and how often they were escalated."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["fast_path_rate"] = stats["agreed"] / stats["checks"] if stats["checks"] else 0.0
+        return stats
@@ -0,0 +1,79 @@
+from typing import Callable, List, Optional
+
+from app.services.tokenization import get_token_counter
+
+class ContextWindowExceeded(ValueError):
+    """Raised when a request cannot fit in a model's context window."""
+    
+    def __init__(self, model: str, required_tokens: int, context_length: int):
+        super().__init__(f"Request needs {required_tokens} tokens but {model} has a "
+                         f"{context_length} token context window")
+        self.model = model
+        self.required_tokens = required_tokens
+        self.context_length = context_length
+
+class PackedHistory:
+    """The conversation turns that fit a token budget, newest last."""
+    
+    def __init__(self, turns: List[str], dropped: int, summary: Optional[str], tokens: int,
+                 separator: str = "\n"):
+        self.turns = turns
+        self.dropped = dropped
+        self.summary = summary
+        self.tokens = tokens
+        self.separator = separator
+    
+    @property
+    def text(self) -> str:
+        """The packed history as one string, led by the summary of dropped turns if any."""
+        pieces = ([self.summary] if self.summary else []) + self.turns
+        return self.separator.join(pieces)
+
+def pack_turns(turns: List[str], budget: int, provider_name: str = None, model: str = None,
+               summarize: Callable[[List[str], int], str] = None, summary_tokens: int = 256,
+               separator: str = "\n") -> PackedHistory:
+    """Keep the newest turns that fit in budget tokens.
+    
+    The oldest turns are dropped first. If summarize is given and turns
+    have to be dropped, summary_tokens of the budget are set aside and
+    summarize(dropped_turns, summary_tokens) replaces them. Counts use the
+    model's tokenizer, and the joined result is checked against the budget.
+    """
+    if budget <= 0:
+        return PackedHistory([], len(turns), None, 0, separator)
+    
+    counter = get_token_counter()
+    counts = counter.count_batch(turns, provider_name, model)
+    separator_tokens = counter.count(separator, provider_name, model)
+    
+    def fit(limit: int) -> int:
+        """Index of the oldest turn that fits when filling from the newest."""
+        used = 0
+        start = len(turns)
+        while start > 0:
+            cost = counts[start - 1] + (separator_tokens if start < len(turns) else 0)
+            if used + cost > limit:
+                break
+            used += cost
+            start -= 1
+        return start
+    
+    start = fit(budget)
+    summary = None
+    if start > 0 and summarize is not None and budget > summary_tokens:
+        start = fit(budget - summary_tokens - separator_tokens)
+        summary = summarize(turns[:start], summary_tokens) or None
+    
+    packed = PackedHistory(turns[start:], start, summary, 0, separator)
+    
+    # Tokens can merge across the separators, so check the exact total
+    packed.tokens = counter.count(packed.text, provider_name, model)
+    while packed.tokens > budget and (packed.turns or packed.summary):
+        if packed.turns:
+            packed.turns = packed.turns[1:]
+            packed.dropped += 1
+        else:
+            packed.summary = None
+        packed.tokens = counter.count(packed.text, provider_name, model)
+    
+    return packed
@@ -0,0 +1,146 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from app.services.tokenization import get_token_counter
+
+SUMMARY_PREFIX = "Summary of earlier conversation: "
+
+# Summaries are refreshed off the request path on a small shared pool
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summary")
+
+def message_text(message: Any) -> str:
+    """Render a chat message, or a plain string, as a line of the conversation."""
+    content = getattr(message, "content", message)
+    role = getattr(message, "type", None)
+    if role == "human":
+        return f"Human: {content}"
+    if role == "ai":
+        return f"AI: {content}"
+    
+    return str(content)
+
+class MemoryStrategy:
+    """Keep every message, like ConversationBufferMemory."""
+    
+    name = "buffer"
+    
+    # Text standing in for messages that were pruned, if the strategy keeps one
+    summary = None
+    
+    def prune(self, messages: List[Any]) -> List[Any]:
+        """Get the messages to keep, oldest first."""
+        return messages
+
+class LastTurnsStrategy(MemoryStrategy):
+    """Keep the last k turns, each a human message and the reply to it."""
+    
+    name = "last_k"
+    
+    def __init__(self, k: int = 10):
+        self.k = k
+    
+    def prune(self, messages: List[Any]) -> List[Any]:
+        return messages[-2 * self.k:] if self.k > 0 else []
+
+class TokenWindowStrategy(MemoryStrategy):
+    """Keep the newest messages that fit in max_tokens."""
+    
+    name = "token_window"
+    
+    def __init__(self, max_tokens: int = 4000, provider_name: str = None, model: str = None):
+        self.max_tokens = max_tokens
+        self.provider_name = provider_name
+        self.model = model
+    
+    def _first_kept(self, messages: List[Any]) -> int:
+        """Index of the oldest message that still fits."""
+        counts = get_token_counter().count_batch([message_text(message) for message in messages],
+                                                 self.provider_name, self.model)
+        used = 0
+        start = len(messages)
+        while start > 0 and used + counts[start - 1] <= self.max_tokens:
+            used += counts[start - 1]
+            start -= 1
+        
+        return start
+    
+    def prune(self, messages: List[Any]) -> List[Any]:
+        return messages[self._first_kept(messages):]
+
+class RollingSummaryStrategy(TokenWindowStrategy):
+    """Keep a token window and fold the messages leaving it into a summary.
+    
+    summarize(previous_summary, lines) returns the new summary. It runs on
+    a background thread, so pruning never waits for it; messages pruned
+    while a refresh is running are folded in by the next one.
+    """
+    
+    name = "summary"
+    
+    def __init__(self, summarize: Callable[[Optional[str], List[str]], str], max_tokens: int = 2000,
+                 provider_name: str = None, model: str = None, executor: ThreadPoolExecutor = None):
+        super().__init__(max_tokens, provider_name, model)
+        self.summarize = summarize
+        self.summary = None
+        self.executor = executor or _summary_executor
+        self._pending = []
+        self._refreshing = False
+        self._condition = threading.Condition()
+    
+    def prune(self, messages: List[Any]) -> List[Any]:
+        start = self._first_kept(messages)
+        if start:
+            with self._condition:
+                self._pending.extend(message_text(message) for message in messages[:start])
+                if not self._refreshing:
+                    self._refreshing = True
+                    self.executor.submit(self._refresh)
+        
+        return messages[start:]
+    
+    def _refresh(self):
+        """Fold pending lines into the summary until none are left."""
+        while True:
+            with self._condition:
+                lines, self._pending = self._pending, []
+                if not lines:
+                    self._refreshing = False
+                    self._condition.notify_all()
+                    return
+            
+            try:
+                self.summary = self.summarize(self.summary, lines) or self.summary
+            except Exception as e:
+                # The lines are lost from the summary, but the conversation goes on
+                logging.error(f"Error refreshing conversation summary: {str(e)}")
+    
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for the summary to catch up with every pruned message."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._refreshing, timeout)
+
+MEMORY_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (MemoryStrategy, LastTurnsStrategy, TokenWindowStrategy, RollingSummaryStrategy)
+}
+
+def create_memory_strategy(name: str, **options) -> MemoryStrategy:
+    """Create a memory strategy by name: buffer, last_k, token_window or summary."""
+    strategy = MEMORY_STRATEGIES.get(name)
+    if strategy is None:
+        raise ValueError(f"Unknown memory strategy '{name}'; expected one of {sorted(MEMORY_STRATEGIES)}")
+    
+    return strategy(**options)
+
+def strategy_options(name: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only the options a strategy accepts, so one config can serve every strategy."""
+    accepted = {
+        "buffer": (),
+        "last_k": ("k",),
+        "token_window": ("max_tokens", "provider_name", "model"),
+        "summary": ("summarize", "max_tokens", "provider_name", "model", "executor")
+    }.get(name, ())
+    
+    return {key: value for key, value in options.items() if key in accepted}
@@ -0,0 +1,77 @@
+import time
+import threading
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from typing import Any, Dict, Hashable, List
+
+class Gathered:
+    """What a fan-out collected: results in the order they arrived, errors and the calls still running."""
+    
+    def __init__(self, results: Dict[Hashable, Any], errors: Dict[Hashable, BaseException],
+                 pending: List[Hashable], elapsed: float):
+        self.results = results
+        self.errors = errors
+        self.pending = pending
+        self.elapsed = elapsed
+
+class FanOut:
+    """Wait on concurrent calls until a quorum of them succeed or a deadline passes.
+    
+    gather takes futures of calls that are already running, so the total
+    wait is that of the slowest call needed rather than the sum. It
+    returns once quorum calls succeeded, every call finished or deadline
+    seconds passed; calls still running then are reported as pending and
+    left to finish on their own.
+    """
+    
+    def __init__(self, quorum: int = None, deadline: float = None):
+        self.quorum = quorum
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._stats = {"fan_outs": 0, "calls": 0, "completed": 0, "failed": 0, "late": 0,
+                       "quorum_reached": 0, "timed_out": 0, "elapsed": 0.0}
+    
+    def gather(self, futures: Dict[Hashable, Future], quorum: int = None, deadline: float = None) -> Gathered:
+        """Collect the futures' results, keyed like futures, until the quorum or deadline."""
+        quorum = quorum if quorum is not None else self.quorum
+        deadline = deadline if deadline is not None else self.deadline
+        quorum = len(futures) if quorum is None else min(quorum, len(futures))
+        
+        started = time.monotonic()
+        results, errors = {}, {}
+        pending = {future: key for key, future in futures.items()}
+        timed_out = False
+        while pending and len(results) < quorum:
+            timeout = None if deadline is None else deadline - (time.monotonic() - started)
+            if timeout is not None and timeout <= 0:
+                timed_out = True
+                break
+            
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    results[key] = future.result()
+                else:
+                    errors[key] = error
+        
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._stats["fan_outs"] += 1
+            self._stats["calls"] += len(futures)
+            self._stats["completed"] += len(results)
+            self._stats["failed"] += len(errors)
+            self._stats["late"] += len(pending)
+            self._stats["quorum_reached"] += quorum > 0 and len(results) >= quorum
+            self._stats["timed_out"] += timed_out
+            self._stats["elapsed"] += elapsed
+        
+        return Gathered(results, errors, list(pending.values()), elapsed)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get call counters and the mean time a fan-out waited in milliseconds."""
+        with self._lock:
+            stats = dict(self._stats)
+        elapsed = stats.pop("elapsed")
+        stats["mean_ms"] = elapsed / stats["fan_outs"] * 1000 if stats["fan_outs"] else 0.0
+        return stats
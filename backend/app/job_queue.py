@@ -0,0 +1,377 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+# Job classes in priority order: a background job only runs when no interactive job waits
+JOB_CLASSES = ("interactive", "background")
+
+# Share of the workers each user's tier gets when users compete, relative to free
+TIER_WEIGHTS = {"free": 1, "pro": 4, "enterprise": 8}
+
+class Job:
+    """A unit of work for a registered handler, queued on behalf of a user."""
+    
+    def __init__(self, kind: str, payload: Any = None, user_id: Hashable = None, tier: str = "free",
+                 job_class: str = "interactive", enqueued_at: float = None, id: int = None,
+                 serial_key: Hashable = None):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.user_id = user_id
+        self.tier = tier
+        self.job_class = job_class
+        self.enqueued_at = enqueued_at if enqueued_at is not None else time.time()
+        self.serial_key = serial_key
+
+class InMemoryJobBackend:
+    """Pending jobs held in this process; they are lost if it exits."""
+    
+    def __init__(self):
+        self._jobs = {}  # id -> job, in the order they were pushed
+        self._next_id = 1
+    
+    def push(self, job: Job):
+        job.id = self._next_id
+        self._next_id += 1
+        self._jobs[job.id] = job
+    
+    def pop(self, job_id: int) -> Optional[Job]:
+        """Take a pending job, or get None if it was already taken."""
+        return self._jobs.pop(job_id, None)
+    
+    def load(self) -> List[Job]:
+        """Get the pending jobs in the order they were pushed."""
+        return list(self._jobs.values())
+
+class SQLiteJobBackend:
+    """Pending jobs kept in SQLite, so they survive a restart.
+    
+    Payloads must be JSON-serializable. A job is removed when it is taken,
+    so one that was running when the process died is not run again. The
+    file belongs to one JobQueue at a time: futures and context live in
+    the process that submitted a job, so queues in other processes must
+    not share it.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, job_class TEXT NOT NULL, "
+            "user_id TEXT, tier TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT, enqueued_at REAL NOT NULL, "
+            "serial_key TEXT)"
+        )
+        # Files written before jobs had serial keys
+        if "serial_key" not in {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN serial_key TEXT")
+    
+    def push(self, job: Job):
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (job_class, user_id, tier, kind, payload, enqueued_at, serial_key) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job.job_class, json.dumps(job.user_id), job.tier, job.kind, json.dumps(job.payload), job.enqueued_at,
+             json.dumps(job.serial_key))
+        )
+        job.id = cursor.lastrowid
+    
+    def pop(self, job_id: int) -> Optional[Job]:
+        # One statement checks and removes the job, so it can never be taken twice
+        rows = self._conn.execute(
+            "DELETE FROM jobs WHERE id = ? "
+            "RETURNING id, job_class, user_id, tier, kind, payload, enqueued_at, serial_key",
+            (job_id,)
+        ).fetchall()
+        return self._job(rows[0]) if rows else None
+    
+    def load(self) -> List[Job]:
+        rows = self._conn.execute(
+            "SELECT id, job_class, user_id, tier, kind, payload, enqueued_at, serial_key FROM jobs ORDER BY id"
+        ).fetchall()
+        return [self._job(row) for row in rows]
+    
+    @staticmethod
+    def _job(row) -> Job:
+        id, job_class, user_id, tier, kind, payload, enqueued_at, serial_key = row
+        return Job(kind, json.loads(payload), json.loads(user_id), tier, job_class, enqueued_at, id,
+                   json.loads(serial_key) if serial_key is not None else None)
+
+class _JobExecutor:
+    """Executor-like view of a JobQueue, for code that expects submit(fn, *args)."""
+    
+    def __init__(self, job_queue: "JobQueue", **job):
+        self.job_queue = job_queue
+        self.job = job
+    
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        return self.job_queue.submit_call(fn, *args, **self.job, **kwargs)
+
+class JobQueue:
+    """Run jobs on a fixed set of workers, by class priority and weighted-fair across users.
+    
+    Interactive jobs always go before background ones. Within a class,
+    users take turns in proportion to their tier's weight (stride
+    scheduling): each job a user runs moves their virtual time on by
+    1 / weight and the user furthest behind goes next, so one user's
+    burst can't starve the others and a pro user gets four times the
+    turns of a free one. Jobs of a class submitted with the same
+    serial_key run one at a time in the order they were submitted,
+    whoever submitted them; while one runs, the others wait and their
+    users' other jobs go ahead. The backend only stores pending jobs so
+    they survive a restart; the scheduling state is kept in memory.
+    Handlers are registered per kind, and context passed to submit
+    reaches the handler only while the job stays in this process.
+    """
+    
+    def __init__(self, backend=None, workers: int = 4, handlers: Dict[str, Callable[..., Any]] = None,
+                 tier_weights: Dict[str, float] = None, window: int = 1000):
+        self.backend = backend or InMemoryJobBackend()
+        self.tier_weights = tier_weights or TIER_WEIGHTS
+        # Handlers given here are in place before jobs left in a persistent backend start running
+        self._handlers = {"call": self._run_call, **(handlers or {})}
+        self._futures = {}  # job id -> (future, context) for jobs submitted in this process
+        self._pending = {job_class: OrderedDict() for job_class in JOB_CLASSES}  # user_id -> deque of jobs
+        self._serial_queues = {job_class: {} for job_class in JOB_CLASSES}  # serial_key -> deque of job ids
+        self._busy = {job_class: set() for job_class in JOB_CLASSES}  # serial keys with a running job
+        self._active = {job_class: {} for job_class in JOB_CLASSES}  # user_id -> running jobs
+        self._virtual_times = {job_class: {} for job_class in JOB_CLASSES}
+        self._clock = {job_class: 0.0 for job_class in JOB_CLASSES}
+        self._latencies = {job_class: {"wait": deque(maxlen=window), "run": deque(maxlen=window)}
+                           for job_class in JOB_CLASSES}
+        self._stats = {f"{job_class}_{stat}": 0 for job_class in JOB_CLASSES
+                       for stat in ("submitted", "completed", "failed")}
+        self._tier_stats = {}
+        self._running = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        for job in self.backend.load():
+            self._add_pending(job)
+        self._threads = [threading.Thread(target=self._work, name=f"job-{number}", daemon=True)
+                         for number in range(workers)]
+        for thread in self._threads:
+            thread.start()
+    
+    def register(self, kind: str, handler: Callable[..., Any]):
+        """Run jobs of a kind with handler(payload, **context)."""
+        self._handlers[kind] = handler
+    
+    def submit(self, kind: str, payload: Any = None, user_id: Hashable = None, tier: str = "free",
+               job_class: str = "interactive", context: Dict[str, Any] = None,
+               serial_key: Hashable = None) -> Future:
+        """Queue a job and get a future of its handler's result."""
+        if job_class not in JOB_CLASSES:
+            raise ValueError(f"Unknown job class '{job_class}'; expected one of {list(JOB_CLASSES)}")
+        if tier not in self.tier_weights:
+            tier = "free"
+        
+        future = Future()
+        job = Job(kind, payload, user_id, tier, job_class, serial_key=serial_key)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Job queue is shut down")
+            
+            self.backend.push(job)
+            self._add_pending(job)
+            self._futures[job.id] = (future, context or {})
+            self._stats[f"{job_class}_submitted"] += 1
+            self._condition.notify()
+        
+        return future
+    
+    def submit_call(self, fn: Callable, *args, user_id: Hashable = None, tier: str = "free",
+                    job_class: str = "background", serial_key: Hashable = None, **kwargs) -> Future:
+        """Run fn(*args, **kwargs) as a job; it only runs in this process, whatever the backend."""
+        return self.submit("call", None, user_id, tier, job_class, {"call": lambda: fn(*args, **kwargs)},
+                           serial_key)
+    
+    def executor(self, **job) -> _JobExecutor:
+        """Get an object whose submit(fn, *args) runs fn as a job with these submit_call options."""
+        return _JobExecutor(self, **job)
+    
+    @staticmethod
+    def _run_call(payload, call=None):
+        if call is None:
+            logging.warning("Dropped a queued call that did not survive a restart")
+            return None
+        return call()
+    
+    def _add_pending(self, job: Job):
+        """Index a pending job by its user and serial key, holding the lock."""
+        self._pending[job.job_class].setdefault(job.user_id, deque()).append(job)
+        if job.serial_key is not None:
+            self._serial_queues[job.job_class].setdefault(job.serial_key, deque()).append(job.id)
+    
+    def _remove_pending(self, job: Job):
+        """Drop a job from the pending index, holding the lock."""
+        jobs = self._pending[job.job_class][job.user_id]
+        jobs.remove(job)
+        if not jobs:
+            del self._pending[job.job_class][job.user_id]
+        
+        if job.serial_key is not None:
+            serial_queue = self._serial_queues[job.job_class][job.serial_key]
+            serial_queue.remove(job.id)
+            if not serial_queue:
+                del self._serial_queues[job.job_class][job.serial_key]
+    
+    def _first_runnable(self, job_class: str, jobs: deque) -> Optional[Job]:
+        """Get a user's oldest job that is not waiting behind another job of its serial key."""
+        for job in jobs:
+            if job.serial_key is None:
+                return job
+            if job.serial_key not in self._busy[job_class] and \
+                    self._serial_queues[job_class][job.serial_key][0] == job.id:
+                return job
+        
+        return None
+    
+    def _next_job(self) -> Optional[Job]:
+        """Take the next job by class priority and the users' virtual times, holding the lock."""
+        for job_class in JOB_CLASSES:
+            pending = self._pending[job_class]
+            while pending:
+                runnable = {}
+                for user_id, jobs in pending.items():
+                    job = self._first_runnable(job_class, jobs)
+                    if job is not None:
+                        runnable[user_id] = job
+                if not runnable:
+                    break
+                
+                virtual_times = self._virtual_times[job_class]
+                clock = self._clock[job_class]
+                active = self._active[job_class]
+                
+                # A user who was idle starts at the current virtual time rather than with saved-up turns
+                starts = {user_id: max(virtual_times.get(user_id, 0.0), clock) for user_id in runnable}
+                user_id = min(starts, key=starts.get)
+                self._clock[job_class] = starts[user_id]
+                # Users are weighted by the tier of their latest job
+                tier = pending[user_id][-1].tier
+                virtual_times[user_id] = starts[user_id] + 1.0 / self.tier_weights.get(tier, 1)
+                
+                job = runnable[user_id]
+                self._remove_pending(job)
+                
+                for idle in [idle for idle, time_ in virtual_times.items()
+                             if idle not in pending and idle not in active and time_ <= self._clock[job_class]]:
+                    del virtual_times[idle]
+                
+                # Skip a job the backend no longer has, so none ever runs twice
+                if self.backend.pop(job.id) is not None:
+                    return job
+        
+        return None
+    
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    if self._closed:
+                        return
+                    self._condition.wait()
+                    job = self._next_job()
+                future, context = self._futures.pop(job.id, (None, {}))
+                active = self._active[job.job_class]
+                active[job.user_id] = active.get(job.user_id, 0) + 1
+                if job.serial_key is not None:
+                    self._busy[job.job_class].add(job.serial_key)
+                self._running += 1
+            
+            self._run(job, future, context)
+            
+            with self._condition:
+                self._running -= 1
+                active[job.user_id] -= 1
+                if not active[job.user_id]:
+                    del active[job.user_id]
+                self._busy[job.job_class].discard(job.serial_key)
+                self._condition.notify_all()
+    
+    def _run(self, job: Job, future: Optional[Future], context: Dict[str, Any]):
+        started = time.time()
+        try:
+            handler = self._handlers[job.kind]
+            result = handler(job.payload, **context)
+        except Exception as e:
+            error = e
+            if future is None:
+                logging.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+        else:
+            error = None
+        
+        finished = time.time()
+        with self._condition:
+            self._stats[f"{job.job_class}_{'failed' if error else 'completed'}"] += 1
+            self._latencies[job.job_class]["wait"].append(started - job.enqueued_at)
+            self._latencies[job.job_class]["run"].append(finished - started)
+            tier_stats = self._tier_stats.setdefault(job.tier, {"jobs": 0, "wait": 0.0})
+            tier_stats["jobs"] += 1
+            tier_stats["wait"] += started - job.enqueued_at
+        
+        if future is not None:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+    
+    def get_user_depths(self, job_class: str = "interactive") -> Dict[Hashable, int]:
+        """Get the number of queued and running jobs of a class for every user with any."""
+        with self._condition:
+            depths = {user_id: len(jobs) for user_id, jobs in self._pending[job_class].items()}
+            for user_id, running in self._active[job_class].items():
+                depths[user_id] = depths.get(user_id, 0) + running
+            return depths
+    
+    def get_serial_depths(self, job_class: str = "interactive") -> Dict[Hashable, int]:
+        """Get the number of queued and running jobs of a class for every serial key with any."""
+        with self._condition:
+            depths = {serial_key: len(job_ids) for serial_key, job_ids in self._serial_queues[job_class].items()}
+            for serial_key in self._busy[job_class]:
+                depths[serial_key] = depths.get(serial_key, 0) + 1
+            return depths
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get job counters, queue depth and wait and run latency per class and mean wait per tier."""
+        def summary(samples: List[float]) -> Dict[str, float]:
+            ordered = sorted(samples)
+            return {
+                "mean_ms": sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+                "p99_ms": ordered[max(0, int(len(ordered) * 0.99) - 1)] * 1000 if ordered else 0.0
+            }
+        
+        with self._condition:
+            depths = {job_class: sum(len(jobs) for jobs in users.values())
+                      for job_class, users in self._pending.items()}
+            return {
+                **self._stats,
+                "running": self._running,
+                "classes": {
+                    job_class: {
+                        "queued": depths.get(job_class, 0),
+                        "wait": summary(latencies["wait"]),
+                        "run": summary(latencies["run"])
+                    }
+                    for job_class, latencies in self._latencies.items()
+                },
+                "tiers": {
+                    tier: {"jobs": stats["jobs"], "mean_wait_ms": stats["wait"] / stats["jobs"] * 1000}
+                    for tier, stats in self._tier_stats.items()
+                }
+            }
+    
+    def shutdown(self, wait: bool = True):
+        """Stop taking jobs once the queued ones have run."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,125 @@
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+class WriteBehindQueue:
+    """Write items in batches on a background thread, in the order they were queued.
+    
+    write_batch(items) must write every item or raise. A batch is written
+    as soon as the writer is free, after waiting up to max_delay seconds
+    for it to fill to max_batch items. One writer thread preserves the
+    order of all items, and so the order within each sandbox. A failed
+    batch is retried up to retries times before its items are given up
+    on, and nothing after it is written first.
+    
+    put returns a Future that completes once the item is written, so a
+    caller that must not lose the item can wait on it.
+    """
+    
+    def __init__(self, write_batch: Callable[[List[Any]], None], max_batch: int = 500,
+                 max_delay: float = 0.01, max_pending: int = 10000, retries: int = 3,
+                 retry_delay: float = 0.1):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pending = deque()  # (item, future)
+        self._writing = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._stats = {"queued": 0, "written": 0, "failed": 0, "batches": 0, "retries": 0, "largest_batch": 0}
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+    
+    def put(self, item: Any) -> Future:
+        """Queue an item, waiting for room if max_pending items are already queued."""
+        future = Future()
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._pending) < self.max_pending or self._closed)
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            
+            self._pending.append((item, future))
+            self._stats["queued"] += 1
+            self._condition.notify_all()
+        
+        return future
+    
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until every item queued so far is written or given up on."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._writing, timeout)
+    
+    def close(self, timeout: float = None) -> bool:
+        """Write what is queued and stop the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+    
+    def _next_batch(self):
+        """Take the next batch, lingering up to max_delay for it to fill."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending or self._closed)
+            if not self._pending:
+                return None
+            
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+            self._writing = len(batch)
+            self._condition.notify_all()
+            return batch
+    
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            
+            error = self._write([item for item, _ in batch])
+            for _, future in batch:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+            
+            with self._condition:
+                self._writing = 0
+                self._stats["batches"] += 1
+                self._stats["written" if error is None else "failed"] += len(batch)
+                self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+                self._condition.notify_all()
+    
+    def _write(self, items: List[Any]):
+        """Write a batch, retrying failures; returns the last error if it could not be written."""
+        for attempt in range(self.retries + 1):
+            try:
+                self.write_batch(items)
+                return None
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    with self._condition:
+                        self._stats["retries"] += 1
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        
+        logging.error(f"Dropped {len(items)} queued writes: {str(error)}")
+        return error
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get counters of queued, written and failed items and the current backlog."""
+        with self._condition:
+            return {**self._stats, "pending": len(self._pending) + self._writing}
@@ -0,0 +1,170 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict
+
+class OffloadedTask:
+    """A call running on an OffloadPool thread and the events it published so far."""
+    
+    def __init__(self, timeout: float = None):
+        self.events = queue.Queue()  # Filled by the worker thread, drained by the relay
+        self.future = None
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+    
+    def publish(self, event: Any):
+        """Hand an event, such as a token, from the worker thread to the relay."""
+        self.events.put(event)
+
+class OffloadPool:
+    """Run blocking calls on OS threads so they don't stall the server's event loop.
+    
+    Under eventlet every socket handler shares one thread, so a handler
+    that blocks on an LLM call blocks them all. submit runs
+    fn(publish, *args, **kwargs) on one of max_workers threads; relay,
+    run as a background task of the event loop, passes what fn publishes
+    and then its result or error to callbacks on the loop's thread,
+    where it is safe to emit. A call still running after timeout seconds
+    is reported as a TimeoutError; its thread finishes it, but the result
+    is dropped.
+    """
+    
+    def __init__(self, max_workers: int = 16, timeout: float = 120.0, poll_interval: float = 0.01):
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="offload")
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "timed_out": 0, "running": 0}
+    
+    def submit(self, fn: Callable, *args, timeout: float = None, **kwargs) -> OffloadedTask:
+        """Start fn(publish, *args, **kwargs) on a worker thread."""
+        task = OffloadedTask(timeout if timeout is not None else self.timeout)
+        with self._lock:
+            self._stats["submitted"] += 1
+        task.future = self._executor.submit(self._call, fn, task, *args, **kwargs)
+        return task
+    
+    def _call(self, fn: Callable, task: OffloadedTask, *args, **kwargs):
+        with self._lock:
+            self._stats["running"] += 1
+        try:
+            return fn(task.publish, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._stats["running"] -= 1
+    
+    def relay(self, task: OffloadedTask, on_event: Callable[[Any], None] = None,
+              on_result: Callable[[Any], None] = None, on_error: Callable[[BaseException], None] = None,
+              sleep: Callable[[float], None] = time.sleep):
+        """Pass a task's events, then its result or error, to callbacks until it is done.
+        
+        sleep must yield to the event loop, e.g. socketio.sleep.
+        """
+        while True:
+            self._drain(task, on_event)
+            if task.future.done():
+                break
+            if task.deadline is not None and time.monotonic() >= task.deadline:
+                task.future.cancel()
+                with self._lock:
+                    self._stats["timed_out"] += 1
+                if on_error:
+                    on_error(TimeoutError(f"Task did not finish within {task.timeout} seconds"))
+                return
+            sleep(self.poll_interval)
+        
+        # Events published just before the call returned
+        self._drain(task, on_event)
+        
+        error = task.future.exception()
+        with self._lock:
+            self._stats["completed" if error is None else "failed"] += 1
+        
+        if error is None:
+            if on_result:
+                on_result(task.future.result())
+        elif on_error:
+            on_error(error)
+        else:
+            logging.error(f"Offloaded task failed: {str(error)}")
+    
+    @staticmethod
+    def _drain(task: OffloadedTask, on_event: Callable[[Any], None]):
+        while True:
+            try:
+                event = task.events.get_nowait()
+            except queue.Empty:
+                return
+            if on_event:
+                on_event(event)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get counters of submitted, finished, timed out and running tasks."""
+        with self._lock:
+            return dict(self._stats)
+    
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes a sleeping task.
+    
+    run sleeps interval seconds at a time with the loop's sleep; any
+    extra time it took to be woken is time the loop was blocked by
+    something else. Lags over warn_after seconds are logged.
+    """
+    
+    def __init__(self, interval: float = 0.5, warn_after: float = 0.25, window: int = 120):
+        self.interval = interval
+        self.warn_after = warn_after
+        self._lags = deque(maxlen=window)
+        self._started = False
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._stats = {"samples": 0, "stalls": 0, "max_lag": 0.0}
+    
+    def start(self, spawn: Callable[..., Any], sleep: Callable[[float], None]):
+        """Start run with spawn, e.g. socketio.start_background_task, unless already started."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        
+        spawn(self.run, sleep)
+    
+    def run(self, sleep: Callable[[float], None] = time.sleep):
+        while not self._stopped:
+            started = time.monotonic()
+            sleep(self.interval)
+            self.record(max(0.0, time.monotonic() - started - self.interval))
+    
+    def record(self, lag: float):
+        """Record one lag sample in seconds."""
+        with self._lock:
+            self._lags.append(lag)
+            self._stats["samples"] += 1
+            self._stats["max_lag"] = max(self._stats["max_lag"], lag)
+            if lag > self.warn_after:
+                self._stats["stalls"] += 1
+        
+        if lag > self.warn_after:
+            logging.warning(f"Event loop stalled for {lag * 1000:.0f} ms")
+    
+    def stop(self):
+        self._stopped = True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the latest, mean, p99 and maximum lag in milliseconds over the recent window."""
+        with self._lock:
+            lags = sorted(self._lags)
+            return {
+                "samples": self._stats["samples"],
+                "stalls": self._stats["stalls"],
+                "last_ms": self._lags[-1] * 1000 if self._lags else 0.0,
+                "mean_ms": sum(lags) / len(lags) * 1000 if lags else 0.0,
+                "p99_ms": lags[max(0, int(len(lags) * 0.99) - 1)] * 1000 if lags else 0.0,
+                "max_ms": self._stats["max_lag"] * 1000
+            }
@@ -0,0 +1,162 @@
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from app.services.request_coalescing import SingleFlight
+from app.services.tokenization import count_tokens
+
+class _CachedPrefix:
+    """One version of an owner's prefix as cached by one provider and model."""
+    
+    def __init__(self, provider, version: str, handle: Optional[str], expires_at: float):
+        self.provider = provider
+        self.version = version
+        self.handle = handle  # None if the provider refused to cache it
+        self.expires_at = expires_at
+
+class PrefixCache:
+    """Track provider-side caches of long, stable prompt prefixes.
+    
+    An owner, such as "agent:12", has at most one cached prefix per provider
+    and model: the current version, identified by a digest of its text.
+    A handle is renewed once less than renew_fraction of its TTL is left,
+    replaced when the prefix changes and deleted when the owner is
+    invalidated. A prefix the provider refuses to cache is not offered
+    again for failure_backoff seconds.
+    """
+    
+    def __init__(self, ttl: float = 3600.0, renew_fraction: float = 0.25,
+                 failure_backoff: float = 300.0):
+        self.ttl = ttl
+        self.renew_fraction = renew_fraction
+        self.failure_backoff = failure_backoff
+        self._entries = {}  # (owner, provider_name, model) -> _CachedPrefix
+        self._single_flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "created": 0, "renewed": 0, "deleted": 0, "failures": 0}
+    
+    def get(self, provider, model: str, owner: str, prefix: str) -> Optional[str]:
+        """Get the provider's cache handle for an owner's prefix, caching it if needed.
+        
+        Returns None if the provider can't cache the prefix, in which case
+        it has to be sent in full.
+        """
+        if not provider.supports_prefix_caching or not prefix:
+            return None
+        
+        if count_tokens(prefix, provider.provider_name, model) < provider.min_prefix_cache_tokens:
+            return None
+        
+        version = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        key = (owner, provider.provider_name, model)
+        
+        # Concurrent requests for a new prefix share one create call
+        return self._single_flight.do((key, version), self._get, provider, model, key, version, prefix)
+    
+    def _get(self, provider, model: str, key, version: str, prefix: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        
+        if entry is not None and entry.version == version:
+            if entry.handle is None and now < entry.expires_at:
+                return None
+            
+            if entry.handle is not None and now < entry.expires_at:
+                if entry.expires_at - now < self.ttl * self.renew_fraction and not self._renew(entry):
+                    return self._create(provider, model, key, version, prefix)
+                
+                with self._lock:
+                    self._stats["hits"] += 1
+                return entry.handle
+        
+        if entry is not None and entry.version != version:
+            # The owner's prefix changed, so the old version will not be used again
+            self._delete(entry)
+        
+        return self._create(provider, model, key, version, prefix)
+    
+    def _create(self, provider, model: str, key, version: str, prefix: str) -> Optional[str]:
+        try:
+            handle = provider.create_prefix_cache(prefix, model, self.ttl)
+        except Exception as e:
+            logging.warning(f"Could not cache prompt prefix on {provider.provider_name}: {str(e)}")
+            entry = _CachedPrefix(provider, version, None, time.monotonic() + self.failure_backoff)
+            stat = "failures"
+        else:
+            entry = _CachedPrefix(provider, version, handle, time.monotonic() + self.ttl)
+            stat = "created"
+        
+        with self._lock:
+            self._entries[key] = entry
+            self._stats[stat] += 1
+        
+        return entry.handle
+    
+    def _renew(self, entry: _CachedPrefix) -> bool:
+        try:
+            entry.provider.renew_prefix_cache(entry.handle, self.ttl)
+        except Exception as e:
+            logging.warning(f"Could not renew prompt prefix cache {entry.handle}: {str(e)}")
+            return False
+        
+        entry.expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            self._stats["renewed"] += 1
+        
+        return True
+    
+    def _delete(self, entry: _CachedPrefix):
+        if entry.handle is None:
+            return
+        
+        try:
+            entry.provider.delete_prefix_cache(entry.handle)
+        except Exception as e:
+            # It expires on its own at the end of its TTL
+            logging.warning(f"Could not delete prompt prefix cache {entry.handle}: {str(e)}")
+        
+        with self._lock:
+            self._stats["deleted"] += 1
+    
+    def discard(self, provider, model: str, owner: str):
+        """Forget an owner's cached prefix on one provider, e.g. after a request using it failed."""
+        with self._lock:
+            entry = self._entries.pop((owner, provider.provider_name, model), None)
+        
+        if entry is not None:
+            self._delete(entry)
+    
+    def invalidate(self, owner: str):
+        """Delete every cached version of an owner's prefix, e.g. after the agent was edited."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == owner]
+            entries = [self._entries.pop(key) for key in keys]
+        
+        for entry in entries:
+            self._delete(entry)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get counters and the number of live cached prefixes."""
+        with self._lock:
+            live = sum(1 for entry in self._entries.values() if entry.handle is not None)
+            return {**self._stats, "entries": live}
+
+_default_prefix_cache = None
+_default_prefix_cache_lock = threading.Lock()
+
+def get_prefix_cache() -> PrefixCache:
+    """Get the process-wide prefix cache, shared so edits to an agent invalidate it everywhere."""
+    global _default_prefix_cache
+    
+    with _default_prefix_cache_lock:
+        if _default_prefix_cache is None:
+            _default_prefix_cache = PrefixCache()
+        
+        return _default_prefix_cache
+
+def agent_prefix_owner(agent_id: Any) -> str:
+    """Get the prefix cache owner key of an agent's system instructions."""
+    return f"agent:{agent_id}"
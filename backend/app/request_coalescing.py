@@ -0,0 +1,191 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator
+
+# Marks that a consumer must pull the next chunk itself
+_PULL = object()
+
+class _Call:
+    """A call in flight, shared by every caller with the same key."""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SharedStream:
+    """A stream whose chunks are replayed to every consumer.
+    
+    Whichever consumer first needs a chunk that has not arrived yet pulls it
+    from the source, so the stream keeps flowing as long as anyone reads it.
+    """
+    
+    def __init__(self, source: Iterator[Any], on_close: Callable[[], None] = None):
+        self._source = source
+        self._on_close = on_close
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._pulling = False
+        self._consumers = 0
+        self._condition = threading.Condition()
+    
+    def subscribe(self) -> Iterator[Any]:
+        """Iterate over every chunk of the stream from the beginning."""
+        with self._condition:
+            self._consumers += 1
+        
+        try:
+            index = 0
+            while True:
+                with self._condition:
+                    while index >= len(self._chunks) and not self._done and self._pulling:
+                        self._condition.wait()
+                    
+                    if index < len(self._chunks):
+                        chunk = self._chunks[index]
+                        index += 1
+                    elif self._done:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                    else:
+                        self._pulling = True
+                        chunk = _PULL
+                
+                if chunk is _PULL:
+                    self._pull()
+                    continue
+                
+                yield chunk
+        finally:
+            with self._condition:
+                self._consumers -= 1
+                abandoned = self._consumers == 0 and not self._done
+            
+            if abandoned:
+                # Nobody is left to read it, so stop the upstream request
+                self._finish(error=None, close_source=True)
+    
+    def _pull(self):
+        """Pull the next chunk from the source for every consumer."""
+        try:
+            chunk = next(self._source)
+        except StopIteration:
+            self._finish(error=None)
+            return
+        except Exception as e:
+            self._finish(error=e)
+            return
+        
+        with self._condition:
+            self._chunks.append(chunk)
+            self._pulling = False
+            self._condition.notify_all()
+    
+    def _finish(self, error: Exception = None, close_source: bool = False):
+        """Mark the stream finished and wake every waiting consumer."""
+        with self._condition:
+            if self._done:
+                return
+            self._done = True
+            self._error = error
+            self._pulling = False
+            self._condition.notify_all()
+        
+        if close_source and hasattr(self._source, "close"):
+            self._source.close()
+        
+        if self._on_close:
+            self._on_close()
+
+class SingleFlight:
+    """Collapse concurrent identical calls into one upstream call.
+    
+    Callers that arrive while a call with the same key is in flight wait for
+    it and share its result, error or stream instead of issuing their own.
+    Nothing is cached once the call completes.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._stats = {"leaders": 0, "coalesced": 0}
+    
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn once for all concurrent callers with the same key."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self._stats["coalesced"] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._stats["leaders"] += 1
+                leader = True
+        
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        
+        if call.error is not None:
+            raise call.error
+        
+        return call.result
+    
+    def stream(self, key: Hashable, factory: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """Share one upstream stream among concurrent callers with the same key."""
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is not None:
+                self._stats["coalesced"] += 1
+            else:
+                shared = SharedStream(factory(), on_close=lambda: self._release_stream(key, shared))
+                self._streams[key] = shared
+                self._stats["leaders"] += 1
+        
+        return shared.subscribe()
+    
+    def _release_stream(self, key: Hashable, shared: SharedStream):
+        """Stop handing out a finished stream to new callers."""
+        with self._lock:
+            if self._streams.get(key) is shared:
+                del self._streams[key]
+    
+    async def ado(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Await one upstream coroutine for all concurrent callers with the same key."""
+        loop = asyncio.get_running_loop()
+        
+        with self._lock:
+            task = self._async_calls.get((loop, key))
+            if task is not None:
+                self._stats["coalesced"] += 1
+            else:
+                task = loop.create_task(factory())
+                self._async_calls[(loop, key)] = task
+                task.add_done_callback(lambda _: self._release_async(loop, key, task))
+                self._stats["leaders"] += 1
+        
+        # Shield the shared task so one caller's cancellation doesn't cancel the others
+        return await asyncio.shield(task)
+    
+    def _release_async(self, loop, key: Hashable, task: asyncio.Task):
+        """Forget a completed async call."""
+        with self._lock:
+            if self._async_calls.get((loop, key)) is task:
+                del self._async_calls[(loop, key)]
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get how many calls went upstream and how many were coalesced."""
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls) + len(self._streams) + len(self._async_calls)}
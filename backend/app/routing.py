@@ -0,0 +1,228 @@
+import time
+import threading
+from collections import deque
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+class ModelMetrics:
+    """Exponentially weighted moving averages of one model's recent behaviour."""
+    
+    def __init__(self, alpha: float = 0.2, window: int = 100):
+        self.alpha = alpha
+        self.latency = None
+        self.time_to_first_token = None
+        self.error_rate = 0.0
+        self.rate_limit_rate = 0.0
+        self.requests = 0
+        self.last_failure_at = None
+        self._latencies = deque(maxlen=window)
+        self._first_token_times = deque(maxlen=window)
+    
+    def _ewma(self, current: Optional[float], sample: float) -> float:
+        """Blend a sample into an average, seeding it with the first sample."""
+        if current is None:
+            return sample
+        return self.alpha * sample + (1 - self.alpha) * current
+    
+    def record(self, latency: float = None, time_to_first_token: float = None,
+               error: bool = False, rate_limited: bool = False):
+        """Fold the outcome of one request into the averages."""
+        self.requests += 1
+        self.error_rate = self._ewma(self.error_rate, 1.0 if error else 0.0)
+        self.rate_limit_rate = self._ewma(self.rate_limit_rate, 1.0 if rate_limited else 0.0)
+        
+        if error or rate_limited:
+            self.last_failure_at = time.monotonic()
+        elif latency is not None:
+            # Failed requests return early, so only successes describe latency
+            self.latency = self._ewma(self.latency, latency)
+            self._latencies.append(latency)
+        
+        if time_to_first_token is not None:
+            self.time_to_first_token = self._ewma(self.time_to_first_token, time_to_first_token)
+            self._first_token_times.append(time_to_first_token)
+    
+    @staticmethod
+    def _percentile(samples: deque, percentile: float) -> Optional[float]:
+        if not samples:
+            return None
+        
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+        
+        return ordered[index]
+    
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Get a percentile (0-100) of the most recent successful latencies."""
+        return self._percentile(self._latencies, percentile)
+    
+    def time_to_first_token_percentile(self, percentile: float) -> Optional[float]:
+        """Get a percentile (0-100) of the most recent times to first token."""
+        return self._percentile(self._first_token_times, percentile)
+    
+    @property
+    def samples(self) -> int:
+        """Number of recent successful requests the percentiles are based on."""
+        return len(self._latencies)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the metrics to a dictionary."""
+        return {
+            "latency": self.latency,
+            "time_to_first_token": self.time_to_first_token,
+            "error_rate": self.error_rate,
+            "rate_limit_rate": self.rate_limit_rate,
+            "requests": self.requests,
+            "p50_latency": self.latency_percentile(50),
+            "p99_latency": self.latency_percentile(99)
+        }
+
+class LatencyRouter:
+    """Route requests to the fastest healthy provider and model.
+    
+    A model is unhealthy while its error or 429 rate is above the configured
+    threshold, until ``recovery_time`` seconds have passed since its last
+    failure; it is then offered traffic again so it can prove it recovered.
+    Models with no measurements yet are preferred so that every candidate
+    gets sampled.
+    """
+    
+    def __init__(self, alpha: float = 0.2, max_error_rate: float = 0.5,
+                 max_rate_limit_rate: float = 0.3, recovery_time: float = 30.0,
+                 history_size: int = 100):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.max_rate_limit_rate = max_rate_limit_rate
+        self.recovery_time = recovery_time
+        self._metrics = {}  # (provider_name, model) -> ModelMetrics
+        self._pins = {}  # pin key -> (provider_name, model)
+        self._decisions = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+    
+    def record(self, provider_name: str, model: str, latency: float = None,
+               time_to_first_token: float = None, error: bool = False,
+               rate_limited: bool = False):
+        """Record the outcome of a request to a provider's model."""
+        with self._lock:
+            metrics = self._metrics.get((provider_name, model))
+            if metrics is None:
+                metrics = self._metrics[(provider_name, model)] = ModelMetrics(self.alpha)
+            metrics.record(latency, time_to_first_token, error, rate_limited)
+    
+    def get_model_metrics(self, provider_name: str, model: str) -> Optional[ModelMetrics]:
+        """Get the live metrics of a provider's model, if it has been used."""
+        with self._lock:
+            return self._metrics.get((provider_name, model))
+    
+    def is_healthy(self, provider_name: str, model: str) -> bool:
+        """Check whether a model may currently receive traffic."""
+        with self._lock:
+            return self._is_healthy(self._metrics.get((provider_name, model)))
+    
+    def _is_healthy(self, metrics: Optional[ModelMetrics]) -> bool:
+        if metrics is None:
+            return True
+        
+        if metrics.error_rate <= self.max_error_rate and metrics.rate_limit_rate <= self.max_rate_limit_rate:
+            return True
+        
+        return (metrics.last_failure_at is not None and
+                time.monotonic() - metrics.last_failure_at >= self.recovery_time)
+    
+    def _score(self, metrics: Optional[ModelMetrics], streaming: bool) -> float:
+        """Expected seconds until the caller is served; lower is better."""
+        if metrics is None or metrics.latency is None:
+            return 0.0
+        
+        latency = metrics.latency
+        if streaming and metrics.time_to_first_token is not None:
+            latency = metrics.time_to_first_token
+        
+        # Failed attempts have to be retried elsewhere, so they inflate the wait
+        return latency / max(1.0 - metrics.error_rate, 0.05)
+    
+    def pin(self, key: Hashable, provider_name: str, model: str = None):
+        """Send every request routed with this key to one provider and model."""
+        with self._lock:
+            self._pins[key] = (provider_name, model)
+    
+    def unpin(self, key: Hashable):
+        """Let requests routed with this key use any provider again."""
+        with self._lock:
+            self._pins.pop(key, None)
+    
+    def get_pin(self, key: Hashable) -> Optional[Tuple[str, Optional[str]]]:
+        """Get the provider and model a key is pinned to."""
+        with self._lock:
+            return self._pins.get(key)
+    
+    def choose(self, candidates: List[Tuple[str, str]], streaming: bool = False,
+               pin_key: Hashable = None, pin: bool = False) -> Tuple[str, str]:
+        """Choose a (provider_name, model) pair from the candidates.
+        
+        If pin_key is pinned to a healthy candidate, that candidate is used.
+        With pin set, the chosen candidate becomes the pin for pin_key.
+        """
+        if not candidates:
+            raise ValueError("No provider can serve this request")
+        
+        with self._lock:
+            scored = []
+            for candidate in candidates:
+                metrics = self._metrics.get(candidate)
+                scored.append((self._score(metrics, streaming), candidate, self._is_healthy(metrics)))
+            
+            pinned = self._pins.get(pin_key) if pin_key is not None else None
+            choice = None
+            reason = None
+            
+            if pinned is not None:
+                for _, candidate, healthy in scored:
+                    if candidate[0] == pinned[0] and pinned[1] in (None, candidate[1]) and healthy:
+                        choice, reason = candidate, "pinned"
+                        break
+            
+            if choice is None:
+                healthy = [entry for entry in scored if entry[2]]
+                # If every candidate is unhealthy, the least bad one is still better than failing
+                pool = healthy or scored
+                choice = min(pool, key=lambda entry: entry[0])[1]
+                reason = "fastest" if healthy else "all_unhealthy"
+                if pinned is not None:
+                    reason = "pin_unavailable"
+                
+                if pin and pin_key is not None:
+                    self._pins[pin_key] = choice
+            
+            self._decisions.append({
+                "timestamp": time.time(),
+                "provider": choice[0],
+                "model": choice[1],
+                "reason": reason,
+                "pin_key": pin_key,
+                "streaming": streaming,
+                "candidates": [
+                    {"provider": candidate[0], "model": candidate[1],
+                     "score": score, "healthy": healthy}
+                    for score, candidate, healthy in scored
+                ]
+            })
+        
+        return choice
+    
+    def get_metrics(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Get the live metrics of every model, grouped by provider."""
+        with self._lock:
+            metrics = {}
+            for (provider_name, model), model_metrics in self._metrics.items():
+                entry = model_metrics.to_dict()
+                entry["healthy"] = self._is_healthy(model_metrics)
+                metrics.setdefault(provider_name, {})[model] = entry
+            
+            return metrics
+    
+    def get_decisions(self, limit: int = None) -> List[Dict[str, Any]]:
+        """Get the most recent routing decisions, newest last."""
+        with self._lock:
+            decisions = list(self._decisions)
+        
+        return decisions[-limit:] if limit else decisions
@@ -1,10 +1,26 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, session
 from flask_socketio import emit, join_room, leave_room
 from app.models.sandbox import Sandbox
+from app.services.sandbox_manager import SandboxManager, in_own_session
+from app.services.offload import OffloadPool, LoopLagMonitor
 from app import socketio
+import os
 
 bp = Blueprint('sandbox', __name__, url_prefix='/api/sandbox')
 
+# Shared sandbox manager so cached chains are reused across events
+sandbox_manager = SandboxManager()
+
+# Agent replies are generated off the event loop so one slow completion can't stall every socket
+offload_pool = OffloadPool(
+    max_workers=int(os.environ.get('OFFLOAD_WORKERS', 16)),
+    timeout=float(os.environ.get('OFFLOAD_TIMEOUT', 120))
+)
+loop_lag = LoopLagMonitor(
+    interval=float(os.environ.get('LOOP_LAG_INTERVAL', 0.5)),
+    warn_after=float(os.environ.get('LOOP_LAG_WARN', 0.25))
+)
+
 @bp.route('/sessions', methods=['GET'])
 def get_sessions():
     """Get all sandbox sessions for the current user"""
@@ -63,6 +79,52 @@ def remove_agent_from_session(id, agent_id):
     result = Sandbox.remove_agent_from_session(id, agent_id)
     return jsonify(result)
 
+@bp.route('/sessions/<int:id>/memory', methods=['PUT'])
+def set_session_memory(id):
+    """Choose how a sandbox session's conversation memory is bounded"""
+    data = request.get_json()
+    
+    if 'strategy' not in data:
+        return jsonify({"error": "Missing required field: strategy"}), 400
+    
+    session = Sandbox.get_session_by_id(id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    
+    options = {key: data[key] for key in ('k', 'max_tokens') if key in data}
+    try:
+        sandbox_manager.set_memory_strategy(id, data['strategy'], **options)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return jsonify({"session_id": id, "strategy": data['strategy'], **options})
+
+@bp.route('/stats/cache', methods=['GET'])
+def get_cache_stats():
+    """Get hit, miss, eviction and size counters of the cached agent and manager chains"""
+    return jsonify(sandbox_manager.get_cache_stats())
+
+@bp.route('/stats/consensus', methods=['GET'])
+def get_consensus_stats():
+    """Get how often agent responses agreed, skipping LLM conflict resolution, and how often they were escalated"""
+    return jsonify(sandbox_manager.get_consensus_stats())
+
+@bp.route('/stats/offload', methods=['GET'])
+def get_offload_stats():
+    """Get counters of offloaded agent calls and the event loop's lag"""
+    return jsonify({"pool": offload_pool.get_stats(), "loop_lag": loop_lag.get_stats()})
+
+@bp.route('/stats/queues', methods=['GET'])
+def get_queue_stats():
+    """Get the number of messages waiting per sandbox session, the scheduler, job queue, fan-out and subtask counters"""
+    return jsonify({
+        "depths": {str(id): depth for id, depth in sandbox_manager.get_queue_depths().items()},
+        "scheduler": sandbox_manager.get_scheduler_stats(),
+        "jobs": sandbox_manager.get_job_queue_stats(),
+        "fan_out": sandbox_manager.get_fan_out_stats(),
+        "tasks": sandbox_manager.get_task_stats()
+    })
+
 # WebSocket events
 @socketio.on('join')
 def on_join(data):
@@ -71,6 +133,8 @@ def on_join(data):
     if not session_id:
         return False
     
+    loop_lag.start(socketio.start_background_task, socketio.sleep)
+    
     room = f"session_{session_id}"
     join_room(room)
     emit('status', {'msg': f"User has joined session {session_id}"}, room=room)
@@ -99,13 +163,10 @@ def on_message(data):
     if not all([session_id, message, sender]):
         return False
     
+    # The job queue shares workers fairly between the users sending messages
+    user_id = session.get('user_id')
     room = f"session_{session_id}"
     
-    # If message is from user to agent, trigger agent response
-    if agent_id:
-        # TODO: Process agent response using AI service
-        pass
-    
     # Broadcast message to all in the session
     emit('message', {
         'session_id': session_id,
@@ -115,4 +176,82 @@ def on_message(data):
         'timestamp': Sandbox.get_timestamp()
     }, room=room)
     
+    # If message is from user to agent, stream the agent response to the room.
+    # The reply is generated on a worker thread and relayed by a background task,
+    # so this handler returns at once and other sockets keep being served.
+    if agent_id:
+        def emit_token(token):
+            socketio.emit('agent_token', {
+                'session_id': session_id,
+                'agent_id': agent_id,
+                'token': token
+            }, room=room)
+        
+        def emit_reply(agent_message):
+            if agent_message:
+                socketio.emit('message', {
+                    'session_id': session_id,
+                    'message': agent_message.content,
+                    'sender': 'agent',
+                    'agent_id': agent_id,
+                    'timestamp': Sandbox.get_timestamp()
+                }, room=room)
+        
+        def emit_error(error):
+            socketio.emit('agent_error', {
+                'session_id': session_id,
+                'agent_id': agent_id,
+                'error': str(error) or type(error).__name__
+            }, room=room)
+        
+        task = offload_pool.submit(in_own_session(
+            lambda publish: sandbox_manager.process_user_message(
+                session_id, message, user_id=user_id, target_agent_id=agent_id, on_token=publish
+            )
+        ))
+        socketio.start_background_task(
+            offload_pool.relay, task, on_event=emit_token, on_result=emit_reply, on_error=emit_error,
+            sleep=socketio.sleep
+        )
+    
+    # Other user messages go to the manager, or in parallel mode to every agent at once;
+    # each agent's tokens are streamed as they arrive, then the manager's resolution
+    elif sender == 'user':
+        def emit_token(event):
+            token_agent_id, token = event
+            socketio.emit('manager_token' if token_agent_id is None else 'agent_token', {
+                'session_id': session_id,
+                'agent_id': token_agent_id,
+                'token': token
+            }, room=room)
+        
+        def emit_reply(manager_message):
+            if manager_message:
+                socketio.emit('message', {
+                    'session_id': session_id,
+                    'message': manager_message.content,
+                    'sender': 'manager',
+                    'agent_id': None,
+                    'timestamp': Sandbox.get_timestamp()
+                }, room=room)
+        
+        def emit_error(error):
+            socketio.emit('agent_error', {
+                'session_id': session_id,
+                'agent_id': None,
+                'error': str(error) or type(error).__name__
+            }, room=room)
+        
+        task = offload_pool.submit(in_own_session(
+            lambda publish: sandbox_manager.process_user_message(
+                session_id, message, user_id=user_id,
+                on_token=lambda token: publish((None, token)),
+                on_agent_token=lambda token_agent_id, token: publish((token_agent_id, token))
+            )
+        ))
+        socketio.start_background_task(
+            offload_pool.relay, task, on_event=emit_token, on_result=emit_reply, on_error=emit_error,
+            sleep=socketio.sleep
+        )
+    
     return True
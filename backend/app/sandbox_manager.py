@@ -3,8 +3,46 @@ from app.services.agent_tools import create_agent_tools
 from app.models.database import db_session
 from app.models.agent import Agent
 from app.models.sandbox import Sandbox, AgentSession, Message
+from app.services.conversation_memory import MEMORY_STRATEGIES
+from app.services.caching import LRUCache, approximate_size
+from app.services.message_queue import WriteBehindQueue
+from app.services.sandbox_scheduler import SandboxScheduler
+from app.services.job_queue import JobQueue, InMemoryJobBackend, SQLiteJobBackend
+from app.services.fan_out import FanOut
+from app.services.task_dag import DagExecutor, parse_plan
+from sqlalchemy import text
+import os
+import atexit
 import logging
 import datetime
+import functools
+import threading
+from concurrent.futures import wait
+
+def in_own_session(fn):
+    """Wrap fn so the calling thread's database session is closed after each call
+    
+    Job queue, scheduler and offload threads live as long as the process
+    and never reach Flask's teardown. Without this their sessions would sit
+    idle in a transaction between jobs and read versions from their
+    identity maps instead of the database.
+    """
+    @functools.wraps(fn)
+    def call(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db_session.remove()
+    
+    return call
+
+class SandboxContext:
+    """A sandbox with its agent sessions and agents, loaded together for one request"""
+    
+    def __init__(self, sandbox, agent_sessions, agents):
+        self.sandbox = sandbox
+        self.agent_sessions = agent_sessions
+        self.agents = agents  # Members in the order they joined
 
 class SandboxManager:
     """Manager for sandbox sessions and agent interactions"""
@@ -12,93 +50,386 @@ class SandboxManager:
     def __init__(self):
         """Initialize the sandbox manager"""
         self.ai_service = AIService()
-        self.agent_chains = {}  # Cache for agent chains
-        self.manager_chains = {}  # Cache for manager chains
-        self.agent_executors = {}  # Cache for agent executors
+        
+        # Chains are rebuilt from the messages table on a miss, so idle ones can be dropped.
+        # Each is stored with the version of the agent or sandbox it was built from.
+        self.agent_chains = self._create_chain_cache('AGENT_CHAINS')  # (sandbox_id, agent_id) -> (version, chain)
+        self.manager_chains = self._create_chain_cache('MANAGER_CHAINS')  # sandbox_id -> (version, chain)
+        self.agent_executors = self._create_chain_cache('AGENT_EXECUTORS')  # (sandbox_id, agent_id) -> (version, executor)
+        self.stale_chains = {'agent_chains': 0, 'manager_chains': 0, 'agent_executors': 0}
+        
+        # In parallel mode every agent answers a message at once. Each agent's replies are
+        # generated in turn on a pool of their own, so an agent still answering after the
+        # deadline never races the next message on its chain's memory.
+        self.agent_scheduler = SandboxScheduler(
+            max_workers=int(os.environ.get('SANDBOX_AGENT_WORKERS', 32)),
+            max_burst=int(os.environ.get('SANDBOX_MAX_BURST', 8))
+        )
+        fan_out_quorum = os.environ.get('SANDBOX_FAN_OUT_QUORUM')
+        self.fan_out = FanOut(
+            quorum=int(fan_out_quorum) if fan_out_quorum else None,  # Default: wait for every agent
+            deadline=float(os.environ.get('SANDBOX_FAN_OUT_DEADLINE', 60))
+        )
+        
+        # In strict mode the manager plans subtasks that the agents run as a dependency graph.
+        # Outputs are kept per sandbox version, so a re-plan reuses the steps it kept.
+        self.task_executor = DagExecutor(cache=LRUCache(
+            max_entries=int(os.environ.get('SANDBOX_SUBTASK_CACHE_ENTRIES', 1000)),
+            ttl=float(os.environ.get('SANDBOX_SUBTASK_CACHE_TTL', 3600))
+        ))
+        
+        # Provider capacity is shared by priority: chat before background work such as
+        # summaries, and users on paying tiers get a larger share when users compete.
+        # A sandbox's jobs run one at a time, so its messages never race on its chains'
+        # memory, are answered in the order they arrived whoever sent them, and a busy
+        # sandbox holds one worker.
+        job_queue_path = os.environ.get('JOB_QUEUE_PATH')
+        self.job_queue = JobQueue(
+            backend=SQLiteJobBackend(job_queue_path) if job_queue_path else InMemoryJobBackend(),
+            workers=int(os.environ.get('JOB_WORKERS', 8)),
+            handlers={'user_message': in_own_session(self._run_user_message_job)}
+        )
+        self.user_tiers = LRUCache(max_entries=10000, ttl=300)  # user_id -> subscription tier
+        
+        # Bound every sandbox's conversation memory unless it picks its own strategy
+        self.default_memory_strategy = os.environ.get('SANDBOX_MEMORY_STRATEGY', 'token_window')
+        self.default_memory_options = {
+            'max_tokens': int(os.environ.get('SANDBOX_MEMORY_MAX_TOKENS', 4000)),
+            'k': int(os.environ.get('SANDBOX_MEMORY_TURNS', 10))
+        }
+        self.memory_strategies = {}  # sandbox_id -> (strategy name, options)
+        
+        # Chains missing from the caches are rebuilt from this many recent messages
+        self.history_messages = int(os.environ.get('SANDBOX_HISTORY_MESSAGES', 50))
+        
+        # sync commits each message on the request path. write_behind batches them
+        # on a background thread; durable does too but waits until the batch is written.
+        self.message_write_mode = os.environ.get('MESSAGE_WRITE_MODE', 'sync')
+        self.message_queue = None
+        self.pending_writes = {}  # sandbox_id -> future of its last queued message
+        self._pending_writes_lock = threading.Lock()
+        if self.message_write_mode in ('write_behind', 'durable'):
+            self.message_queue = WriteBehindQueue(
+                self._write_messages,
+                max_batch=int(os.environ.get('MESSAGE_WRITE_MAX_BATCH', 500)),
+                # Durable callers are waiting, so their batches are written without lingering
+                max_delay=float(os.environ.get(
+                    'MESSAGE_WRITE_MAX_DELAY', 0.01 if self.message_write_mode == 'write_behind' else 0
+                ))
+            )
+            atexit.register(self.close)
     
-    def get_agent_chain(self, agent_id):
-        """Get or create an agent chain"""
-        if agent_id in self.agent_chains:
-            return self.agent_chains[agent_id]
+    @staticmethod
+    def _create_chain_cache(name):
+        """Create a chain cache bounded by SANDBOX_<name>_MAX_ENTRIES, _MAX_BYTES and _IDLE_TTL"""
+        return LRUCache(
+            max_entries=int(os.environ.get(f'SANDBOX_{name}_MAX_ENTRIES', 1000)),
+            max_bytes=int(os.environ.get(f'SANDBOX_{name}_MAX_BYTES', 256 * 1024 * 1024)),
+            ttl=float(os.environ.get(f'SANDBOX_{name}_IDLE_TTL', 1800)),
+            sizeof=SandboxManager._chain_size,
+            refresh_on_access=True
+        )
+    
+    @staticmethod
+    def _chain_size(entry):
+        """Approximate the memory a cached chain holds for its conversation
+        
+        The LLM client and prompt are shared or fixed, so only the
+        conversation memory, which grows with every turn, is counted.
+        """
+        _, chain = entry
+        memory = getattr(chain, "memory", None)
+        if memory is None or not hasattr(memory, "chat_memory"):
+            return 0
+        
+        return approximate_size(memory.chat_memory.messages) + approximate_size(
+            getattr(getattr(memory, "strategy", None), "summary", None)
+        )
+    
+    def set_memory_strategy(self, sandbox_id, strategy, **options):
+        """Choose how a sandbox's conversation memory is bounded
+        
+        strategy is one of buffer, last_k, token_window or summary. The
+        sandbox's chains are rebuilt with it on their next message.
+        """
+        if strategy not in MEMORY_STRATEGIES:
+            raise ValueError(f"Unknown memory strategy '{strategy}'; expected one of {sorted(MEMORY_STRATEGIES)}")
+        
+        self.memory_strategies[sandbox_id] = (strategy, options)
+        self.clear_cache(sandbox_id=sandbox_id)
+    
+    def _create_memory_strategy(self, sandbox_id):
+        """Create the memory strategy of one of a sandbox's chains"""
+        strategy, options = self.memory_strategies.get(sandbox_id, (self.default_memory_strategy, {}))
+        
+        # Rolling summaries are refreshed as background jobs, behind chat
+        executor = self.job_queue.executor(user_id=sandbox_id, serial_key=sandbox_id, job_class='background')
+        return self.ai_service.create_memory_strategy(
+            strategy, **{**self.default_memory_options, 'executor': executor, **options}
+        )
+    
+    def _load_history(self, sandbox_id, sender_type, sender_id):
+        """Get a sender's recent exchanges in a sandbox as (user message, reply) pairs
+        
+        Only the last history_messages messages of the sandbox are read,
+        newest first through the (sandbox_id, created_at) index.
+        """
+        # Messages still queued for writing are part of the history too. They are
+        # written in order, so once this sandbox's last one is, all of them are.
+        written = self.pending_writes.get(sandbox_id)
+        if written is not None:
+            wait([written])
+        
+        messages = Message.query.filter_by(sandbox_id=sandbox_id).order_by(
+            Message.created_at.desc(), Message.id.desc()
+        ).limit(self.history_messages).all()
+        messages.reverse()
+        
+        exchanges = []
+        for previous, message in zip(messages, messages[1:]):
+            if (previous.sender_type == 'user' and message.sender_type == sender_type
+                    and message.sender_id == sender_id):
+                exchanges.append((previous.content, message.content))
+        
+        return exchanges
+    
+    def _restore_memory(self, chain, sandbox_id, sender_type, sender_id):
+        """Rebuild a new chain's memory from the messages table
+        
+        This keeps the conversation going after a restart, a cleared cache
+        or a request landing on another worker.
+        """
+        if sandbox_id is None:
+            return
+        
+        try:
+            self.ai_service.restore_memory(chain, self._load_history(sandbox_id, sender_type, sender_id))
+        except Exception as e:
+            # The chain still works, it just starts without context
+            logging.error(f"Error restoring chain memory: {str(e)}")
+    
+    def _cached_chain(self, name, key, version):
+        """Get a cached chain if it was built from the current version of its agent or sandbox
+        
+        Versions are bumped in the database, so edits made through any
+        worker make the chains built from the old version stale.
+        """
+        cache = getattr(self, name)
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        
+        cached_version, chain = entry
+        if cached_version != version:
+            cache.delete(key)
+            self.stale_chains[name] += 1
+            return None
+        
+        return chain
+    
+    def load_sandbox_context(self, sandbox_id):
+        """Load a sandbox, its agent sessions and their agents in one query
+        
+        The context can be passed to get_agent_chain, get_manager_chain and
+        get_agent_executor so one request does not load the same rows twice.
+        Returns None if the sandbox does not exist.
+        """
+        rows = db_session.query(Sandbox, AgentSession, Agent).outerjoin(
+            AgentSession, AgentSession.sandbox_id == Sandbox.id
+        ).outerjoin(
+            Agent, Agent.id == AgentSession.agent_id
+        ).filter(Sandbox.id == sandbox_id).order_by(AgentSession.id).all()
+        
+        if not rows:
+            return None
+        
+        agent_sessions = [agent_session for _, agent_session, _ in rows if agent_session is not None]
+        agents = [agent for _, _, agent in rows if agent is not None]
+        
+        return SandboxContext(rows[0][0], agent_sessions, agents)
+    
+    def _get_agent(self, agent_id, context=None):
+        """Get an agent, from the request's sandbox context if it is a member"""
+        if context is not None:
+            for agent in context.agents:
+                if agent.id == agent_id:
+                    return agent
+        
+        return Agent.query.get(agent_id)
+    
+    def get_agent_chain(self, agent_id, sandbox_id=None, context=None):
+        """Get or create an agent chain
+        
+        Each sandbox has its own chain, and so its own memory, per agent.
+        """
+        key = (sandbox_id, agent_id)
         
         try:
             # Get the agent from the database
-            agent = Agent.query.get(agent_id)
+            agent = self._get_agent(agent_id, context)
             if not agent:
                 logging.error(f"Agent {agent_id} not found")
+                self.agent_chains.delete(key)
                 return None
             
+            chain = self._cached_chain('agent_chains', key, agent.version)
+            if chain is not None:
+                return chain
+            
             # Create the agent chain
             agent_config = agent.to_dict()
-            chain = self.ai_service.create_agent_chain(agent_config)
+            chain = self.ai_service.create_agent_chain(
+                agent_config, memory_strategy=self._create_memory_strategy(sandbox_id)
+            )
+            self._restore_memory(chain, sandbox_id, 'agent', agent_id)
             
             # Cache the chain
-            self.agent_chains[agent_id] = chain
+            self.agent_chains.set(key, (agent.version, chain))
             
             return chain
         except Exception as e:
             logging.error(f"Error getting agent chain: {str(e)}")
             return None
     
-    def get_manager_chain(self, sandbox_id, mode="collaborative"):
-        """Get or create a manager chain"""
-        if sandbox_id in self.manager_chains:
-            return self.manager_chains[sandbox_id]
+    def get_manager_chain(self, sandbox_id, mode="collaborative", context=None):
+        """Get or create a manager chain
         
+        The sandbox's version changes with its mode, its agents and their
+        names and roles, all of which the manager's prompt embeds.
+        """
         try:
-            # Get the sandbox from the database
-            sandbox = Sandbox.query.get(sandbox_id)
-            if not sandbox:
+            # Get the sandbox and its agents from the database
+            context = context or self.load_sandbox_context(sandbox_id)
+            if not context:
                 logging.error(f"Sandbox {sandbox_id} not found")
+                self.manager_chains.delete(sandbox_id)
                 return None
             
-            # Get the agents in the sandbox
-            agent_sessions = AgentSession.query.filter_by(sandbox_id=sandbox_id).all()
-            agents = []
-            for agent_session in agent_sessions:
-                if agent_session.agent:
-                    agents.append(agent_session.agent.to_dict())
+            sandbox = context.sandbox
+            chain = self._cached_chain('manager_chains', sandbox_id, sandbox.version)
+            if chain is not None:
+                return chain
+            
+            agents = [agent.to_dict() for agent in context.agents]
             
             # Create the manager chain
-            chain = self.ai_service.create_manager_chain(mode=sandbox.mode, agents=agents)
+            chain = self.ai_service.create_manager_chain(
+                mode=sandbox.mode, agents=agents, memory_strategy=self._create_memory_strategy(sandbox_id)
+            )
+            self._restore_memory(chain, sandbox_id, 'manager', 0)  # Manager has ID 0
             
             # Cache the chain
-            self.manager_chains[sandbox_id] = chain
+            self.manager_chains.set(sandbox_id, (sandbox.version, chain))
             
             return chain
         except Exception as e:
             logging.error(f"Error getting manager chain: {str(e)}")
             return None
     
-    def get_agent_executor(self, agent_id):
+    def get_agent_executor(self, agent_id, sandbox_id=None, context=None):
         """Get or create an agent executor with tools"""
-        if agent_id in self.agent_executors:
-            return self.agent_executors[agent_id]
+        key = (sandbox_id, agent_id)
         
         try:
             # Get the agent from the database
-            agent = Agent.query.get(agent_id)
+            agent = self._get_agent(agent_id, context)
             if not agent:
                 logging.error(f"Agent {agent_id} not found")
+                self.agent_executors.delete(key)
                 return None
             
+            executor = self._cached_chain('agent_executors', key, agent.version)
+            if executor is not None:
+                return executor
+            
             # Create agent tools
             tools = create_agent_tools(self.ai_service)
             
             # Create the agent executor
             agent_config = agent.to_dict()
-            executor = self.ai_service.create_agent_executor(agent_config, tools)
+            executor = self.ai_service.create_agent_executor(
+                agent_config, tools, memory_strategy=self._create_memory_strategy(sandbox_id)
+            )
+            self._restore_memory(executor, sandbox_id, 'agent', agent_id)
             
             # Cache the executor
-            self.agent_executors[agent_id] = executor
+            self.agent_executors.set(key, (agent.version, executor))
             
             return executor
         except Exception as e:
             logging.error(f"Error getting agent executor: {str(e)}")
             return None
     
-    def process_user_message(self, sandbox_id, message_content, user_id=None, target_agent_id=None):
-        """Process a user message in a sandbox session"""
+    def _generate_response(self, chain, message_content, on_token=None):
+        """Generate a response, passing partial tokens to on_token if given"""
+        if on_token is None:
+            return self.ai_service.generate_response(chain, message_content)
+        
+        chunks = []
+        for chunk in self.ai_service.stream_response(chain, message_content):
+            chunks.append(chunk)
+            on_token(chunk)
+        
+        return "".join(chunks)
+    
+    def get_user_tier(self, user_id):
+        """Get the tier of a user's active subscription: free, pro or enterprise"""
+        if user_id is None:
+            return 'free'
+        
+        tier = self.user_tiers.get(user_id)
+        if tier is None:
+            try:
+                row = db_session.execute(text(
+                    "SELECT LOWER(p.name) FROM user_subscriptions s "
+                    "JOIN subscription_plans p ON p.id = s.plan_id "
+                    "WHERE s.user_id = :user_id AND s.status = 'active'"
+                ), {"user_id": user_id}).fetchone()
+                tier = row[0] if row else 'free'
+            except Exception as e:
+                logging.error(f"Error getting subscription tier: {str(e)}")
+                return 'free'
+            
+            self.user_tiers.set(user_id, tier)
+        
+        return tier
+    
+    def process_user_message(self, sandbox_id, message_content, user_id=None, target_agent_id=None, on_token=None,
+                             on_agent_token=None):
+        """Process a user message in a sandbox session
+        
+        The message waits in the job queue behind the sandbox's earlier
+        messages, which are processed one at a time in the order they
+        arrive, while users take turns weighted by their tiers. If
+        on_token is given, it is called with each partial token of the
+        reply as it is generated. In parallel mode on_agent_token is called
+        with (agent_id, token) as every agent answers.
+        """
+        return self.job_queue.submit(
+            'user_message',
+            {
+                'sandbox_id': sandbox_id,
+                'message_content': message_content,
+                'user_id': user_id,
+                'target_agent_id': target_agent_id
+            },
+            user_id=user_id,
+            tier=self.get_user_tier(user_id),
+            job_class='interactive',
+            serial_key=sandbox_id,
+            context={'on_token': on_token, 'on_agent_token': on_agent_token}
+        ).result()
+    
+    def _run_user_message_job(self, payload, on_token=None, on_agent_token=None):
+        """Process a queued user message; the job queue runs one of a sandbox's messages at a time"""
+        return self._process_user_message(
+            payload['sandbox_id'], payload['message_content'], payload['user_id'], payload['target_agent_id'],
+            on_token, on_agent_token
+        )
+    
+    def _process_user_message(self, sandbox_id, message_content, user_id=None, target_agent_id=None, on_token=None,
+                              on_agent_token=None):
+        """Save a user message and get the reply to it, in the sandbox's turn"""
         try:
             # Save the user message
             user_message = Message(
@@ -109,30 +440,95 @@ class SandboxManager:
                 created_at=datetime.datetime.utcnow()
             )
             
-            db_session.add(user_message)
-            db_session.commit()
+            self._save_message(user_message)
             
             # If a specific agent is targeted, get a response from that agent
             if target_agent_id:
-                return self.get_agent_response(sandbox_id, target_agent_id, message_content)
+                return self.get_agent_response(sandbox_id, target_agent_id, message_content, on_token)
             
             # Otherwise, get a response from the manager agent
-            return self.get_manager_response(sandbox_id, message_content)
+            return self.get_manager_response(sandbox_id, message_content, on_token, on_agent_token)
         except Exception as e:
             db_session.rollback()
             logging.error(f"Error processing user message: {str(e)}")
             return None
     
-    def get_agent_response(self, sandbox_id, agent_id, message_content):
-        """Get a response from a specific agent"""
+    @staticmethod
+    def _write_messages(messages):
+        """Insert a batch of queued messages with one multi-row INSERT, giving each its id"""
+        columns = ('sandbox_id', 'sender_type', 'sender_id', 'content', 'created_at')
+        try:
+            result = db_session.execute(Message.__table__.insert().values(
+                [{column: getattr(message, column) for column in columns} for message in messages]
+            ).returning(Message.__table__.c.id))
+            # Ids are drawn in VALUES order, even if the rows come back in another
+            ids = sorted(row[0] for row in result)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+        
+        for message, id in zip(messages, ids):
+            message.id = id
+    
+    def _save_message(self, message, wait_for_id=False):
+        """Save a message as MESSAGE_WRITE_MODE says
+        
+        Queued messages are written in order after those queued before them,
+        but have no id until written. In durable mode this waits for the
+        write and raises if it failed; with wait_for_id it waits in
+        write_behind mode too, but a failed write leaves the id None.
+        """
+        if self.message_queue is None:
+            db_session.add(message)
+            db_session.commit()
+            return message
+        
+        written = self.message_queue.put(message)
+        with self._pending_writes_lock:
+            self.pending_writes[message.sandbox_id] = written
+        written.add_done_callback(lambda future: self._forget_write(message.sandbox_id, future))
+        
+        if self.message_write_mode == 'durable':
+            written.result()
+        elif wait_for_id:
+            wait([written])
+        
+        return message
+    
+    def _forget_write(self, sandbox_id, written):
+        """Stop tracking a sandbox's written message unless a later one was queued since"""
+        with self._pending_writes_lock:
+            if self.pending_writes.get(sandbox_id) is written:
+                del self.pending_writes[sandbox_id]
+    
+    def _save_shared_message(self, message):
+        """Save a reply so it can be handed to callers on other threads
+        
+        Callers emit the reply with its id, so this waits for a queued write.
+        """
+        self._save_message(message, wait_for_id=True)
+        
+        # Queued messages never join a session; committed ones are loaded and detached from it
+        if self.message_queue is None:
+            db_session.refresh(message)
+            db_session.expunge(message)
+        
+        return message
+    
+    def get_agent_response(self, sandbox_id, agent_id, message_content, on_token=None):
+        """Generate and save a response from a specific agent"""
         try:
             # Get the agent chain
-            chain = self.get_agent_chain(agent_id)
+            chain = self.get_agent_chain(agent_id, sandbox_id)
             if not chain:
                 return None
             
             # Generate the response
-            response = self.ai_service.generate_response(chain, message_content)
+            response = self._generate_response(chain, message_content, on_token)
+            
+            # Re-measure the chain so its grown memory counts against the cache bound
+            self.agent_chains.update_size((sandbox_id, agent_id))
             
             # Save the agent response
             agent_message = Message(
@@ -143,31 +539,39 @@ class SandboxManager:
                 created_at=datetime.datetime.utcnow()
             )
             
-            db_session.add(agent_message)
-            db_session.commit()
-            
-            return agent_message
+            return self._save_shared_message(agent_message)
         except Exception as e:
             db_session.rollback()
             logging.error(f"Error getting agent response: {str(e)}")
             return None
     
-    def get_manager_response(self, sandbox_id, message_content):
-        """Get a response from the manager agent"""
+    def get_manager_response(self, sandbox_id, message_content, on_token=None, on_agent_token=None):
+        """Generate and save a response from the manager agent"""
         try:
-            # Get the sandbox
-            sandbox = Sandbox.query.get(sandbox_id)
-            if not sandbox:
+            # Get the sandbox and its agents
+            context = self.load_sandbox_context(sandbox_id)
+            if not context:
                 logging.error(f"Sandbox {sandbox_id} not found")
                 return None
             
+            if context.sandbox.mode == 'parallel':
+                return self._get_parallel_response(sandbox_id, message_content, context, on_agent_token)
+            
+            if context.sandbox.mode == 'strict' and context.agents:
+                planned_message = self._get_planned_response(sandbox_id, message_content, context, on_agent_token)
+                if planned_message is not None:
+                    return planned_message
+            
             # Get the manager chain
-            chain = self.get_manager_chain(sandbox_id, sandbox.mode)
+            chain = self.get_manager_chain(sandbox_id, context.sandbox.mode, context)
             if not chain:
                 return None
             
             # Generate the response
-            response = self.ai_service.generate_response(chain, message_content)
+            response = self._generate_response(chain, message_content, on_token)
+            
+            # Re-measure the chain so its grown memory counts against the cache bound
+            self.manager_chains.update_size(sandbox_id)
             
             # Save the manager response
             manager_message = Message(
@@ -178,23 +582,107 @@ class SandboxManager:
                 created_at=datetime.datetime.utcnow()
             )
             
-            db_session.add(manager_message)
-            db_session.commit()
-            
-            return manager_message
+            return self._save_shared_message(manager_message)
         except Exception as e:
             db_session.rollback()
             logging.error(f"Error getting manager response: {str(e)}")
             return None
     
-    def resolve_conflict(self, sandbox_id, context, responses):
-        """Resolve a conflict between agent responses"""
+    def _get_parallel_response(self, sandbox_id, message_content, context, on_agent_token=None):
+        """Ask every agent in the sandbox at once and have the manager resolve their answers
+        
+        The answers gathered once a quorum of agents replied or the
+        deadline passed go to resolve_conflict, so the wait is about that
+        of the slowest agent needed. Agents still answering then finish on
+        their own; their replies are saved but left out of the resolution.
+        """
+        def answer(agent_id):
+            on_token = (lambda token: on_agent_token(agent_id, token)) if on_agent_token else None
+            agent_message = self.get_agent_response(sandbox_id, agent_id, message_content, on_token)
+            if agent_message is None:
+                raise RuntimeError(f"Agent {agent_id} did not reply")
+            return agent_message
+        
+        futures = {
+            agent.id: self.agent_scheduler.submit((sandbox_id, agent.id), in_own_session(answer), agent.id)
+            for agent in context.agents
+        }
+        gathered = self.fan_out.gather(futures)
+        
+        if gathered.pending:
+            logging.warning(f"Agents {gathered.pending} in sandbox {sandbox_id} missed the deadline")
+        if not gathered.results:
+            logging.error(f"No agent in sandbox {sandbox_id} replied")
+            return None
+        
+        names = {agent.id: agent.name for agent in context.agents}
+        responses = [
+            {'sender': names[agent_id], 'content': agent_message.content}
+            for agent_id, agent_message in gathered.results.items()
+        ]
+        return self.resolve_conflict(sandbox_id, message_content, responses)
+    
+    def _get_planned_response(self, sandbox_id, message_content, context, on_agent_token=None):
+        """Have the manager plan subtasks for the agents and run them as a dependency graph
+        
+        Subtasks that don't depend on each other run in parallel, each
+        agent's in turn, and every subtask is given the outputs of those it
+        depends on. The outputs of the final subtasks are the reply. Returns
+        None if the plan is unusable or no final subtask succeeded, so the
+        manager answers on its own instead.
+        """
+        agents = {agent.name: agent for agent in context.agents}
+        plan = self.ai_service.plan_tasks(message_content, [agent.to_dict() for agent in context.agents])
         try:
-            # Convert responses to string format
-            responses_str = "\n\n".join([f"{resp['sender']}: {resp['content']}" for resp in responses])
+            subtasks = parse_plan(plan or "", list(agents))
+        except ValueError as e:
+            logging.warning(f"Ignoring the manager's plan for sandbox {sandbox_id}: {str(e)}")
+            return None
+        
+        def run_subtask(subtask, inputs):
+            agent_id = agents[subtask.agent].id
+            prompt = f"{subtask.task}\n\nThis is part of the request: {message_content}"
+            if inputs:
+                prompt += "\n\nResults of earlier subtasks:\n" + "\n\n".join(
+                    f"[{id}]\n{output}" for id, output in inputs.items()
+                )
             
+            on_token = (lambda token: on_agent_token(agent_id, token)) if on_agent_token else None
+            agent_message = self.get_agent_response(sandbox_id, agent_id, prompt, on_token)
+            if agent_message is None:
+                raise RuntimeError(f"Agent {agent_id} did not reply")
+            return agent_message.content
+        
+        dag_run = self.task_executor.run(
+            subtasks, run_subtask,
+            submit=lambda subtask, fn: self.agent_scheduler.submit(
+                (sandbox_id, agents[subtask.agent].id), in_own_session(fn)
+            ),
+            scope=(sandbox_id, context.sandbox.version)
+        )
+        
+        finals = [(subtask, dag_run.outputs[subtask.id]) for subtask in dag_run.sinks() if subtask.id in dag_run.outputs]
+        if not finals:
+            logging.error(f"No final subtask succeeded for sandbox {sandbox_id}")
+            return None
+        
+        manager_message = Message(
+            sandbox_id=sandbox_id,
+            sender_type='manager',
+            sender_id=0,  # Manager has ID 0
+            content=finals[0][1] if len(finals) == 1 else "\n\n".join(
+                f"{subtask.agent}: {output}" for subtask, output in finals
+            ),
+            created_at=datetime.datetime.utcnow()
+        )
+        
+        return self._save_shared_message(manager_message)
+    
+    def resolve_conflict(self, sandbox_id, context, responses):
+        """Resolve a conflict between agent responses, merging them without the LLM if they agree"""
+        try:
             # Resolve the conflict
-            resolution = self.ai_service.resolve_conflict(responses_str, context)
+            resolution = self.ai_service.resolve_conflict(responses, context)
             
             # Save the resolution as a manager message
             resolution_message = Message(
@@ -205,10 +693,7 @@ class SandboxManager:
                 created_at=datetime.datetime.utcnow()
             )
             
-            db_session.add(resolution_message)
-            db_session.commit()
-            
-            return resolution_message
+            return self._save_shared_message(resolution_message)
         except Exception as e:
             db_session.rollback()
             logging.error(f"Error resolving conflict: {str(e)}")
@@ -217,14 +702,62 @@ class SandboxManager:
     def clear_cache(self, agent_id=None, sandbox_id=None):
         """Clear the cache for a specific agent or sandbox, or all if none specified"""
         if agent_id:
-            if agent_id in self.agent_chains:
-                del self.agent_chains[agent_id]
-            if agent_id in self.agent_executors:
-                del self.agent_executors[agent_id]
+            for cache in (self.agent_chains, self.agent_executors):
+                for key in [key for key in cache.keys() if key[1] == agent_id]:
+                    cache.delete(key)
         elif sandbox_id:
-            if sandbox_id in self.manager_chains:
-                del self.manager_chains[sandbox_id]
+            self.manager_chains.delete(sandbox_id)
+            for cache in (self.agent_chains, self.agent_executors):
+                for key in [key for key in cache.keys() if key[0] == sandbox_id]:
+                    cache.delete(key)
         else:
-            self.agent_chains = {}
-            self.manager_chains = {}
-            self.agent_executors = {}
+            self.agent_chains.clear()
+            self.manager_chains.clear()
+            self.agent_executors.clear()
+    
+    def flush_messages(self, timeout=None):
+        """Wait until every queued message is written"""
+        return self.message_queue is None or self.message_queue.flush(timeout)
+    
+    def close(self, timeout=None):
+        """Process the queued messages, write them and stop, e.g. on shutdown"""
+        self.job_queue.shutdown()
+        self.agent_scheduler.shutdown()
+        self.task_executor.shutdown()
+        if self.message_queue is not None:
+            self.message_queue.close(timeout)
+    
+    def get_message_queue_stats(self):
+        """Get counters of the write-behind message queue, or None if messages are written directly"""
+        return self.message_queue.get_stats() if self.message_queue is not None else None
+    
+    def get_queue_depths(self):
+        """Get the number of messages queued or being processed per sandbox"""
+        return self.job_queue.get_serial_depths('interactive')
+    
+    def get_scheduler_stats(self):
+        """Get counters of the per-agent scheduler"""
+        return self.agent_scheduler.get_stats()
+    
+    def get_consensus_stats(self):
+        """Get how often agent responses agreed and skipped conflict resolution"""
+        return self.ai_service.consensus.get_stats()
+    
+    def get_fan_out_stats(self):
+        """Get counters of parallel-mode fan-outs and how long they waited for agents"""
+        return self.fan_out.get_stats()
+    
+    def get_task_stats(self):
+        """Get counters of strict-mode subtasks and each agent's mean subtask time"""
+        return self.task_executor.get_stats()
+    
+    def get_job_queue_stats(self):
+        """Get job counters and latency per job class and subscription tier"""
+        return self.job_queue.get_stats()
+    
+    def get_cache_stats(self):
+        """Get hit, miss, eviction, staleness and size counters of the chain caches"""
+        return {
+            name: {**getattr(self, name).get_stats(), "stale": stale}
+            for name, stale in self.stale_chains.items()
+        }
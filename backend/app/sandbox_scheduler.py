@@ -0,0 +1,105 @@
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+class SandboxScheduler:
+    """Run tasks one at a time per key, and keys in parallel on a shared pool.
+    
+    Every key, such as a sandbox id, has a mailbox of tasks run in the
+    order they were submitted, never two at once. Keys with work take turns
+    on max_workers threads: a key runs at most max_burst tasks before going
+    to the back of the pool's queue, so a busy sandbox cannot starve the
+    others. Tasks run in the context of the caller that submitted them.
+    """
+    
+    def __init__(self, max_workers: int = 16, max_burst: int = 8):
+        self.max_burst = max_burst
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sandbox")
+        self._mailboxes = {}  # key -> deque of (context, future, fn, args, kwargs); present while active
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "max_depth": 0}
+    
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        """Queue fn(*args, **kwargs) behind the key's earlier tasks."""
+        future = Future()
+        task = (contextvars.copy_context(), future, fn, args, kwargs)
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            start = mailbox is None
+            if start:
+                mailbox = self._mailboxes[key] = deque()
+            mailbox.append(task)
+            self._stats["submitted"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], len(mailbox))
+        
+        if start:
+            try:
+                self._executor.submit(self._drain, key)
+            except RuntimeError:
+                with self._lock:
+                    del self._mailboxes[key]
+                raise
+        
+        return future
+    
+    def run(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn in the key's turn and wait for its result."""
+        return self.submit(key, fn, *args, **kwargs).result()
+    
+    def _drain(self, key: Hashable):
+        """Run up to max_burst of a key's tasks, then yield the thread to other keys."""
+        for _ in range(self.max_burst):
+            with self._lock:
+                mailbox = self._mailboxes[key]
+                if not mailbox:
+                    del self._mailboxes[key]
+                    return
+                context, future, fn, args, kwargs = mailbox[0]
+            
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = context.run(fn, *args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                    stat = "failed"
+                else:
+                    future.set_result(result)
+                    stat = "completed"
+            else:
+                stat = "failed"
+            
+            # The task leaves the mailbox only once done, so depth counts the running one
+            with self._lock:
+                mailbox.popleft()
+                self._stats[stat] += 1
+        
+        with self._lock:
+            if not self._mailboxes[key]:
+                del self._mailboxes[key]
+                return
+        
+        try:
+            self._executor.submit(self._drain, key)
+        except RuntimeError:
+            # The pool is shutting down, so finish the key's tasks on this thread
+            self._drain(key)
+    
+    def get_queue_depths(self) -> Dict[Hashable, int]:
+        """Get the number of queued and running tasks of every key with work."""
+        with self._lock:
+            return {key: len(mailbox) for key, mailbox in self._mailboxes.items()}
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get task counters and the number of keys with work."""
+        with self._lock:
+            return {
+                **self._stats,
+                "active_keys": len(self._mailboxes),
+                "queued": sum(len(mailbox) for mailbox in self._mailboxes.values())
+            }
+    
+    def shutdown(self, wait: bool = True):
+        """Stop the pool once the queued tasks have run."""
+        self._executor.shutdown(wait=wait)
@@ -3,13 +3,52 @@ from langchain.chains import LLMChain, ConversationChain
 from langchain.prompts import PromptTemplate
 from langchain.memory import ConversationBufferMemory
 from langchain.agents import Tool, AgentExecutor, ZeroShotAgent
+from langchain.schema import get_buffer_string
+from app.services.ai_providers import AIModelManager
+from app.services.prompt_cache import agent_prefix_owner
+from app.services.context_packing import pack_turns
+from app.services.tokenization import count_tokens
+from app.services.conversation_memory import SUMMARY_PREFIX, create_memory_strategy, strategy_options
+from app.services.consensus import ConsensusDetector
+from typing import Any
 import os
+import json
 import logging
 
+class BoundedConversationMemory(ConversationBufferMemory):
+    """Conversation buffer pruned by a memory strategy after every exchange"""
+    
+    strategy: Any = None
+    
+    def save_context(self, inputs, outputs):
+        super().save_context(inputs, outputs)
+        if self.strategy is not None:
+            self.chat_memory.messages = self.strategy.prune(self.chat_memory.messages)
+    
+    def load_memory_variables(self, inputs):
+        variables = super().load_memory_variables(inputs)
+        summary = getattr(self.strategy, "summary", None)
+        if summary and not self.return_messages:
+            variables[self.memory_key] = f"{SUMMARY_PREFIX}{summary}\n{variables[self.memory_key]}"
+        
+        return variables
+
 class AIService:
-    def __init__(self, api_key=None):
-        """Initialize the AI service with Gemini Flash 2.0"""
+    # Tokens of each model's context window kept free for the response
+    RESPONSE_TOKENS = 1000
+    
+    def __init__(self, api_key=None, model_manager=None, summarize_overflow=False):
+        """Initialize the AI service with Gemini Flash 2.0
+        
+        With summarize_overflow set, turns that no longer fit a model's
+        context window are summarized instead of dropped.
+        """
         self.api_key = api_key or os.environ.get('GEMINI_API_KEY')
+        self.model_manager = model_manager or AIModelManager.from_environment()
+        self.summarize_overflow = summarize_overflow
+        
+        # Agent responses that agree are merged locally instead of spending an LLM call to resolve them
+        self.consensus = ConsensusDetector(threshold=float(os.environ.get('CONSENSUS_THRESHOLD', 0.8)))
         try:
             self.llm = Gemini(api_key=self.api_key, model_name="gemini-flash-2.0")
             logging.info("AI Service initialized with Gemini Flash 2.0")
@@ -19,15 +58,35 @@ class AIService:
             self.llm = None
             logging.warning("Using mock AI implementation")
         
-    def create_agent_chain(self, agent_config):
+    def create_memory_strategy(self, name, **options):
+        """Create a memory strategy, summarizing with the model manager where one is needed
+        
+        Options the strategy does not take are ignored, so one set of
+        defaults can serve every strategy.
+        """
+        if name == "summary":
+            options.setdefault("summarize", self._summarize_history)
+        
+        return create_memory_strategy(name, **strategy_options(name, options))
+    
+    def _create_memory(self, memory_strategy):
+        """Create the conversation memory of a chain"""
+        if memory_strategy is None:
+            return ConversationBufferMemory(memory_key="chat_history")
+        
+        return BoundedConversationMemory(memory_key="chat_history", strategy=memory_strategy)
+    
+    def create_agent_chain(self, agent_config, memory_strategy=None):
         """Create a LangChain chain for a specific agent"""
         try:
             # Create a prompt template based on agent configuration
-            template = f"""
+            prefix = f"""
             You are {agent_config['name']}, a {agent_config['role']} with a {agent_config['personality']} personality.
             
             {agent_config['system_instructions']}
+            """
             
+            template = prefix + f"""
             Current conversation:
             {{chat_history}}
             
@@ -41,7 +100,7 @@ class AIService:
             )
             
             # Create memory for conversation history
-            memory = ConversationBufferMemory(memory_key="chat_history")
+            memory = self._create_memory(memory_strategy)
             
             # Create the chain
             if self.llm:
@@ -49,7 +108,13 @@ class AIService:
                     llm=self.llm,
                     prompt=prompt,
                     memory=memory,
-                    verbose=True
+                    verbose=True,
+                    # The agent's identity and instructions are the same on every call,
+                    # so providers that support it can cache them
+                    metadata={
+                        "cached_prefix": PromptTemplate(input_variables=[], template=prefix).format(),
+                        "prefix_cache_key": agent_prefix_owner(agent_config.get('id'))
+                    }
                 )
             else:
                 # Mock implementation for development
@@ -60,7 +125,7 @@ class AIService:
             logging.error(f"Error creating agent chain: {str(e)}")
             return MockAgentChain(agent_config)
     
-    def create_manager_chain(self, mode="collaborative", agents=None):
+    def create_manager_chain(self, mode="collaborative", agents=None, memory_strategy=None):
         """Create a LangChain chain for the manager agent"""
         try:
             # Create a prompt template for the manager agent
@@ -93,7 +158,7 @@ class AIService:
             )
             
             # Create memory for conversation history
-            memory = ConversationBufferMemory(memory_key="chat_history")
+            memory = self._create_memory(memory_strategy)
             
             # Create the chain
             if self.llm:
@@ -112,7 +177,7 @@ class AIService:
             logging.error(f"Error creating manager chain: {str(e)}")
             return MockManagerChain(mode, agents)
     
-    def create_agent_executor(self, agent_config, tools=None):
+    def create_agent_executor(self, agent_config, tools=None, memory_strategy=None):
         """Create a more advanced agent executor with tools"""
         try:
             if not tools:
@@ -144,7 +209,7 @@ class AIService:
             )
             
             # Create memory for conversation history
-            memory = ConversationBufferMemory(memory_key="chat_history")
+            memory = self._create_memory(memory_strategy)
             
             # Create the agent
             if self.llm:
@@ -165,19 +230,216 @@ class AIService:
             logging.error(f"Error creating agent executor: {str(e)}")
             return MockAgentExecutor(agent_config, tools)
     
+    def _uses_model_manager(self, chain):
+        """Check whether a chain's LLM call can go through the model manager"""
+        # Executors run a tool loop and mock chains never call a provider
+        return isinstance(chain, LLMChain) and bool(self.model_manager.get_all_providers())
+    
+    def _render_prompt(self, chain, input_text):
+        """Render the prompt as chain.run would, with the history packed into the model's window"""
+        inputs = chain.prep_inputs({"input": input_text})
+        variables = {key: inputs[key] for key in chain.prompt.input_variables}
+        
+        history_key = getattr(chain.memory, "memory_key", None)
+        if history_key in variables and hasattr(chain.memory, "chat_memory"):
+            variables[history_key] = self._pack_history(chain, variables, history_key)
+        
+        return chain.prompt.format(**variables)
+    
+    def _pack_history(self, chain, variables, history_key):
+        """Keep the newest turns of the chain's memory that fit the default model's context window"""
+        provider = self.model_manager.get_provider()
+        model = getattr(provider, "default_model", None)
+        context_length = self.model_manager.get_context_window(provider.provider_name, model)
+        if context_length is None:
+            return variables[history_key]
+        
+        # Everything but the history: instructions, examples and the new input
+        fixed_tokens = count_tokens(chain.prompt.format(**{**variables, history_key: ""}),
+                                    provider.provider_name, model)
+        turns = [
+            get_buffer_string([message], human_prefix=chain.memory.human_prefix, ai_prefix=chain.memory.ai_prefix)
+            for message in chain.memory.chat_memory.messages
+        ]
+        summary = getattr(getattr(chain.memory, "strategy", None), "summary", None)
+        if summary:
+            turns.insert(0, f"{SUMMARY_PREFIX}{summary}")
+        
+        packed = pack_turns(
+            turns,
+            context_length - self.RESPONSE_TOKENS - fixed_tokens,
+            provider.provider_name,
+            model,
+            summarize=self._summarize_turns if self.summarize_overflow else None
+        )
+        if packed.dropped:
+            logging.info(f"Dropped {packed.dropped} turns to fit the {context_length} token window of {model}")
+        
+        return packed.text
+    
+    def _summarize_turns(self, turns, max_tokens):
+        """Summarize conversation turns that no longer fit the context window"""
+        try:
+            summary = self.model_manager.generate_text(
+                prompt="Summarize this conversation briefly, keeping names, decisions and open questions:\n\n"
+                       + "\n".join(turns),
+                temperature=0.0,
+                max_tokens=max_tokens
+            )
+        except Exception as e:
+            logging.error(f"Error summarizing conversation: {str(e)}")
+            return None
+        
+        return f"{SUMMARY_PREFIX}{summary}"
+    
+    def _summarize_history(self, summary, lines):
+        """Fold conversation lines pruned from memory into its rolling summary"""
+        previous = f"Summary so far:\n{summary}\n\n" if summary else ""
+        return self.model_manager.generate_text(
+            prompt=f"{previous}Update the summary of this conversation briefly, keeping names, "
+                   f"decisions and open questions:\n\n" + "\n".join(lines),
+            temperature=0.0,
+            max_tokens=256
+        )
+    
+    def _prompt_args(self, chain, input_text):
+        """Render the chain's prompt as model manager arguments
+        
+        A stable prefix recorded on the chain is sent as the system message,
+        marked so the provider can cache it.
+        """
+        prompt = self._render_prompt(chain, input_text)
+        metadata = chain.metadata or {}
+        prefix = metadata.get("cached_prefix")
+        
+        if not prefix or not prompt.startswith(prefix):
+            return {"prompt": prompt}
+        
+        return {
+            "prompt": prompt[len(prefix):],
+            "system_message": prefix,
+            "prefix_cache_key": metadata.get("prefix_cache_key")
+        }
+    
+    def restore_memory(self, chain, exchanges):
+        """Refill a new chain's memory with earlier (input, response) exchanges, oldest first"""
+        memory = getattr(chain, "memory", None)
+        if not memory or not hasattr(memory, "chat_memory"):
+            return
+        
+        for input_text, response in exchanges:
+            memory.chat_memory.add_user_message(input_text)
+            memory.chat_memory.add_ai_message(response)
+        
+        # Prune once for the whole history rather than once per exchange
+        strategy = getattr(memory, "strategy", None)
+        if strategy is not None:
+            memory.chat_memory.messages = strategy.prune(memory.chat_memory.messages)
+    
+    def _save_to_memory(self, chain, input_text, response):
+        """Record an exchange in the chain's memory as chain.run would"""
+        if chain.memory:
+            chain.memory.save_context({"input": input_text}, {chain.output_key: response})
+    
     def generate_response(self, chain, input_text):
-        """Generate a response using the provided chain"""
+        """Generate a response using the provided chain
+        
+        LLM chains are run through the model manager so a failing provider
+        trips its circuit breaker and the request falls back to the next one.
+        """
         try:
-            if isinstance(chain, (MockAgentChain, MockManagerChain, MockAgentExecutor)):
-                return chain.run(input=input_text)
+            if self._uses_model_manager(chain):
+                response = self.model_manager.generate_text(max_tokens=self.RESPONSE_TOKENS,
+                                                            **self._prompt_args(chain, input_text))
+                self._save_to_memory(chain, input_text, response)
+                return response
             
             return chain.run(input=input_text)
         except Exception as e:
             logging.error(f"Error generating response: {str(e)}")
             return "I'm sorry, I encountered an error processing your request."
     
+    def stream_response(self, chain, input_text):
+        """Stream a response from the provided chain as tokens are generated"""
+        # Chains that don't call a provider are returned as a single chunk
+        if not self._uses_model_manager(chain):
+            yield self.generate_response(chain, input_text)
+            return
+        
+        chunks = []
+        try:
+            for chunk in self.model_manager.stream_text(max_tokens=self.RESPONSE_TOKENS,
+                                                        **self._prompt_args(chain, input_text)):
+                chunks.append(chunk)
+                yield chunk
+            
+            self._save_to_memory(chain, input_text, "".join(chunks))
+        except Exception as e:
+            logging.error(f"Error streaming response: {str(e)}")
+            if not chunks:
+                yield "I'm sorry, I encountered an error processing your request."
+    
+    def plan_tasks(self, task, agents):
+        """Ask the manager for a plan of subtasks with dependencies and agent assignments, as JSON
+        
+        Returns None if the provider fails. Without a provider, every agent
+        gets an independent subtask.
+        """
+        agents_str = "\n".join([f"- {agent['name']}: {agent['role']}" for agent in agents])
+        prompt = f"""
+            You are the Manager Agent in strict mode. Break the task into subtasks and assign each
+            to the one agent whose specialization fits it best.
+            
+            Available agents:
+            {agents_str}
+            
+            Task:
+            {task}
+            
+            Reply with JSON only, in this form:
+            {{"subtasks": [{{"id": "short_id", "agent": "agent name", "task": "what to do",
+                             "depends_on": ["ids of subtasks whose results it needs"]}}]}}
+            Leave depends_on empty for subtasks that can start at once, so they run in parallel.
+            """
+        
+        if self.model_manager.get_all_providers():
+            try:
+                return self.model_manager.generate_text(prompt=prompt, temperature=0.0, max_tokens=self.RESPONSE_TOKENS)
+            except Exception as e:
+                logging.error(f"Error planning tasks: {str(e)}")
+                return None
+        
+        # Mock implementation for development
+        return json.dumps({"subtasks": [
+            {"id": f"task_{number}", "agent": agent['name'],
+             "task": f"As the {agent['role']}, handle your part of: {task}", "depends_on": []}
+            for number, agent in enumerate(agents, 1)
+        ]})
+    
     def resolve_conflict(self, responses, context):
-        """Resolve conflicts between agent responses"""
+        """Resolve conflicts between agent responses
+        
+        responses is a list of response texts or of {'sender', 'content'}
+        dicts. Responses that agree are merged locally; only disagreement
+        is sent to the LLM.
+        """
+        if isinstance(responses, list):
+            contents = [response['content'] if isinstance(response, dict) else str(response) for response in responses]
+            consensus = self.consensus.check(contents)
+            if consensus.agreed:
+                logging.info(f"{len(contents)} agent responses agree (similarity {consensus.similarity:.2f}), "
+                             f"skipped conflict resolution")
+                return consensus.merged
+            
+            responses = "\n\n".join([
+                f"{response['sender']}: {response['content']}" if isinstance(response, dict) else str(response)
+                for response in responses
+            ])
+        
+        return self.generate_conflict_resolution(responses, context)
+    
+    def generate_conflict_resolution(self, responses, context):
+        """Resolve conflicting agent responses with the LLM"""
         try:
             # Create a prompt for conflict resolution
             prompt = f"""
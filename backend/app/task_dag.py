@@ -0,0 +1,209 @@
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Hashable, List
+
+class Subtask:
+    """One step of a plan, assigned to an agent and run after the subtasks it depends on."""
+    
+    def __init__(self, id: str, agent: str, task: str, depends_on: List[str] = None):
+        self.id = id
+        self.agent = agent
+        self.task = task
+        self.depends_on = list(depends_on or [])
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "agent": self.agent, "task": self.task, "depends_on": self.depends_on}
+
+def parse_plan(text: str, agents: List[str]) -> List[Subtask]:
+    """Parse a JSON plan into subtasks in an order that runs dependencies first.
+    
+    The plan is {"subtasks": [{"id", "agent", "task", "depends_on"}]}
+    or just the list, optionally inside a Markdown code block. Raises
+    ValueError if it can't be parsed, names an unknown agent or subtask,
+    or has a dependency cycle.
+    """
+    match = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    try:
+        plan = json.loads(match.group(1) if match else text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Plan is not valid JSON: {str(e)}")
+    
+    if isinstance(plan, dict):
+        plan = plan.get("subtasks")
+    if not isinstance(plan, list) or not plan:
+        raise ValueError("Plan has no subtasks")
+    
+    subtasks = {}
+    for item in plan:
+        if not isinstance(item, dict) or not item.get("id") or not item.get("task"):
+            raise ValueError(f"Subtask needs an id and a task: {item}")
+        subtask = Subtask(str(item["id"]), item.get("agent"), item["task"],
+                          [str(dependency) for dependency in item.get("depends_on") or []])
+        if subtask.id in subtasks:
+            raise ValueError(f"Subtask '{subtask.id}' is defined twice")
+        if subtask.agent not in agents:
+            raise ValueError(f"Subtask '{subtask.id}' is assigned to unknown agent '{subtask.agent}'")
+        subtasks[subtask.id] = subtask
+    
+    for subtask in subtasks.values():
+        for dependency in subtask.depends_on:
+            if dependency not in subtasks:
+                raise ValueError(f"Subtask '{subtask.id}' depends on unknown subtask '{dependency}'")
+    
+    # Kahn's algorithm: whatever is left once nothing more becomes ready is a cycle
+    ordered = []
+    remaining = dict(subtasks)
+    while remaining:
+        ready = [subtask for subtask in remaining.values()
+                 if all(dependency not in remaining for dependency in subtask.depends_on)]
+        if not ready:
+            raise ValueError(f"Plan has a dependency cycle among {sorted(remaining)}")
+        for subtask in ready:
+            ordered.append(remaining.pop(subtask.id))
+    
+    return ordered
+
+class DagRun:
+    """Outputs and per-subtask timings of one plan's execution."""
+    
+    def __init__(self, subtasks: List[Subtask]):
+        self.subtasks = subtasks
+        self.outputs = {}  # subtask id -> output
+        self.errors = {}  # subtask id -> exception
+        self.timings = {}  # subtask id -> {"agent", "status", "wait_ms", "run_ms"}
+        self.elapsed = 0.0
+    
+    def sinks(self) -> List[Subtask]:
+        """Get the subtasks nothing else depends on, whose outputs answer the plan."""
+        dependencies = {dependency for subtask in self.subtasks for dependency in subtask.depends_on}
+        return [subtask for subtask in self.subtasks if subtask.id not in dependencies]
+
+class DagExecutor:
+    """Run a plan's subtasks as soon as their dependencies are done, independent ones in parallel.
+    
+    run_subtask(subtask, inputs) gets the outputs of the subtasks it
+    depends on, by id. A subtask whose dependency failed is skipped.
+    Outputs are cached by the subtask's agent, task and inputs within a
+    scope, so a re-plan that keeps a step with the same inputs reuses its
+    output instead of asking the agent again.
+    """
+    
+    def __init__(self, max_workers: int = 8, cache=None):
+        self.cache = cache  # An LRUCache, or None to always run subtasks
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="subtask")
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "subtasks": 0, "completed": 0, "failed": 0, "skipped": 0, "cached": 0}
+        self._agent_times = {}  # agent -> {"subtasks", "run"}
+    
+    @staticmethod
+    def cache_key(scope: Hashable, subtask: Subtask, inputs: Dict[str, Any]) -> tuple:
+        material = json.dumps([subtask.agent, subtask.task, [[id, inputs[id]] for id in subtask.depends_on]],
+                              default=str)
+        return (scope, hashlib.sha256(material.encode("utf-8")).hexdigest())
+    
+    def run(self, subtasks: List[Subtask], run_subtask: Callable[[Subtask, Dict[str, Any]], Any],
+            submit: Callable[[Subtask, Callable[[], Any]], Future] = None, scope: Hashable = None) -> DagRun:
+        """Execute subtasks ordered by parse_plan, waiting until every one finished or was skipped.
+        
+        submit(subtask, fn) may run fn elsewhere, e.g. on a per-agent
+        scheduler; by default it runs on this executor's threads.
+        """
+        submit = submit or (lambda subtask, fn: self._executor.submit(fn))
+        dag_run = DagRun(subtasks)
+        started = time.monotonic()
+        waiting = {subtask.id: subtask for subtask in subtasks}
+        running = {}  # future -> (subtask, cache key)
+        blocked = set()  # Ids of subtasks that failed or were skipped
+        
+        while waiting or running:
+            for subtask in list(waiting.values()):
+                if blocked.intersection(subtask.depends_on):
+                    del waiting[subtask.id]
+                    blocked.add(subtask.id)
+                    dag_run.timings[subtask.id] = {"agent": subtask.agent, "status": "skipped",
+                                                   "wait_ms": 0.0, "run_ms": 0.0}
+                    continue
+                if not all(dependency in dag_run.outputs for dependency in subtask.depends_on):
+                    continue
+                
+                del waiting[subtask.id]
+                inputs = {dependency: dag_run.outputs[dependency] for dependency in subtask.depends_on}
+                key = self.cache_key(scope, subtask, inputs)
+                cached = self.cache.get(key) if self.cache is not None else None
+                if cached is not None:
+                    dag_run.outputs[subtask.id] = cached
+                    dag_run.timings[subtask.id] = {"agent": subtask.agent, "status": "cached",
+                                                   "wait_ms": 0.0, "run_ms": 0.0}
+                    continue
+                
+                running[submit(subtask, self._timed(subtask, inputs, run_subtask, time.monotonic()))] = (subtask, key)
+            
+            if not running:
+                if waiting:
+                    raise ValueError(f"Subtasks {sorted(waiting)} can never run; check the plan with parse_plan")
+                continue
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                subtask, key = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    logging.error(f"Subtask '{subtask.id}' ({subtask.agent}) failed: {str(error)}")
+                    dag_run.errors[subtask.id] = error
+                    blocked.add(subtask.id)
+                    dag_run.timings[subtask.id] = {"agent": subtask.agent, "status": "failed",
+                                                   "wait_ms": 0.0, "run_ms": 0.0}
+                    continue
+                
+                output, timing = future.result()
+                dag_run.outputs[subtask.id] = output
+                dag_run.timings[subtask.id] = {"agent": subtask.agent, "status": "completed", **timing}
+                if self.cache is not None:
+                    self.cache.set(key, output)
+        
+        dag_run.elapsed = time.monotonic() - started
+        self._record(dag_run)
+        return dag_run
+    
+    @staticmethod
+    def _timed(subtask: Subtask, inputs: Dict[str, Any], run_subtask: Callable, ready: float) -> Callable[[], Any]:
+        """Wrap a subtask so it reports how long it waited for a thread and how long it ran."""
+        def call():
+            started = time.monotonic()
+            output = run_subtask(subtask, inputs)
+            return output, {"wait_ms": (started - ready) * 1000, "run_ms": (time.monotonic() - started) * 1000}
+        return call
+    
+    def _record(self, dag_run: DagRun):
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["subtasks"] += len(dag_run.subtasks)
+            for timing in dag_run.timings.values():
+                self._stats[timing["status"]] += 1
+                if timing["status"] == "completed":
+                    agent_times = self._agent_times.setdefault(timing["agent"], {"subtasks": 0, "run": 0.0})
+                    agent_times["subtasks"] += 1
+                    agent_times["run"] += timing["run_ms"]
+        
+        logging.info(f"Ran {len(dag_run.subtasks)} subtasks in {dag_run.elapsed * 1000:.0f} ms: " + ", ".join(
+            f"{id} {timing['status']} {timing['run_ms']:.0f} ms" for id, timing in dag_run.timings.items()
+        ))
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get subtask counters and the mean run time of each agent's subtasks in milliseconds."""
+        with self._lock:
+            return {
+                **self._stats,
+                "agents": {
+                    agent: {"subtasks": times["subtasks"], "mean_run_ms": times["run"] / times["subtasks"]}
+                    for agent, times in self._agent_times.items()
+                }
+            }
+    
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
@@ -1,12 +1,19 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+import asyncio
 import os
 import json
+import time
+import threading
+import requests
 from app.services.ai_providers import (
     AIModelProvider, GeminiProvider, DeepSeekProvider, HuggingFaceProvider,
     OpenRouterProvider, AnthropicProvider, MistralAIProvider, PerplexityProvider,
-    GrokProvider, OllamaProvider, AIModelManager
+    GrokProvider, OllamaProvider, AIModelManager, iter_sse_events,
+    HTTPSessionPool, RateLimiter, RateLimitExceeded, parse_retry_after
 )
+from app.services.caching import ResponseCache
+from app.services.context_packing import ContextWindowExceeded
 
 class TestAIProviders(unittest.TestCase):
     def setUp(self):
@@ -108,7 +115,7 @@ class TestAIProviders(unittest.TestCase):
                 self.assertIn('name', model)
                 self.assertIn('description', model)
     
-    @patch('requests.post')
+    @patch('requests.Session.request')
     def test_gemini_generate_text(self, mock_post):
         """Test Gemini text generation."""
         # Mock response
@@ -143,13 +150,18 @@ class TestAIProviders(unittest.TestCase):
         # Verify API call
         mock_post.assert_called_once()
         args, kwargs = mock_post.call_args
-        self.assertIn("generativelanguage.googleapis.com", args[0])
+        self.assertEqual(args[0], "POST")
+        self.assertIn("generativelanguage.googleapis.com", args[1])
         self.assertIn("temperature", kwargs["json"]["generationConfig"])
         self.assertIn("maxOutputTokens", kwargs["json"]["generationConfig"])
     
-    @patch('requests.post')
-    def test_deepseek_generate_text(self, mock_post):
+    @patch('app.services.ai_providers.get_token_counter')
+    @patch('requests.Session.request')
+    def test_deepseek_generate_text(self, mock_post, mock_counter):
         """Test DeepSeek text generation."""
+        # Count tokens without tiktoken, whose vocabulary download would go through the mocked session
+        mock_counter.return_value.count_batch.return_value = [10, 0]
+        
         # Mock response
         mock_response = MagicMock()
         mock_response.json.return_value = {
@@ -178,11 +190,560 @@ class TestAIProviders(unittest.TestCase):
         # Verify API call
         mock_post.assert_called_once()
         args, kwargs = mock_post.call_args
-        self.assertIn("api.deepseek.ai", args[0])
+        self.assertEqual(args[0], "POST")
+        self.assertIn("api.deepseek.ai", args[1])
         self.assertIn("messages", kwargs["json"])
         self.assertIn("temperature", kwargs["json"])
         self.assertIn("max_tokens", kwargs["json"])
     
+    def test_providers_share_manager_http_pool(self):
+        """Test that registered providers send requests through the manager's pool."""
+        for provider in self.manager.get_all_providers().values():
+            self.assertIs(provider.http_pool, self.manager.http_pool)
+    
+    @patch('requests.Session.request')
+    def test_http_pool_reuses_provider_session(self, mock_request):
+        """Test that repeated calls reuse one keep-alive session per provider."""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"choices": [{"message": {"content": "ok"}}]}
+        mock_request.return_value = mock_response
+        
+        self.deepseek.generate_text(prompt="First")
+        session = self.manager.http_pool.get_session("DeepSeek")
+        self.deepseek.generate_text(prompt="Second")
+        
+        self.assertIs(self.manager.http_pool.get_session("DeepSeek"), session)
+        self.assertIsNot(self.manager.http_pool.get_session("Gemini"), session)
+        
+        # Timeouts are applied to every pooled request
+        _, kwargs = mock_request.call_args
+        self.assertEqual(kwargs["timeout"], (self.manager.http_pool.connect_timeout,
+                                             self.manager.http_pool.read_timeout))
+        
+        stats = self.manager.get_http_pool_stats()
+        self.assertIn("DeepSeek", stats)
+        for key in ("requests", "connections_opened", "connections_in_use", "idle_connections",
+                    "open_connections", "reuse_ratio", "hosts"):
+            self.assertIn(key, stats["DeepSeek"])
+    
+    def test_http_pool_stats_count_connections_per_host(self):
+        """Test that pool stats report each host's connections in use, idle and open."""
+        http_pool = HTTPSessionPool(pool_size=4)
+        adapter = http_pool.get_session("DeepSeek").get_adapter("https://api.deepseek.com")
+        host_pool = adapter.poolmanager.connection_from_url("https://api.deepseek.com/chat")
+        
+        # Check out two connections without sending anything, then return one
+        first, second = host_pool._get_conn(), host_pool._get_conn()
+        host_pool._put_conn(first)
+        
+        stats = http_pool.get_stats()["DeepSeek"]
+        self.assertEqual(stats["hosts"]["https://api.deepseek.com:443"], {"in_use": 1, "idle": 1, "open": 2})
+        self.assertEqual(stats["connections_in_use"], 1)
+        self.assertEqual(stats["open_connections"], 2)
+        
+        host_pool._put_conn(second)
+        self.assertEqual(http_pool.get_stats()["DeepSeek"]["connections_in_use"], 0)
+        http_pool.close()
+    
+    def test_sse_event_parsing(self):
+        """Test parsing of server-sent event streams."""
+        lines = [
+            b"event: message_start",
+            b'data: {"type": "message_start"}',
+            b"",
+            b": keep-alive comment",
+            b'data: {"text":',
+            b'data: "multi-line"}',
+            b"",
+            b"data: [DONE]",
+            b"",
+            b'data: {"text": "after done"}'
+        ]
+        
+        events = list(iter_sse_events(lines))
+        
+        self.assertEqual(events, [{"type": "message_start"}, {"text": "multi-line"}])
+    
+    @patch('requests.Session.request')
+    def test_deepseek_stream_text(self, mock_request):
+        """Test DeepSeek token streaming."""
+        mock_response = MagicMock()
+        mock_response.__enter__.return_value = mock_response
+        mock_response.iter_lines.return_value = [
+            b'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+            b"",
+            b'data: {"choices": [{"delta": {"content": "Hello"}}]}',
+            b"",
+            b'data: {"choices": [{"delta": {"content": " world"}}]}',
+            b"",
+            b"data: [DONE]",
+            b""
+        ]
+        mock_request.return_value = mock_response
+        
+        chunks = list(self.deepseek.stream_text(prompt="Test prompt"))
+        
+        self.assertEqual(chunks, ["Hello", " world"])
+        args, kwargs = mock_request.call_args
+        self.assertTrue(kwargs["stream"])
+        self.assertTrue(kwargs["json"]["stream"])
+    
+    @patch('requests.Session.request')
+    def test_gemini_stream_uses_sse_endpoint(self, mock_request):
+        """Test that Gemini streaming calls streamGenerateContent with SSE."""
+        mock_response = MagicMock()
+        mock_response.__enter__.return_value = mock_response
+        mock_response.iter_lines.return_value = [
+            b'data: {"candidates": [{"content": {"parts": [{"text": "Hi"}]}}]}',
+            b""
+        ]
+        mock_request.return_value = mock_response
+        
+        chunks = list(self.gemini.stream_text(prompt="Test prompt"))
+        
+        self.assertEqual(chunks, ["Hi"])
+        args, kwargs = mock_request.call_args
+        self.assertIn(":streamGenerateContent", args[1])
+        self.assertIn("alt=sse", args[1])
+    
+    def test_anthropic_stream_event_parsing(self):
+        """Test extraction of Anthropic text deltas."""
+        self.assertEqual(self.anthropic._parse_stream_event(
+            {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "Hi"}}), "Hi")
+        self.assertEqual(self.anthropic._parse_stream_event({"type": "message_stop"}), "")
+        
+        with self.assertRaises(RuntimeError):
+            self.anthropic._parse_stream_event({"type": "error", "error": {"message": "overloaded"}})
+    
+    @patch('httpx.AsyncClient.post', new_callable=AsyncMock)
+    def test_anthropic_agenerate_text(self, mock_post):
+        """Test async Anthropic text generation."""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"content": [{"type": "text", "text": "Async hello"}]}
+        mock_post.return_value = mock_response
+        
+        response = asyncio.run(self.anthropic.agenerate_text(
+            prompt="Test prompt",
+            system_message="You are a helpful assistant"
+        ))
+        
+        self.assertEqual(response, "Async hello")
+        args, kwargs = mock_post.call_args
+        self.assertIn("api.anthropic.com", args[0])
+        self.assertEqual(kwargs["json"]["system"], "You are a helpful assistant")
+    
+    def test_manager_agenerate_text_bounds_concurrency(self):
+        """Test that async generation respects the per-provider concurrency limit."""
+        manager = AIModelManager(max_concurrency=2)
+        manager.register_provider(self.deepseek)
+        peak = 0
+        
+        async def fake_agenerate(**kwargs):
+            nonlocal peak
+            peak = max(peak, manager.get_concurrency_stats()["DeepSeek"]["in_flight"])
+            await asyncio.sleep(0.01)
+            return "ok"
+        
+        async def run():
+            return await asyncio.gather(*[
+                manager.agenerate_text(prompt=f"Prompt {i}") for i in range(10)
+            ])
+        
+        with patch.object(self.deepseek, 'agenerate_text', side_effect=fake_agenerate):
+            results = asyncio.run(run())
+        
+        self.assertEqual(results, ["ok"] * 10)
+        self.assertEqual(peak, 2)
+        self.assertEqual(manager.get_concurrency_stats()["DeepSeek"]["in_flight"], 0)
+        self.assertEqual(manager.get_usage_stats()["providers"]["DeepSeek"]["requests"], 10)
+    
+    def test_manager_response_cache(self):
+        """Test that low temperature completions are served from the response cache."""
+        manager = AIModelManager(response_cache=ResponseCache(max_temperature=0.3))
+        manager.register_provider(self.deepseek)
+        
+        with patch.object(self.deepseek, 'generate_text', return_value="Cached answer") as mock_generate:
+            first = manager.generate_text(prompt="Same prompt", system_message="Agent", temperature=0.0)
+            second = manager.generate_text(prompt="Same prompt", system_message="Agent", temperature=0.0)
+            manager.generate_text(prompt="Same prompt", system_message="Agent", temperature=0.9)
+            manager.generate_text(prompt="Same prompt", system_message="Agent", temperature=0.0,
+                                  use_cache=False)
+        
+        self.assertEqual(first, "Cached answer")
+        self.assertEqual(second, "Cached answer")
+        self.assertEqual(mock_generate.call_count, 3)
+        
+        stats = manager.get_response_cache_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+    
+    def test_manager_coalesces_identical_requests(self):
+        """Test that identical concurrent requests share one upstream call."""
+        manager = AIModelManager()
+        manager.register_provider(self.deepseek)
+        
+        async def slow_generate(**kwargs):
+            await asyncio.sleep(0.01)
+            return "Shared answer"
+        
+        async def burst():
+            return await asyncio.gather(*[
+                manager.agenerate_text(prompt="Same prompt", system_message="Agent")
+                for _ in range(5)
+            ])
+        
+        with patch.object(self.deepseek, 'agenerate_text', side_effect=slow_generate) as mock_generate:
+            responses = asyncio.run(burst())
+        
+        self.assertEqual(responses, ["Shared answer"] * 5)
+        self.assertEqual(mock_generate.call_count, 1)
+        
+        stats = manager.get_coalescing_stats()
+        self.assertEqual(stats["leaders"], 1)
+        self.assertEqual(stats["coalesced"], 4)
+        self.assertEqual(stats["in_flight"], 0)
+    
+    def test_manager_auto_routes_to_fastest_provider(self):
+        """Test that "auto" requests go to the provider with the best live latency."""
+        manager = AIModelManager()
+        manager.register_provider(self.gemini)
+        manager.register_provider(self.deepseek)
+        manager.router.record("Gemini", self.gemini.default_model, latency=3.0)
+        manager.router.record("DeepSeek", self.deepseek.default_model, latency=0.2)
+        
+        with patch.object(self.deepseek, 'generate_text', return_value="Fast answer") as mock_generate:
+            response = manager.generate_text(prompt="Test prompt", provider_name="auto")
+        
+        self.assertEqual(response, "Fast answer")
+        mock_generate.assert_called_once()
+        self.assertEqual(manager.get_routing_decisions()[-1]["provider"], "DeepSeek")
+        self.assertEqual(manager.get_routing_metrics()["DeepSeek"]["deepseek-chat"]["requests"], 2)
+        
+        manager.pin_sandbox("sandbox-1", "Gemini")
+        self.assertEqual(manager.route(sandbox_id="sandbox-1"), ("Gemini", self.gemini.default_model))
+    
+    def test_manager_falls_back_when_circuit_opens(self):
+        """Test that failures fail over along the chain and then skip the open circuit."""
+        manager = AIModelManager(failure_threshold=2, reset_timeout=60)
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        manager.set_fallback_chain("Gemini", ["DeepSeek"])
+        
+        with patch.object(self.gemini, 'generate_text', side_effect=requests.ConnectionError("down")) as mock_gemini, \
+             patch.object(self.deepseek, 'generate_text', return_value="Fallback answer") as mock_deepseek:
+            responses = [manager.generate_text(prompt=f"Prompt {i}") for i in range(4)]
+        
+        self.assertEqual(responses, ["Fallback answer"] * 4)
+        self.assertEqual(mock_gemini.call_count, 2)
+        self.assertEqual(mock_deepseek.call_count, 4)
+        
+        stats = manager.get_circuit_breaker_stats()
+        self.assertEqual(stats["Gemini"]["state"], "open")
+        self.assertEqual(stats["Gemini"]["rejected"], 2)
+        self.assertEqual(stats["DeepSeek"]["state"], "closed")
+    
+    def test_manager_circuit_ignores_rejected_requests(self):
+        """Test that bad requests and rate limits fail over without opening the provider's circuit."""
+        manager = AIModelManager(failure_threshold=2, reset_timeout=60)
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        manager.set_fallback_chain("Gemini", ["DeepSeek"])
+        
+        bad_request = MagicMock(status_code=400)
+        rate_limited = MagicMock(status_code=429)
+        errors = [requests.HTTPError(response=bad_request)] * 3 + [
+            requests.HTTPError(response=rate_limited), RateLimitExceeded("Gemini", 30.0)
+        ]
+        
+        with patch.object(self.gemini, 'generate_text', side_effect=errors) as mock_gemini, \
+             patch.object(self.deepseek, 'generate_text', return_value="Fallback answer"):
+            responses = [manager.generate_text(prompt=f"Prompt {i}") for i in range(5)]
+        
+        self.assertEqual(responses, ["Fallback answer"] * 5)
+        self.assertEqual(mock_gemini.call_count, 5)
+        stats = manager.get_circuit_breaker_stats()["Gemini"]
+        self.assertEqual(stats["state"], "closed")
+        self.assertEqual(stats["failures"], 0)
+    
+    def test_manager_fails_over_instead_of_waiting_for_rate_limit(self):
+        """Test that a paused provider with a fallback fails over instead of sleeping out the pause."""
+        manager = AIModelManager(rate_limit_max_wait=60.0, fallback_rate_limit_wait=1.0)
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        manager.set_fallback_chain("Gemini", ["DeepSeek"])
+        self.gemini.rate_limiter.update_from_response(429, {"retry-after": "30"})
+        
+        with patch.object(self.gemini, '_post') as mock_gemini, \
+             patch.object(self.deepseek, 'generate_text', return_value="Fallback answer"), \
+             patch("time.sleep") as mock_sleep:
+            response = manager.generate_text(prompt="Test prompt")
+        
+        self.assertEqual(response, "Fallback answer")
+        mock_gemini.assert_not_called()
+        mock_sleep.assert_not_called()
+        self.assertEqual(self.gemini.rate_limiter.get_stats()["rejected"], 1)
+        
+        # Without a fallback the provider waits out the pause
+        with patch.object(self.deepseek.rate_limiter, "acquire") as acquire, \
+             patch.object(self.deepseek, '_post') as mock_post, \
+             patch.object(self.deepseek, '_parse_response', return_value="Answer"):
+            mock_post.return_value.status_code = 200
+            manager.generate_text(prompt="Test prompt", provider_name="DeepSeek")
+        self.assertIsNone(acquire.call_args[0][1])
+    
+    def test_manager_stream_falls_back_before_first_chunk(self):
+        """Test that a stream fails over if the provider errors before sending anything."""
+        manager = AIModelManager()
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        manager.set_fallback_chain("Gemini", ["DeepSeek"])
+        
+        with patch.object(self.gemini, 'stream_text', side_effect=requests.Timeout("slow")), \
+             patch.object(self.deepseek, 'stream_text', return_value=iter(["Hello", " there"])):
+            chunks = list(manager.stream_text(prompt="Test prompt"))
+        
+        self.assertEqual(chunks, ["Hello", " there"])
+    
+    def test_manager_hedges_slow_primary(self):
+        """Test that a backup request wins when the primary is slower than usual."""
+        manager = AIModelManager(hedge_min_samples=5, hedge_percentile=90, hedge_budget_fraction=1.0)
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        for _ in range(5):
+            manager.router.record("Gemini", self.gemini.default_model, latency=0.05,
+                                  time_to_first_token=0.01)
+        
+        primary_closed = []
+        
+        def slow_stream(*args, **kwargs):
+            try:
+                time.sleep(0.2)
+                yield "Slow"
+                yield " answer"
+            finally:
+                primary_closed.append(True)
+        
+        with patch.object(self.gemini, 'stream_text', side_effect=slow_stream), \
+             patch.object(self.deepseek, 'stream_text', return_value=iter(["Fast", " answer"])) as mock_backup:
+            response = manager.generate_text(prompt="Test prompt", hedge=True, hedge_budget_tokens=2000)
+        
+        self.assertEqual(response, "Fast answer")
+        # The backup's answer is as long as the primary's could have been
+        self.assertEqual(mock_backup.call_args.kwargs["max_tokens"], 1000)
+        
+        time.sleep(0.3)
+        self.assertEqual(primary_closed, [True])
+        
+        stats = manager.get_hedging_stats()
+        self.assertEqual(stats["hedged"], 1)
+        self.assertEqual(stats["backup_won"], 1)
+    
+    def test_manager_hedge_closes_stalled_loser(self):
+        """Test that the losing request's connection is closed as soon as the other side wins."""
+        manager = AIModelManager(hedge_min_samples=5, hedge_percentile=90, hedge_budget_fraction=1.0)
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        for _ in range(5):
+            manager.router.record("Gemini", self.gemini.default_model, latency=0.05,
+                                  time_to_first_token=0.01)
+        
+        closed = threading.Event()
+        
+        def stalled_lines():
+            # Stands in for an upstream that never sends its first token until hung up on
+            closed.wait(5)
+            return iter([])
+        
+        stalled = MagicMock(status_code=200, headers={})
+        stalled.__enter__.return_value = stalled
+        stalled.iter_lines.side_effect = stalled_lines
+        stalled.close.side_effect = closed.set
+        self.gemini.http_pool = MagicMock()
+        self.gemini.http_pool.request.return_value = stalled
+        
+        with patch.object(self.deepseek, 'stream_text', return_value=iter(["Fast", " answer"])):
+            response = manager.generate_text(prompt="Test prompt", hedge=True, max_tokens=1000)
+        
+        self.assertEqual(response, "Fast answer")
+        self.assertTrue(closed.wait(1))
+        
+        # Being hung up on is not the primary's failure
+        time.sleep(0.1)
+        self.assertEqual(manager.circuit_breakers["Gemini"].get_stats()["failures"], 0)
+    
+    def test_manager_hedges_within_budget(self):
+        """Test that backups stop once they would exceed their share of the tokens requested."""
+        manager = AIModelManager(hedge_min_samples=5, hedge_percentile=90, hedge_budget_fraction=0.5)
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        # Enough fast history that the slow calls below don't make slowness look normal
+        for _ in range(100):
+            manager.router.record("Gemini", self.gemini.default_model, latency=0.05,
+                                  time_to_first_token=0.01)
+        
+        def slow_stream(*args, **kwargs):
+            time.sleep(0.1)
+            yield "Slow answer"
+        
+        with patch.object(self.gemini, 'stream_text', side_effect=slow_stream), \
+             patch.object(self.deepseek, 'stream_text', side_effect=lambda *args, **kwargs: iter(["Fast answer"])):
+            responses = [manager.generate_text(prompt="Test prompt", hedge=True) for _ in range(4)]
+            # Too expensive to hedge however much budget is left
+            manager.generate_text(prompt="Test prompt", hedge=True, hedge_budget_tokens=100)
+        
+        stats = manager.get_hedging_stats()
+        self.assertEqual(stats["hedged"], 2)
+        self.assertEqual(stats["skipped"], 3)
+        self.assertLessEqual(stats["hedged_tokens"], stats["requested_tokens"] * 0.5)
+        self.assertEqual(sorted(responses), ["Fast answer", "Fast answer", "Slow answer", "Slow answer"])
+    
+    def test_manager_does_not_hedge_without_history(self):
+        """Test that hedging is skipped until the primary has enough latency samples."""
+        manager = AIModelManager()
+        manager.register_provider(self.gemini, is_default=True)
+        manager.register_provider(self.deepseek)
+        
+        with patch.object(self.gemini, 'generate_text', return_value="Primary answer"):
+            response = manager.generate_text(prompt="Test prompt", hedge=True)
+        
+        self.assertEqual(response, "Primary answer")
+        self.assertEqual(manager.get_hedging_stats()["hedged"], 0)
+    
+    def test_provider_without_batch_endpoint_or_prefix_cache(self):
+        """Test that a provider without these features degrades instead of raising."""
+        self.assertIsNone(self.deepseek.create_prefix_cache("Long instructions"))
+        
+        with patch.object(self.deepseek, 'generate_text', return_value="Answer") as mock_generate:
+            self.assertEqual(self.deepseek.generate_batch(["Prompt"], max_tokens=50), ["Answer"])
+        mock_generate.assert_called_once_with("Prompt", None, 0.7, 50, model=None)
+    
+    def test_manager_generate_many(self):
+        """Test that batches keep input order, bound concurrency and report per-item errors."""
+        manager = AIModelManager()
+        manager.register_provider(self.deepseek, is_default=True)
+        active = 0
+        peak = 0
+        lock = threading.Lock()
+        
+        def fake_generate(prompt, **kwargs):
+            nonlocal active, peak
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            time.sleep(0.01)
+            with lock:
+                active -= 1
+            if prompt == "Prompt 3":
+                raise requests.HTTPError("bad request")
+            return prompt.upper()
+        
+        with patch.object(self.deepseek, 'generate_text', side_effect=fake_generate):
+            results = manager.generate_many([f"Prompt {i}" for i in range(8)], concurrency=3,
+                                            system_message="Agent")
+        
+        self.assertEqual([result.index for result in results], list(range(8)))
+        self.assertEqual(results[0].response, "PROMPT 0")
+        self.assertFalse(results[3].ok)
+        self.assertIsInstance(results[3].error, requests.HTTPError)
+        self.assertTrue(all(result.latency is not None for result in results))
+        self.assertLessEqual(peak, 3)
+    
+    @patch('requests.Session.request')
+    def test_manager_generate_many_uses_native_batches(self, mock_request):
+        """Test that Hugging Face requests with the same settings share one batch request."""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.side_effect = lambda: [
+            [{"generated_text": f"Answer {i}"}] for i in range(len(mock_request.call_args[1]["json"]["inputs"]))
+        ]
+        mock_request.return_value = mock_response
+        
+        manager = AIModelManager()
+        manager.register_provider(self.huggingface, is_default=True)
+        results = manager.generate_many([f"Prompt {i}" for i in range(10)], temperature=0.2)
+        
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual([result.response for result in results],
+                         [f"Answer {i}" for i in range(8)] + ["Answer 0", "Answer 1"])
+        self.assertTrue(all(result.batched for result in results))
+        self.assertEqual(manager.get_usage_stats()["providers"]["Hugging Face"]["requests"], 10)
+    
+    def test_manager_stream_many(self):
+        """Test that streams are interleaved and each ends with its result."""
+        manager = AIModelManager()
+        manager.register_provider(self.deepseek, is_default=True)
+        
+        def fake_stream(prompt, **kwargs):
+            if prompt == "broken":
+                raise requests.ConnectionError("down")
+            return iter([prompt, "!"])
+        
+        with patch.object(self.deepseek, 'stream_text', side_effect=fake_stream):
+            events = list(manager.stream_many(["one", "two", "broken"], coalesce=False))
+        
+        results = {index: event for index, event in events if not isinstance(event, str)}
+        chunks = [(index, event) for index, event in events if isinstance(event, str)]
+        
+        self.assertEqual(results[0].response, "one!")
+        self.assertEqual(results[1].response, "two!")
+        self.assertIsNotNone(results[0].time_to_first_token)
+        self.assertIsInstance(results[2].error, requests.ConnectionError)
+        self.assertEqual(sorted(chunks), [(0, "!"), (0, "one"), (1, "!"), (1, "two")])
+    
+    def test_prefix_cache_request_payloads(self):
+        """Test that cached system messages are referenced instead of resent."""
+        _, _, payload = self.gemini._build_request("Hi", "Long instructions", prefix_cache="cachedContents/abc")
+        self.assertEqual(payload["cachedContent"], "cachedContents/abc")
+        self.assertNotIn("systemInstruction", payload)
+        
+        _, _, payload = self.anthropic._build_request("Hi", "Long instructions", prefix_cache="ephemeral")
+        self.assertEqual(payload["system"][0]["cache_control"], {"type": "ephemeral"})
+        
+        _, _, payload = self.anthropic._build_request("Hi", "Long instructions")
+        self.assertEqual(payload["system"], "Long instructions")
+    
+    def test_manager_uses_prefix_cache_handle(self):
+        """Test that prefix_cache_key is swapped for the provider's cache handle."""
+        prefix_cache = MagicMock()
+        prefix_cache.get.return_value = "cachedContents/abc"
+        manager = AIModelManager(prefix_cache=prefix_cache)
+        manager.register_provider(self.gemini, is_default=True)
+        
+        with patch.object(self.gemini, 'generate_text', return_value="ok") as mock_generate:
+            manager.generate_text("Hi", system_message="Long instructions", prefix_cache_key="agent:1")
+        
+        kwargs = mock_generate.call_args[1]
+        self.assertEqual(kwargs["prefix_cache"], "cachedContents/abc")
+        self.assertNotIn("prefix_cache_key", kwargs)
+        prefix_cache.get.assert_called_once_with(self.gemini, "gemini-flash-2.0", "agent:1", "Long instructions")
+    
+    def test_anthropic_cached_tokens_count_as_prompt_tokens(self):
+        """Test that Anthropic cache reads are included in the prompt token count."""
+        usage = self.anthropic._parse_usage({"usage": {
+            "input_tokens": 10, "cache_read_input_tokens": 3000,
+            "cache_creation_input_tokens": 0, "output_tokens": 20
+        }})
+        self.assertEqual(usage, {"prompt_tokens": 3010, "cached_tokens": 3000, "completion_tokens": 20})
+    
+    def test_manager_rejects_prompts_larger_than_the_context_window(self):
+        """Test that an oversized prompt fails over, or fails, without calling the provider."""
+        manager = AIModelManager()
+        manager.register_provider(self.huggingface, is_default=True)
+        manager.register_provider(self.anthropic)
+        long_prompt = "word " * 10000
+        
+        with patch.object(self.huggingface, 'generate_text') as mock_small, \
+             patch.object(self.anthropic, 'generate_text', return_value="ok") as mock_large:
+            with self.assertRaises(ContextWindowExceeded):
+                manager.generate_text(long_prompt)
+            
+            manager.set_fallback_chain("Hugging Face", ["Anthropic"])
+            self.assertEqual(manager.generate_text(long_prompt), "ok")
+        
+        mock_small.assert_not_called()
+        mock_large.assert_called_once()
+        self.assertEqual(manager.get_context_window("Anthropic"), 200000)
+    
     def test_token_usage_estimation(self):
         """Test token usage estimation."""
         prompt = "This is a test prompt with approximately 10 tokens."
@@ -199,6 +760,38 @@ class TestAIProviders(unittest.TestCase):
             self.assertGreater(usage["completion_tokens"], 0)
             self.assertEqual(usage["total_tokens"], usage["prompt_tokens"] + usage["completion_tokens"])
     
+    @patch('requests.Session.request')
+    def test_reported_token_usage_is_exact(self, mock_request):
+        """Test that the token counts a provider reports replace the local count."""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "candidates": [{"content": {"parts": [{"text": "Hello"}]}}],
+            "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 3, "totalTokenCount": 15}
+        }
+        mock_request.return_value = mock_response
+        
+        usage = {}
+        self.assertEqual(self.gemini.generate_text("Test prompt", usage=usage), "Hello")
+        self.assertEqual(usage, {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15})
+        
+        manager = AIModelManager()
+        manager.register_provider(self.gemini)
+        manager.generate_text("Another prompt", provider_name="Gemini")
+        self.assertEqual(manager.get_usage_stats()["providers"]["Gemini"]["total_tokens"], 15)
+    
+    def test_anthropic_stream_usage_parsing(self):
+        """Test that Anthropic's split stream usage is combined."""
+        reported = {}
+        reported.update(self.anthropic._parse_usage(
+            {"type": "message_start", "message": {"usage": {"input_tokens": 25, "output_tokens": 1}}}))
+        reported.update(self.anthropic._parse_usage({"type": "content_block_delta", "delta": {"text": "Hi"}}))
+        reported.update(self.anthropic._parse_usage({"type": "message_delta", "usage": {"output_tokens": 15}}))
+        
+        usage = {}
+        self.anthropic._report_usage(usage, reported)
+        self.assertEqual(usage, {"prompt_tokens": 25, "completion_tokens": 15, "total_tokens": 40})
+    
     def test_manager_functionality(self):
         """Test AIModelManager functionality."""
         # Test getting providers
@@ -258,5 +851,103 @@ class TestAIProviders(unittest.TestCase):
         stats = self.manager.get_usage_stats()
         self.assertGreater(stats["total_tokens"], 0)
 
+class TestRateLimiter(unittest.TestCase):
+    def test_requests_are_paced_in_arrival_order(self):
+        """Test that callers beyond the burst wait for the bucket to refill."""
+        with patch("time.monotonic", return_value=100.0):
+            limiter = RateLimiter("DeepSeek:key", requests_per_minute=60)
+            waits = [limiter._reserve(0) for _ in range(62)]
+        
+        self.assertEqual(waits[:60], [0.0] * 60)
+        self.assertAlmostEqual(waits[60], 1.0)
+        self.assertAlmostEqual(waits[61], 2.0)
+        
+        stats = limiter.get_stats()
+        self.assertEqual(stats["waited"], 2)
+        self.assertEqual(stats["queue_depth"], 2)
+    
+    def test_token_budget_and_settlement(self):
+        """Test that unused reserved tokens are returned to the budget."""
+        with patch("time.monotonic", return_value=100.0):
+            limiter = RateLimiter("Gemini:key", tokens_per_minute=600)
+            self.assertEqual(limiter._reserve(600), 0.0)
+            limiter.settle(600, 100)
+            self.assertEqual(limiter._reserve(500), 0.0)
+            self.assertAlmostEqual(limiter._reserve(100), 10.0)
+    
+    def test_retry_after_pauses_callers(self):
+        """Test that a 429 with Retry-After delays every following caller."""
+        with patch("time.monotonic", return_value=100.0):
+            limiter = RateLimiter("Gemini:key")
+            limiter.update_from_response(429, {"retry-after": "5"})
+            self.assertAlmostEqual(limiter._reserve(0), 5.0)
+        
+        self.assertEqual(limiter.get_stats()["rate_limited"], 1)
+    
+    def test_exhausted_rate_limit_headers_pause_until_reset(self):
+        """Test that remaining=0 headers pause the limiter until the reset time."""
+        with patch("time.monotonic", return_value=100.0):
+            limiter = RateLimiter("DeepSeek:key", requests_per_minute=100)
+            limiter.update_from_response(200, {
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "30s"
+            })
+            self.assertAlmostEqual(limiter._reserve(0), 30.0 + 0.6)
+    
+    def test_long_queue_is_rejected(self):
+        """Test that callers are rejected rather than queued past max_wait."""
+        with patch("time.monotonic", return_value=100.0):
+            limiter = RateLimiter("Gemini:key", requests_per_minute=1, max_wait=10)
+            limiter._reserve(0)
+            with self.assertRaises(RateLimitExceeded):
+                limiter._reserve(0)
+        
+        self.assertEqual(limiter.get_stats()["rejected"], 1)
+    
+    def test_reservation_counts_system_message_and_is_released_on_failure(self):
+        """Test that the system message is reserved and a failed request gives its reservation back."""
+        provider = DeepSeekProvider("test_deepseek_key")
+        provider.attach_rate_limiter(RateLimiter("DeepSeek:key", tokens_per_minute=100000))
+        system_message = "Follow these long agent instructions carefully. " * 200
+        
+        with patch.object(provider.rate_limiter, "acquire") as acquire:
+            provider._acquire_quota("Hi", 100, system_message=system_message)
+        self.assertGreater(acquire.call_args[0][0], provider._acquire_quota("Hi", 100) + 1000)
+        
+        level = provider.rate_limiter.token_bucket.level
+        response = MagicMock(status_code=500, headers={})
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+        with patch('requests.Session.request', return_value=response):
+            with self.assertRaises(requests.HTTPError):
+                provider.generate_text("Hi", system_message=system_message, max_tokens=100)
+        
+        # The bucket refills meanwhile, so only a level below the start means tokens were kept
+        self.assertGreaterEqual(provider.rate_limiter.token_bucket.level, level - 5)
+    
+    def test_parse_retry_after(self):
+        """Test parsing of the Retry-After and reset header formats."""
+        self.assertEqual(parse_retry_after("30"), 30.0)
+        self.assertEqual(parse_retry_after("6m0s"), 360.0)
+        self.assertEqual(parse_retry_after("250ms"), 0.25)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertIsNone(parse_retry_after("soon"))
+    
+    def test_provider_feeds_headers_to_limiter(self):
+        """Test that providers report 429 responses to their limiter."""
+        manager = AIModelManager()
+        provider = DeepSeekProvider("test_deepseek_key")
+        manager.register_provider(provider)
+        
+        response = MagicMock(status_code=429, headers={"retry-after": "2"})
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+        
+        with patch('requests.Session.request', return_value=response):
+            with self.assertRaises(requests.HTTPError):
+                provider.generate_text("Test prompt")
+        
+        stats = manager.get_rate_limit_stats()["DeepSeek"]
+        self.assertEqual(stats["rate_limited"], 1)
+        self.assertGreater(stats["paused_for"], 0)
+
 if __name__ == '__main__':
     unittest.main()
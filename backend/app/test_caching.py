@@ -0,0 +1,114 @@
+import unittest
+from unittest.mock import patch
+import os
+import tempfile
+from app.services.caching import LRUCache, ResponseCache, approximate_size
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        """Test that the least recently used entry is evicted first."""
+        evicted = []
+        cache = LRUCache(max_entries=2, on_evict=lambda key, value: evicted.append(key))
+        
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(evicted, ["b"])
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+    
+    def test_evicts_to_fit_byte_budget(self):
+        """Test that entries are evicted when the size budget is exceeded."""
+        cache = LRUCache(max_entries=100, max_bytes=10, sizeof=len)
+        
+        cache.set("a", "x" * 6)
+        cache.set("b", "y" * 6)
+        
+        self.assertEqual(cache.keys(), ["b"])
+        self.assertEqual(cache.get_stats()["bytes"], 6)
+    
+    def test_update_size_evicts_when_value_grows(self):
+        """Test that a value that grew in place is re-measured against the budget."""
+        cache = LRUCache(max_entries=100, max_bytes=10, sizeof=len)
+        cache.set("a", ["x"] * 3)
+        cache.set("b", ["y"] * 3)
+        
+        cache.get("b").extend(["y"] * 5)
+        self.assertTrue(cache.update_size("b"))
+        
+        self.assertEqual(cache.keys(), ["b"])
+        self.assertEqual(cache.get_stats()["bytes"], 8)
+        self.assertFalse(cache.update_size("a"))
+    
+    def test_ttl_expiry(self):
+        """Test that entries expire after their TTL."""
+        cache = LRUCache(ttl=10)
+        
+        with patch("time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with patch("time.monotonic", return_value=105.0):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+        
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["expirations"], 1)
+    
+    def test_idle_ttl_refreshes_on_access(self):
+        """Test that reads extend the lifetime of idle-timeout entries."""
+        cache = LRUCache(ttl=10, refresh_on_access=True)
+        
+        with patch("time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with patch("time.monotonic", return_value=108.0):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("time.monotonic", return_value=116.0):
+            self.assertEqual(cache.get("a"), 1)
+    
+    def test_approximate_size_counts_nested_objects(self):
+        """Test that nested containers contribute to the approximate size."""
+        self.assertGreater(approximate_size({"history": ["x" * 1000]}), 1000)
+
+class TestResponseCache(unittest.TestCase):
+    def test_key_depends_on_sampling_params(self):
+        """Test that keys differ when any sampling parameter differs."""
+        key = ResponseCache.make_key("Gemini", "gemini-pro", "system", "prompt", temperature=0.0)
+        
+        self.assertEqual(key, ResponseCache.make_key("Gemini", "gemini-pro", "system", "prompt", temperature=0.0))
+        self.assertNotEqual(key, ResponseCache.make_key("Gemini", "gemini-pro", "system", "prompt", temperature=0.1))
+        self.assertNotEqual(key, ResponseCache.make_key("Gemini", "gemini-pro", "other", "prompt", temperature=0.0))
+    
+    def test_temperature_threshold(self):
+        """Test that only low temperature requests are cacheable."""
+        cache = ResponseCache(max_temperature=0.3)
+        
+        self.assertTrue(cache.is_cacheable(0.0))
+        self.assertTrue(cache.is_cacheable(0.3))
+        self.assertFalse(cache.is_cacheable(0.7))
+    
+    def test_disk_tier_survives_new_instance(self):
+        """Test that completions are served from disk after a restart."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "responses.db")
+            
+            first = ResponseCache(disk_path=path)
+            first.set("key", "cached response")
+            first.disk.close()
+            
+            second = ResponseCache(disk_path=path)
+            self.assertEqual(second.get("key"), "cached response")
+            self.assertEqual(second.get("key"), "cached response")
+            second.disk.close()
+            
+            stats = second.get_stats()
+            self.assertEqual(stats["disk_hits"], 1)
+            self.assertEqual(stats["hits"], 2)
+            self.assertEqual(stats["misses"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
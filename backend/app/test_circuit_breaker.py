@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import patch
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        """Test that the circuit opens once the failure threshold is reached."""
+        breaker = CircuitBreaker("Gemini", failure_threshold=2, reset_timeout=30)
+        
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        self.assertEqual(breaker.get_stats()["rejected"], 1)
+    
+    def test_success_resets_failure_count(self):
+        """Test that a success between failures keeps the circuit closed."""
+        breaker = CircuitBreaker("Gemini", failure_threshold=2)
+        
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    
+    def test_half_open_allows_one_trial_call(self):
+        """Test that a half-open circuit admits one trial call and closes on success."""
+        breaker = CircuitBreaker("Gemini", failure_threshold=1, reset_timeout=30)
+        
+        with patch("time.monotonic", return_value=100.0):
+            breaker.record_failure()
+        
+        with patch("time.monotonic", return_value=131.0):
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            breaker.before_call()
+            with self.assertRaises(CircuitOpenError):
+                breaker.before_call()
+            
+            breaker.record_success()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    
+    def test_released_trial_call_admits_another(self):
+        """Test that a trial call given back without an outcome lets the next call try."""
+        breaker = CircuitBreaker("Gemini", failure_threshold=1, reset_timeout=30)
+        
+        with patch("time.monotonic", return_value=100.0):
+            breaker.record_failure()
+        
+        with patch("time.monotonic", return_value=131.0):
+            breaker.before_call()
+            breaker.release()
+            breaker.before_call()
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+    
+    def test_half_open_failure_reopens(self):
+        """Test that a failed trial call opens the circuit again."""
+        breaker = CircuitBreaker("Gemini", failure_threshold=3, reset_timeout=30)
+        
+        with patch("time.monotonic", return_value=100.0):
+            for _ in range(3):
+                breaker.record_failure()
+        
+        with patch("time.monotonic", return_value=131.0):
+            breaker.before_call()
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        
+        self.assertEqual(breaker.get_stats()["opened"], 2)
+
+if __name__ == '__main__':
+    unittest.main()
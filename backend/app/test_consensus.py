@@ -0,0 +1,78 @@
+import unittest
+from app.services.consensus import ConsensusDetector, shingles, similarity
+
+class TestConsensusDetector(unittest.TestCase):
+    def setUp(self):
+        self.detector = ConsensusDetector()
+    
+    def test_near_duplicates_agree(self):
+        """Test that responses differing only in case, punctuation and a word or two are merged."""
+        responses = [
+            "Bamboo is the most sustainable material for the shoes, since it grows quickly and is biodegradable.",
+            "bamboo is the most sustainable material for the shoes since it grows quickly and is fully biodegradable!",
+            "Bamboo is the most sustainable material for the shoes, since it grows quickly and is biodegradable"
+        ]
+        
+        consensus = self.detector.check(responses)
+        
+        self.assertTrue(consensus.agreed)
+        self.assertEqual(consensus.merged, responses[0])
+    
+    def test_templated_disagreement_is_escalated(self):
+        """Test that answers sharing their wording but not their conclusion are not merged."""
+        consensus = self.detector.check([
+            "We should use approach A because it is more efficient.",
+            "We should use approach B because it is more reliable."
+        ])
+        
+        self.assertFalse(consensus.agreed)
+        self.assertIsNone(consensus.merged)
+    
+    def test_contradictions_are_escalated(self):
+        """Test that answers reaching opposite conclusions are escalated, however much wording they share."""
+        approve = ("After reviewing the rollout plan, the load test results and the rollback steps, the migration "
+                   "is safe to run during business hours and the team should proceed with it this week.")
+        refuse = ("After reviewing the rollout plan, the load test results and the rollback steps, the migration "
+                  "is not safe to run during business hours and the team should not proceed with it this week.")
+        self.assertGreaterEqual(similarity(shingles(approve), shingles(refuse)), 0.5)
+        
+        consensus = self.detector.check([approve, refuse])
+        
+        self.assertFalse(consensus.agreed)
+        self.assertIsNone(consensus.merged)
+    
+    def test_negations_and_numbers_must_match(self):
+        """Test that near-duplicates differing in one negation or one figure are escalated."""
+        plan = ("The launch campaign for the new eco-friendly shoes should start in March with three "
+                "influencers, a budget of 20000 dollars and a pop-up store in the city centre for two weeks.")
+        negated = plan.replace("should start", "shouldn't start")
+        changed = plan.replace("20000", "50000")
+        for other in (negated, changed):
+            self.assertGreaterEqual(similarity(shingles(plan), shingles(other)), self.detector.threshold)
+            self.assertFalse(self.detector.check([plan, other]).agreed)
+        
+        self.assertTrue(self.detector.check([plan, plan.replace("pop-up store", "pop-up shop")]).agreed)
+    
+    def test_merge_is_deterministic(self):
+        """Test that the same responses in any order merge to the same answer."""
+        responses = [
+            "Use recycled plastic for the soles and organic cotton for the upper.",
+            "Use recycled plastic for the soles and organic cotton for the upper part.",
+            "use recycled plastic for the soles and organic cotton for the upper"
+        ]
+        
+        merged = {self.detector.check(order).merged for order in (responses, responses[::-1], responses[1:] + responses[:1])}
+        
+        self.assertEqual(len(merged), 1)
+    
+    def test_stats_report_the_fast_path(self):
+        """Test that agreements and escalations are counted."""
+        self.detector.check(["Yes.", "yes"])
+        self.detector.check(["Yes.", "No."])
+        
+        stats = self.detector.get_stats()
+        self.assertEqual((stats["agreed"], stats["escalated"]), (1, 1))
+        self.assertEqual(stats["fast_path_rate"], 0.5)
+
+if __name__ == "__main__":
+    unittest.main()
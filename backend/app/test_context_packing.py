@@ -0,0 +1,51 @@
+import unittest
+from app.services.context_packing import pack_turns
+from app.services.tokenization import count_tokens
+
+TURNS = [f"Human: Question number {i} about the project plan\nAI: Answer number {i} with some detail" for i in range(50)]
+
+class TestContextPacking(unittest.TestCase):
+    def test_everything_fits(self):
+        """Test that a short history is kept whole."""
+        packed = pack_turns(TURNS[:3], 10000)
+        
+        self.assertEqual(packed.turns, TURNS[:3])
+        self.assertEqual(packed.dropped, 0)
+        self.assertEqual(packed.text, "\n".join(TURNS[:3]))
+    
+    def test_oldest_turns_are_dropped_first(self):
+        """Test that the newest turns that fit the budget are kept."""
+        budget = 200
+        packed = pack_turns(TURNS, budget)
+        
+        self.assertGreater(packed.dropped, 0)
+        self.assertEqual(packed.turns, TURNS[packed.dropped:])
+        self.assertLessEqual(count_tokens(packed.text), budget)
+        self.assertEqual(packed.tokens, count_tokens(packed.text))
+        
+        # One more turn would not have fit
+        self.assertGreater(count_tokens("\n".join(TURNS[packed.dropped - 1:])), budget)
+    
+    def test_dropped_turns_are_summarized(self):
+        """Test that a summary of the dropped turns leads the packed history."""
+        summarized = []
+        
+        def summarize(turns, max_tokens):
+            summarized.extend(turns)
+            return "Summary: questions about the project plan"
+        
+        packed = pack_turns(TURNS, 300, summarize=summarize, summary_tokens=50)
+        
+        self.assertEqual(summarized, TURNS[:packed.dropped])
+        self.assertTrue(packed.text.startswith("Summary:"))
+        self.assertLessEqual(count_tokens(packed.text), 300)
+    
+    def test_no_budget(self):
+        """Test that nothing is kept when the fixed prompt fills the window."""
+        packed = pack_turns(TURNS, -5)
+        
+        self.assertEqual(packed.turns, [])
+        self.assertEqual(packed.text, "")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading
+import unittest
+from app.services.tokenization import count_tokens
+from app.services.conversation_memory import (
+    LastTurnsStrategy, TokenWindowStrategy, RollingSummaryStrategy, create_memory_strategy, message_text
+)
+
+class Message:
+    def __init__(self, type, content):
+        self.type = type
+        self.content = content
+
+def conversation(turns):
+    messages = []
+    for turn in range(turns):
+        messages.append(Message("human", f"question {turn} " + "word " * 20))
+        messages.append(Message("ai", f"answer {turn} " + "word " * 40))
+    return messages
+
+class TestConversationMemory(unittest.TestCase):
+    def test_last_k_keeps_whole_turns(self):
+        """Test that the last k exchanges are kept."""
+        kept = LastTurnsStrategy(k=3).prune(conversation(10))
+        
+        self.assertEqual(len(kept), 6)
+        self.assertTrue(kept[0].content.startswith("question 7"))
+    
+    def test_token_window_stays_within_budget(self):
+        """Test that the oldest messages are dropped to fit the token budget."""
+        strategy = TokenWindowStrategy(max_tokens=300)
+        kept = strategy.prune(conversation(50))
+        
+        self.assertTrue(kept)
+        self.assertLessEqual(sum(count_tokens(message_text(message)) for message in kept), 300)
+        self.assertTrue(kept[-1].content.startswith("answer 49"))
+        self.assertEqual(strategy.prune(kept), kept)
+    
+    def test_summary_is_refreshed_in_background(self):
+        """Test that pruning doesn't wait for the summary and every pruned message reaches it."""
+        release = threading.Event()
+        summarized = []
+        
+        def summarize(summary, lines):
+            release.wait(5)
+            summarized.extend(lines)
+            return f"{len(summarized)} messages"
+        
+        strategy = RollingSummaryStrategy(summarize, max_tokens=300)
+        messages = conversation(50)
+        kept = strategy.prune(messages)
+        kept = strategy.prune(kept + conversation(60)[100:])
+        self.assertIsNone(strategy.summary)
+        
+        release.set()
+        self.assertTrue(strategy.wait(5))
+        self.assertEqual(len(summarized), 50 * 2 + 20 - len(kept))
+        self.assertEqual(strategy.summary, f"{len(summarized)} messages")
+    
+    def test_failed_summary_keeps_previous(self):
+        """Test that a summarizer error leaves the summary as it was."""
+        def summarize(summary, lines):
+            raise RuntimeError("provider down")
+        
+        strategy = RollingSummaryStrategy(summarize, max_tokens=100)
+        strategy.summary = "earlier"
+        strategy.prune(conversation(20))
+        
+        self.assertTrue(strategy.wait(5))
+        self.assertEqual(strategy.summary, "earlier")
+    
+    def test_unknown_strategy_is_rejected(self):
+        """Test that strategies are created by name."""
+        self.assertIsInstance(create_memory_strategy("last_k", k=2), LastTurnsStrategy)
+        with self.assertRaises(ValueError):
+            create_memory_strategy("everything")
+
+if __name__ == "__main__":
+    unittest.main()
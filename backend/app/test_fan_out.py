@@ -0,0 +1,66 @@
+import time
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from app.services.fan_out import FanOut
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+    
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+    
+    def test_wait_is_the_slowest_call_not_the_sum(self):
+        """Test that concurrent calls are gathered in about the time of the slowest."""
+        futures = {agent: self.executor.submit(time.sleep, 0.2) for agent in range(4)}
+        
+        gathered = FanOut().gather(futures)
+        
+        self.assertEqual(set(gathered.results), {0, 1, 2, 3})
+        self.assertLess(gathered.elapsed, 0.6)
+    
+    def test_quorum_returns_before_stragglers(self):
+        """Test that gathering stops once a quorum succeeded and reports the rest as pending."""
+        release = threading.Event()
+        futures = {
+            "fast": self.executor.submit(lambda: "a"),
+            "also fast": self.executor.submit(lambda: "b"),
+            "slow": self.executor.submit(lambda: release.wait(5) and "c")
+        }
+        
+        gathered = FanOut(quorum=2).gather(futures)
+        release.set()
+        
+        self.assertEqual(gathered.results, {"fast": "a", "also fast": "b"})
+        self.assertEqual(gathered.pending, ["slow"])
+    
+    def test_deadline_keeps_what_arrived(self):
+        """Test that a deadline returns the answers so far and counts the late calls."""
+        release = threading.Event()
+        fan_out = FanOut(deadline=0.1)
+        futures = {
+            "fast": self.executor.submit(lambda: "a"),
+            "slow": self.executor.submit(lambda: release.wait(5) and "b")
+        }
+        
+        gathered = fan_out.gather(futures)
+        release.set()
+        
+        self.assertEqual(gathered.results, {"fast": "a"})
+        self.assertEqual(gathered.pending, ["slow"])
+        self.assertEqual(fan_out.get_stats()["timed_out"], 1)
+        self.assertEqual(fan_out.get_stats()["late"], 1)
+    
+    def test_errors_are_collected_separately(self):
+        """Test that a failing call is reported without failing the fan-out."""
+        futures = {"ok": self.executor.submit(lambda: "a"), "broken": self.executor.submit(lambda: 1 / 0)}
+        
+        gathered = FanOut().gather(futures)
+        
+        self.assertEqual(gathered.results, {"ok": "a"})
+        self.assertIsInstance(gathered.errors["broken"], ZeroDivisionError)
+        self.assertEqual(gathered.pending, [])
+
+if __name__ == "__main__":
+    unittest.main()
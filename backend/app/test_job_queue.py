@@ -0,0 +1,169 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from app.services.job_queue import Job, JobQueue, SQLiteJobBackend
+
+def blocked_queue(backend=None):
+    """A one-worker queue whose worker is held until the returned event is set."""
+    job_queue = JobQueue(backend=backend, workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    job_queue.register("block", lambda payload: (started.set(), release.wait(5)))
+    job_queue.submit("block", user_id="holder")
+    started.wait(5)
+    return job_queue, release
+
+class TestJobQueue(unittest.TestCase):
+    def test_interactive_jobs_run_before_background(self):
+        """Test that chat waiting in the queue goes ahead of queued background work."""
+        job_queue, release = blocked_queue()
+        order = []
+        job_queue.register("record", order.append)
+        
+        background = [job_queue.submit("record", f"summary {n}", user_id=1, job_class="background") for n in range(3)]
+        chat = job_queue.submit("record", "chat", user_id=2, job_class="interactive")
+        release.set()
+        
+        for future in background + [chat]:
+            future.result(5)
+        self.assertEqual(order[0], "chat")
+        job_queue.shutdown()
+    
+    def test_tiers_share_workers_by_weight(self):
+        """Test that a pro user gets four turns for every turn of a free user."""
+        job_queue, release = blocked_queue()
+        order = []
+        job_queue.register("record", order.append)
+        
+        futures = [job_queue.submit("record", "free", user_id="f", tier="free") for _ in range(10)]
+        futures += [job_queue.submit("record", "pro", user_id="p", tier="pro") for _ in range(10)]
+        release.set()
+        
+        for future in futures:
+            future.result(5)
+        self.assertEqual(order[:10].count("pro"), 8)
+        job_queue.shutdown()
+    
+    def test_one_users_burst_does_not_starve_others(self):
+        """Test that a user with a long backlog takes turns with a newcomer of the same tier."""
+        job_queue, release = blocked_queue()
+        order = []
+        job_queue.register("record", order.append)
+        
+        futures = [job_queue.submit("record", "busy", user_id="busy") for _ in range(20)]
+        futures.append(job_queue.submit("record", "newcomer", user_id="newcomer"))
+        release.set()
+        
+        for future in futures:
+            future.result(5)
+        self.assertLess(order.index("newcomer"), 3)
+        job_queue.shutdown()
+    
+    def test_serial_key_keeps_jobs_in_order_across_users(self):
+        """Test that jobs sharing a serial key run one at a time in order, whichever users sent them."""
+        job_queue = JobQueue(workers=3)
+        lock = threading.Lock()
+        running = {}
+        overlapped = []
+        order = []
+        
+        def record(payload):
+            serial_key, number = payload
+            with lock:
+                running[serial_key] = running.get(serial_key, 0) + 1
+                overlapped.append(running[serial_key] > 1)
+                order.append(payload)
+            time.sleep(0.02)
+            with lock:
+                running[serial_key] -= 1
+        
+        job_queue.register("record", record)
+        
+        # Later jobs of a pro user don't overtake a free user's earlier ones in the same sandbox
+        futures = [job_queue.submit("record", ["sandbox", number], user_id=("free", "pro")[number % 2],
+                                    tier=("free", "pro")[number % 2], serial_key="sandbox")
+                   for number in range(5)]
+        other = job_queue.submit("record", ["other", 0], user_id="free", serial_key="other")
+        
+        other.result(5)
+        self.assertFalse(all(future.done() for future in futures))
+        for future in futures:
+            future.result(5)
+        
+        self.assertEqual([number for serial_key, number in order if serial_key == "sandbox"], list(range(5)))
+        self.assertFalse(any(overlapped))
+        self.assertEqual(job_queue.get_serial_depths(), {})
+        self.assertEqual(job_queue.get_user_depths(), {})
+        job_queue.shutdown()
+    
+    def test_busy_serial_key_does_not_hold_up_its_users_other_jobs(self):
+        """Test that a user's job waiting behind a busy serial key lets their other jobs run."""
+        job_queue = JobQueue(workers=2)
+        started = threading.Event()
+        release = threading.Event()
+        job_queue.register("block", lambda payload: (started.set(), release.wait(5)))
+        order = []
+        job_queue.register("record", order.append)
+        
+        job_queue.submit("block", user_id="other", serial_key="a")
+        started.wait(5)
+        behind = job_queue.submit("record", "a", user_id="user", serial_key="a")
+        elsewhere = job_queue.submit("record", "b", user_id="user", serial_key="b")
+        
+        elsewhere.result(5)
+        self.assertFalse(behind.done())
+        self.assertEqual(job_queue.get_serial_depths(), {"a": 2})
+        
+        release.set()
+        behind.result(5)
+        self.assertEqual(order, ["b", "a"])
+        job_queue.shutdown()
+    
+    def test_handler_errors_reach_the_caller(self):
+        """Test that a failing job fails its future and is counted."""
+        job_queue = JobQueue(workers=1)
+        job_queue.register("fail", lambda payload: 1 / 0)
+        
+        with self.assertRaises(ZeroDivisionError):
+            job_queue.submit("fail").result(5)
+        self.assertEqual(job_queue.get_stats()["interactive_failed"], 1)
+        job_queue.shutdown()
+    
+    def test_sqlite_backend_keeps_jobs_across_restarts(self):
+        """Test that pending jobs in the persistent backend run after a new queue starts."""
+        path = os.path.join(tempfile.mkdtemp(), "jobs.db")
+        
+        # A queue whose process dies before its workers get to the job
+        JobQueue(backend=SQLiteJobBackend(path), workers=0).submit("record", {"message": "hello"}, user_id=7, tier="pro")
+        self.assertEqual(len(SQLiteJobBackend(path).load()), 1)
+        
+        done = threading.Event()
+        received = []
+        restarted = JobQueue(backend=SQLiteJobBackend(path), workers=1, handlers={
+            "record": lambda payload: (received.append(payload), done.set())
+        })
+        
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [{"message": "hello"}])
+        restarted.shutdown()
+        self.assertEqual(SQLiteJobBackend(path).load(), [])
+    
+    def test_sqlite_backend_pops_each_job_once(self):
+        """Test that a job is removed when taken, so none is handed out twice."""
+        path = os.path.join(tempfile.mkdtemp(), "jobs.db")
+        backend = SQLiteJobBackend(path)
+        jobs = [Job("record", {"number": number}, user_id=7, serial_key="sandbox-1") for number in range(3)]
+        for job in jobs:
+            backend.push(job)
+        
+        other = SQLiteJobBackend(path)
+        self.assertEqual([job.payload["number"] for job in other.load()], [0, 1, 2])
+        taken = backend.pop(jobs[1].id)
+        self.assertEqual((taken.payload, taken.user_id, taken.serial_key), ({"number": 1}, 7, "sandbox-1"))
+        self.assertIsNone(other.pop(jobs[1].id))
+        self.assertEqual([job.id for job in other.load()], [jobs[0].id, jobs[2].id])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import threading
+import unittest
+from app.services.message_queue import WriteBehindQueue
+
+class TestWriteBehindQueue(unittest.TestCase):
+    def test_items_are_batched_in_order(self):
+        """Test that queued items are written in batches, in the order they were queued."""
+        written = []
+        release = threading.Event()
+        
+        def write(items):
+            release.wait(5)
+            written.append(list(items))
+        
+        queue = WriteBehindQueue(write, max_batch=50, max_delay=0)
+        for item in range(120):
+            queue.put(item)
+        release.set()
+        
+        self.assertTrue(queue.flush(5))
+        self.assertEqual([item for batch in written for item in batch], list(range(120)))
+        self.assertLess(len(written), 120)
+        self.assertTrue(all(len(batch) <= 50 for batch in written))
+        queue.close(5)
+    
+    def test_durable_put_waits_for_write(self):
+        """Test that the returned future completes once the item's batch is written."""
+        written = []
+        queue = WriteBehindQueue(written.extend, max_delay=0)
+        
+        queue.put("a").result(5)
+        
+        self.assertEqual(written, ["a"])
+        queue.close(5)
+    
+    def test_failed_batch_is_retried_then_reported(self):
+        """Test that a failing write is retried and its futures get the error."""
+        attempts = []
+        
+        def write(items):
+            attempts.append(items)
+            raise IOError("database unavailable")
+        
+        queue = WriteBehindQueue(write, max_delay=0, retries=2, retry_delay=0)
+        written = queue.put("a")
+        
+        with self.assertRaises(IOError):
+            written.result(5)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(queue.get_stats()["failed"], 1)
+        queue.close(5)
+    
+    def test_close_writes_pending_items(self):
+        """Test that closing the queue writes what is still queued."""
+        written = []
+        queue = WriteBehindQueue(written.extend, max_delay=1.0)
+        queue.put("a")
+        queue.put("b")
+        
+        self.assertTrue(queue.close(5))
+        self.assertEqual(written, ["a", "b"])
+        with self.assertRaises(RuntimeError):
+            queue.put("c")
+
+if __name__ == "__main__":
+    unittest.main()
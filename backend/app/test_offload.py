@@ -0,0 +1,75 @@
+import time
+import threading
+import unittest
+from concurrent.futures import TimeoutError
+from app.services.offload import OffloadPool, LoopLagMonitor
+
+class TestOffloadPool(unittest.TestCase):
+    def test_events_and_result_are_relayed_in_order(self):
+        """Test that published tokens reach the relay before the result."""
+        pool = OffloadPool(max_workers=2)
+        received = []
+        
+        def generate(publish, words):
+            for word in words:
+                publish(word)
+            return " ".join(words)
+        
+        task = pool.submit(generate, ["slow", "model"])
+        pool.relay(task, on_event=received.append, on_result=lambda result: received.append(("done", result)))
+        
+        self.assertEqual(received, ["slow", "model", ("done", "slow model")])
+        self.assertEqual(pool.get_stats()["completed"], 1)
+        pool.shutdown()
+    
+    def test_errors_are_relayed(self):
+        """Test that an exception in the worker reaches on_error."""
+        pool = OffloadPool()
+        errors = []
+        
+        def fail(publish):
+            raise ValueError("provider down")
+        
+        pool.relay(pool.submit(fail), on_error=errors.append)
+        
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertEqual(pool.get_stats()["failed"], 1)
+        pool.shutdown()
+    
+    def test_slow_task_times_out(self):
+        """Test that a call running past its timeout is reported without waiting for it."""
+        pool = OffloadPool(timeout=0.05)
+        release = threading.Event()
+        errors = []
+        
+        started = time.monotonic()
+        pool.relay(pool.submit(lambda publish: release.wait(5)), on_error=errors.append)
+        
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsInstance(errors[0], TimeoutError)
+        self.assertEqual(pool.get_stats()["timed_out"], 1)
+        release.set()
+        pool.shutdown()
+
+class TestLoopLagMonitor(unittest.TestCase):
+    def test_blocked_sleep_is_measured_as_lag(self):
+        """Test that the extra time a sleep took is recorded as a stall."""
+        monitor = LoopLagMonitor(interval=0.01, warn_after=0.02)
+        sleeps = []
+        
+        def sleep(seconds):
+            # The second wake-up comes 50 ms late, as if the loop were blocked
+            time.sleep(seconds + (0.05 if len(sleeps) == 1 else 0))
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                monitor.stop()
+        
+        monitor.run(sleep)
+        stats = monitor.get_stats()
+        
+        self.assertEqual(stats["samples"], 3)
+        self.assertEqual(stats["stalls"], 1)
+        self.assertGreaterEqual(stats["max_ms"], 40)
+
+if __name__ == "__main__":
+    unittest.main()
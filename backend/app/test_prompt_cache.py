@@ -0,0 +1,98 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from app.services.prompt_cache import PrefixCache, agent_prefix_owner
+
+LONG_PREFIX = "You are a meticulous reviewer. " * 400
+
+def make_provider(name="Gemini"):
+    provider = MagicMock()
+    provider.provider_name = name
+    provider.supports_prefix_caching = True
+    provider.min_prefix_cache_tokens = 1024
+    provider.create_prefix_cache.side_effect = lambda prefix, model, ttl: f"cachedContents/{len(prefix)}"
+    return provider
+
+class TestPrefixCache(unittest.TestCase):
+    def test_prefix_is_created_once_and_reused(self):
+        """Test that repeated requests reuse the handle."""
+        cache = PrefixCache()
+        provider = make_provider()
+        
+        first = cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        second = cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        
+        self.assertEqual(first, second)
+        self.assertEqual(provider.create_prefix_cache.call_count, 1)
+        self.assertEqual(cache.get_stats()["hits"], 1)
+    
+    def test_short_prefixes_are_not_cached(self):
+        """Test that prefixes below the provider minimum are sent in full."""
+        cache = PrefixCache()
+        provider = make_provider()
+        
+        self.assertIsNone(cache.get(provider, "gemini-pro", "agent:1", "Be brief."))
+        provider.create_prefix_cache.assert_not_called()
+    
+    def test_handle_is_renewed_near_expiry(self):
+        """Test that the TTL is extended once most of it has passed."""
+        cache = PrefixCache(ttl=100, renew_fraction=0.25)
+        provider = make_provider()
+        
+        with patch("time.monotonic", return_value=1000.0):
+            cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        with patch("time.monotonic", return_value=1050.0):
+            cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        provider.renew_prefix_cache.assert_not_called()
+        
+        with patch("time.monotonic", return_value=1080.0):
+            cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        provider.renew_prefix_cache.assert_called_once()
+        self.assertEqual(provider.create_prefix_cache.call_count, 1)
+    
+    def test_new_version_replaces_old_handle(self):
+        """Test that a changed prefix deletes the old version's handle."""
+        cache = PrefixCache()
+        provider = make_provider()
+        
+        old = cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        new = cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX + "Cite sources.")
+        
+        self.assertNotEqual(old, new)
+        provider.delete_prefix_cache.assert_called_once_with(old)
+        self.assertEqual(cache.get_stats()["entries"], 1)
+    
+    def test_invalidate_deletes_every_handle_of_the_owner(self):
+        """Test that invalidating an agent deletes its handles on all providers."""
+        cache = PrefixCache()
+        gemini = make_provider("Gemini")
+        anthropic = make_provider("Anthropic")
+        other = make_provider("Gemini")
+        
+        cache.get(gemini, "gemini-pro", agent_prefix_owner(1), LONG_PREFIX)
+        cache.get(anthropic, "claude-3-haiku-20240307", agent_prefix_owner(1), LONG_PREFIX)
+        cache.get(other, "gemini-pro", agent_prefix_owner(2), LONG_PREFIX)
+        
+        cache.invalidate(agent_prefix_owner(1))
+        
+        gemini.delete_prefix_cache.assert_called_once()
+        anthropic.delete_prefix_cache.assert_called_once()
+        other.delete_prefix_cache.assert_not_called()
+        self.assertEqual(cache.get_stats()["entries"], 1)
+    
+    def test_refused_prefix_is_not_retried_until_backoff(self):
+        """Test that a failed create is not repeated on every request."""
+        cache = PrefixCache(failure_backoff=60)
+        provider = make_provider()
+        provider.create_prefix_cache.side_effect = RuntimeError("too few tokens")
+        
+        with patch("time.monotonic", return_value=1000.0):
+            self.assertIsNone(cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX))
+            self.assertIsNone(cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX))
+        self.assertEqual(provider.create_prefix_cache.call_count, 1)
+        
+        with patch("time.monotonic", return_value=1061.0):
+            cache.get(provider, "gemini-pro", "agent:1", LONG_PREFIX)
+        self.assertEqual(provider.create_prefix_cache.call_count, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import asyncio
+import threading
+from app.services.request_coalescing import SingleFlight
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        """Test that concurrent calls with the same key run the function once."""
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+        
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do("key", fetch)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        
+        while single_flight.get_stats()["coalesced"] < 3:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(results, ["result"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(single_flight.get_stats()["in_flight"], 0)
+    
+    def test_errors_are_shared_and_not_remembered(self):
+        """Test that a failed call raises for its callers and is retried afterwards."""
+        single_flight = SingleFlight()
+        
+        def fail():
+            raise RuntimeError("upstream failed")
+        
+        with self.assertRaises(RuntimeError):
+            single_flight.do("key", fail)
+        
+        self.assertEqual(single_flight.do("key", lambda: "recovered"), "recovered")
+        self.assertEqual(single_flight.get_stats()["leaders"], 2)
+    
+    def test_stream_is_replayed_to_late_joiners(self):
+        """Test that a consumer joining mid-stream still receives every chunk."""
+        single_flight = SingleFlight()
+        opened = []
+        
+        def factory():
+            opened.append(1)
+            return iter(["a", "b", "c"])
+        
+        first = single_flight.stream("key", factory)
+        self.assertEqual(next(first), "a")
+        
+        second = single_flight.stream("key", factory)
+        
+        self.assertEqual(list(second), ["a", "b", "c"])
+        self.assertEqual(list(first), ["b", "c"])
+        self.assertEqual(len(opened), 1)
+    
+    def test_abandoned_stream_closes_source(self):
+        """Test that the upstream stream is closed once every consumer stops reading."""
+        single_flight = SingleFlight()
+        closed = []
+        
+        def source():
+            try:
+                yield "a"
+                yield "b"
+            finally:
+                closed.append(1)
+        
+        stream = single_flight.stream("key", source)
+        self.assertEqual(next(stream), "a")
+        stream.close()
+        
+        self.assertEqual(closed, [1])
+        self.assertEqual(single_flight.get_stats()["in_flight"], 0)
+    
+    def test_async_calls_share_one_task(self):
+        """Test that concurrent coroutines with the same key await one task."""
+        single_flight = SingleFlight()
+        calls = []
+        
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+        
+        async def burst():
+            return await asyncio.gather(*[single_flight.ado("key", fetch) for _ in range(3)])
+        
+        self.assertEqual(asyncio.run(burst()), ["result"] * 3)
+        self.assertEqual(len(calls), 1)
+
+if __name__ == '__main__':
+    unittest.main()
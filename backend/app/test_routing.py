@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import patch
+from app.services.routing import LatencyRouter, ModelMetrics
+
+class TestModelMetrics(unittest.TestCase):
+    def test_ewma_tracks_latency_and_errors(self):
+        """Test that averages are seeded by the first sample and then smoothed."""
+        metrics = ModelMetrics(alpha=0.5)
+        
+        metrics.record(latency=1.0)
+        metrics.record(latency=3.0)
+        metrics.record(error=True)
+        
+        self.assertEqual(metrics.latency, 2.0)
+        self.assertEqual(metrics.error_rate, 0.5)
+        self.assertEqual(metrics.requests, 3)
+        self.assertEqual(metrics.latency_percentile(100), 3.0)
+
+class TestLatencyRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = LatencyRouter(alpha=0.5, max_error_rate=0.5, recovery_time=30)
+        self.candidates = [("Gemini", "gemini-flash-2.0"), ("DeepSeek", "deepseek-chat")]
+    
+    def test_prefers_fastest_provider(self):
+        """Test that the candidate with the lowest latency is chosen."""
+        self.router.record("Gemini", "gemini-flash-2.0", latency=2.0)
+        self.router.record("DeepSeek", "deepseek-chat", latency=0.5)
+        
+        self.assertEqual(self.router.choose(self.candidates), ("DeepSeek", "deepseek-chat"))
+        
+        decision = self.router.get_decisions()[-1]
+        self.assertEqual(decision["reason"], "fastest")
+        self.assertEqual(len(decision["candidates"]), 2)
+    
+    def test_streaming_uses_time_to_first_token(self):
+        """Test that streaming requests are routed by time to first token."""
+        self.router.record("Gemini", "gemini-flash-2.0", latency=2.0, time_to_first_token=0.1)
+        self.router.record("DeepSeek", "deepseek-chat", latency=0.5, time_to_first_token=0.4)
+        
+        self.assertEqual(self.router.choose(self.candidates, streaming=True), ("Gemini", "gemini-flash-2.0"))
+    
+    def test_unhealthy_provider_is_skipped_until_recovery(self):
+        """Test that failing providers are avoided until the recovery time passes."""
+        with patch("time.monotonic", return_value=100.0):
+            self.router.record("Gemini", "gemini-flash-2.0", latency=0.1)
+            self.router.record("DeepSeek", "deepseek-chat", latency=1.0)
+            self.router.record("Gemini", "gemini-flash-2.0", rate_limited=True)
+            self.router.record("Gemini", "gemini-flash-2.0", rate_limited=True)
+            
+            self.assertEqual(self.router.choose(self.candidates), ("DeepSeek", "deepseek-chat"))
+            self.assertFalse(self.router.get_metrics()["Gemini"]["gemini-flash-2.0"]["healthy"])
+        
+        with patch("time.monotonic", return_value=131.0):
+            self.assertEqual(self.router.choose(self.candidates), ("Gemini", "gemini-flash-2.0"))
+    
+    def test_pinned_sandbox_keeps_its_provider(self):
+        """Test that a pinned sandbox is routed to its provider while it is healthy."""
+        self.router.record("Gemini", "gemini-flash-2.0", latency=2.0)
+        self.router.record("DeepSeek", "deepseek-chat", latency=0.5)
+        self.router.pin("sandbox-1", "Gemini")
+        
+        self.assertEqual(self.router.choose(self.candidates, pin_key="sandbox-1"), ("Gemini", "gemini-flash-2.0"))
+        self.assertEqual(self.router.choose(self.candidates, pin_key="sandbox-2"), ("DeepSeek", "deepseek-chat"))
+        
+        self.router.record("Gemini", "gemini-flash-2.0", error=True)
+        self.router.record("Gemini", "gemini-flash-2.0", error=True)
+        
+        self.assertEqual(self.router.choose(self.candidates, pin_key="sandbox-1"), ("DeepSeek", "deepseek-chat"))
+        self.assertEqual(self.router.get_decisions()[-1]["reason"], "pin_unavailable")
+    
+    def test_no_candidates(self):
+        """Test that routing without candidates raises ValueError."""
+        with self.assertRaises(ValueError):
+            self.router.choose([])
+
+if __name__ == '__main__':
+    unittest.main()
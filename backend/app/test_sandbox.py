@@ -1,8 +1,13 @@
 import pytest
+from unittest.mock import MagicMock
+from sqlalchemy import event
 from app import create_app
 from app.models.database import db_session, init_db
 from app.models.sandbox import Sandbox, AgentSession, Message
+from app.services.sandbox_manager import SandboxManager
 import json
+import time
+import datetime
 
 @pytest.fixture
 def client():
@@ -63,6 +68,39 @@ def agent_id(client, auth_token):
     data = json.loads(response.data)
     return data['id']
 
+@pytest.fixture
+def manager(client):
+    """Create a sandbox manager whose chains are stand-ins, so no model is called."""
+    manager = SandboxManager()
+    manager.ai_service = MagicMock()
+    manager.ai_service.create_agent_chain.side_effect = lambda *args, **kwargs: MagicMock()
+    manager.ai_service.create_manager_chain.side_effect = lambda *args, **kwargs: MagicMock()
+    yield manager
+    manager.close()
+
+def create_sandbox(client, auth_token, agent_ids=()):
+    """Create a sandbox session with the given agents and return its ID."""
+    response = client.post('/api/sandbox/sessions', 
+        json={
+            'name': 'Test Session',
+            'description': 'A test sandbox session',
+            'mode': 'collaborative'
+        },
+        headers={'Authorization': f'Bearer {auth_token}'}
+    )
+    sandbox_id = json.loads(response.data)['id']
+    
+    for agent_id in agent_ids:
+        client.post(f'/api/sandbox/sessions/{sandbox_id}/agents',
+            json={
+                'agent_id': agent_id,
+                'is_manager': False
+            },
+            headers={'Authorization': f'Bearer {auth_token}'}
+        )
+    
+    return sandbox_id
+
 def test_create_sandbox(client, auth_token):
     """Test sandbox session creation."""
     response = client.post('/api/sandbox/sessions', 
@@ -195,3 +233,170 @@ def test_remove_agent_from_sandbox(client, auth_token, agent_id):
     )
     data = json.loads(response.data)
     assert len(data['agents']) == 0
+
+def test_agent_edit_invalidates_cached_chain(client, auth_token, agent_id, manager):
+    """Test that editing an agent makes the manager rebuild the chain cached for it."""
+    sandbox_id = create_sandbox(client, auth_token, [agent_id])
+    
+    chain = manager.get_agent_chain(agent_id, sandbox_id)
+    assert chain is not None
+    assert manager.get_agent_chain(agent_id, sandbox_id) is chain
+    
+    # Edit the agent
+    response = client.put(f'/api/agents/{agent_id}', 
+        json={
+            'name': 'Edited Agent',
+            'role': 'Testing',
+            'personality': 'Analytical',
+            'specialization': 'Unit Testing',
+            'system_instructions': 'You are an edited test agent.'
+        },
+        headers={'Authorization': f'Bearer {auth_token}'}
+    )
+    assert response.status_code == 200
+    
+    # The edit bumped the version, so the old chain is stale
+    rebuilt = manager.get_agent_chain(agent_id, sandbox_id)
+    assert rebuilt is not None
+    assert rebuilt is not chain
+    assert manager.stale_chains['agent_chains'] == 1
+    assert manager.get_agent_chain(agent_id, sandbox_id) is rebuilt
+
+def test_membership_change_invalidates_manager_chain(client, auth_token, agent_id, manager):
+    """Test that an agent joining or leaving through the ORM makes the manager chain stale."""
+    sandbox_id = create_sandbox(client, auth_token)
+    
+    chain = manager.get_manager_chain(sandbox_id)
+    assert chain is not None
+    
+    agent_session = AgentSession(sandbox_id=sandbox_id, agent_id=agent_id, is_manager=False)
+    db_session.add(agent_session)
+    db_session.commit()
+    
+    joined = manager.get_manager_chain(sandbox_id)
+    assert joined is not chain
+    
+    db_session.delete(agent_session)
+    db_session.commit()
+    
+    assert manager.get_manager_chain(sandbox_id) is not joined
+    assert manager.stale_chains['manager_chains'] == 2
+
+def test_rebuilt_chain_restores_recent_exchanges(client, auth_token, agent_id, manager):
+    """Test that a chain rebuilt after eviction gets back its agent's exchanges in order."""
+    sandbox_id = create_sandbox(client, auth_token, [agent_id])
+    other_agent_id = agent_id + 1
+    
+    # A conversation where another agent answers one of the questions
+    started = datetime.datetime(2025, 4, 20, 12, 0, 0)
+    history = [
+        ('user', 1, 'First question'),
+        ('agent', agent_id, 'First answer'),
+        ('user', 1, 'Question for the other agent'),
+        ('agent', other_agent_id, 'Answer from the other agent'),
+        ('user', 1, 'Second question'),
+        ('agent', agent_id, 'Second answer')
+    ]
+    db_session.add_all([
+        Message(sandbox_id=sandbox_id, sender_type=sender_type, sender_id=sender_id, content=content,
+                created_at=started + datetime.timedelta(seconds=index))
+        for index, (sender_type, sender_id, content) in enumerate(history)
+    ])
+    db_session.commit()
+    
+    chain = manager.get_agent_chain(agent_id, sandbox_id)
+    assert chain is not None
+    
+    # Evict the chain and rebuild it
+    manager.agent_chains.delete((sandbox_id, agent_id))
+    manager.ai_service.restore_memory.reset_mock()
+    rebuilt = manager.get_agent_chain(agent_id, sandbox_id)
+    assert rebuilt is not chain
+    
+    manager.ai_service.restore_memory.assert_called_once_with(rebuilt, [
+        ('First question', 'First answer'),
+        ('Second question', 'Second answer')
+    ])
+
+def test_chain_cache_eviction_and_rebuild(client, auth_token, agent_id, manager, monkeypatch):
+    """Test that chains evicted for space or idleness are rebuilt on their next use."""
+    response = client.post('/api/agents/', 
+        json={
+            'name': 'Second Agent',
+            'role': 'Testing',
+            'personality': 'Curious',
+            'specialization': 'Integration Testing',
+            'system_instructions': 'You are a second test agent.'
+        },
+        headers={'Authorization': f'Bearer {auth_token}'}
+    )
+    second_agent_id = json.loads(response.data)['id']
+    sandbox_id = create_sandbox(client, auth_token, [agent_id, second_agent_id])
+    
+    # Room for one chain, dropped after 0.2 seconds without use
+    monkeypatch.setenv('SANDBOX_AGENT_CHAINS_MAX_ENTRIES', '1')
+    monkeypatch.setenv('SANDBOX_AGENT_CHAINS_IDLE_TTL', '0.2')
+    manager.agent_chains = manager._create_chain_cache('AGENT_CHAINS')
+    
+    first = manager.get_agent_chain(agent_id, sandbox_id)
+    assert manager.get_agent_chain(agent_id, sandbox_id) is first
+    
+    # The second agent's chain pushes out the least recently used one
+    second = manager.get_agent_chain(second_agent_id, sandbox_id)
+    assert manager.get_cache_stats()['agent_chains']['evictions'] == 1
+    
+    rebuilt = manager.get_agent_chain(agent_id, sandbox_id)
+    assert rebuilt is not None
+    assert rebuilt is not first
+    assert manager.get_cache_stats()['agent_chains']['evictions'] == 2
+    
+    # An idle chain expires and is rebuilt too
+    time.sleep(0.3)
+    assert manager.get_agent_chain(agent_id, sandbox_id) is not rebuilt
+    assert manager.get_cache_stats()['agent_chains']['expirations'] == 1
+    assert manager.ai_service.create_agent_chain.call_count == 4
+
+def test_load_sandbox_context(client, auth_token, agent_id, manager):
+    """Test that a sandbox's context is loaded with one query, with or without agents."""
+    sandbox_id = create_sandbox(client, auth_token, [agent_id])
+    empty_sandbox_id = create_sandbox(client, auth_token)
+    
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    engine = db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        db_session.expire_all()
+        context = manager.load_sandbox_context(sandbox_id)
+        assert [agent.id for agent in context.agents] == [agent_id]
+        assert [session.agent_id for session in context.agent_sessions] == [agent_id]
+        assert context.sandbox.id == sandbox_id
+        assert len(statements) == 1
+        
+        del statements[:]
+        empty = manager.load_sandbox_context(empty_sandbox_id)
+        assert empty.sandbox.id == empty_sandbox_id
+        assert empty.agents == []
+        assert empty.agent_sessions == []
+        assert len(statements) == 1
+        
+        assert manager.load_sandbox_context(empty_sandbox_id + 1000) is None
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+def test_queued_messages_get_their_ids(client, auth_token):
+    """Test that a batch of queued messages is given the ids it was inserted with."""
+    sandbox_id = create_sandbox(client, auth_token)
+    messages = [
+        Message(sandbox_id=sandbox_id, sender_type='user', sender_id=1, content=f'Message {index}',
+                created_at=datetime.datetime.utcnow())
+        for index in range(3)
+    ]
+    
+    SandboxManager._write_messages(messages)
+    
+    assert all(message.id is not None for message in messages)
+    for message in messages:
+        assert db_session.query(Message).get(message.id).content == message.content
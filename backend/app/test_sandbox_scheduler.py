@@ -0,0 +1,71 @@
+import time
+import threading
+import unittest
+from app.services.sandbox_scheduler import SandboxScheduler
+
+class TestSandboxScheduler(unittest.TestCase):
+    def test_tasks_of_a_key_run_in_order_one_at_a_time(self):
+        """Test that a sandbox's messages are processed serially in submission order."""
+        scheduler = SandboxScheduler(max_workers=4, max_burst=2)
+        order = []
+        running = []
+        overlaps = []
+        
+        def task(item):
+            running.append(item)
+            overlaps.append(len(running) > 1)
+            time.sleep(0.001)
+            order.append(item)
+            running.remove(item)
+        
+        futures = [scheduler.submit("sandbox-1", task, item) for item in range(20)]
+        for future in futures:
+            future.result(5)
+        
+        self.assertEqual(order, list(range(20)))
+        self.assertFalse(any(overlaps))
+        scheduler.shutdown()
+    
+    def test_keys_run_in_parallel(self):
+        """Test that different sandboxes do not wait for each other."""
+        scheduler = SandboxScheduler(max_workers=2)
+        barrier = threading.Barrier(2, timeout=5)
+        
+        first = scheduler.submit("sandbox-1", barrier.wait)
+        second = scheduler.submit("sandbox-2", barrier.wait)
+        
+        first.result(5)
+        second.result(5)
+        scheduler.shutdown()
+    
+    def test_queue_depth_is_observable(self):
+        """Test that queued and running tasks are counted per sandbox."""
+        scheduler = SandboxScheduler(max_workers=1)
+        release = threading.Event()
+        
+        scheduler.submit("sandbox-1", release.wait, 5)
+        scheduler.submit("sandbox-1", lambda: None)
+        scheduler.submit("sandbox-2", lambda: None)
+        
+        self.assertEqual(scheduler.get_queue_depths()["sandbox-1"], 2)
+        release.set()
+        scheduler.shutdown()
+        self.assertEqual(scheduler.get_queue_depths(), {})
+        self.assertEqual(scheduler.get_stats()["completed"], 3)
+    
+    def test_errors_reach_the_caller_and_later_tasks_still_run(self):
+        """Test that a failing message does not block the sandbox's mailbox."""
+        scheduler = SandboxScheduler()
+        
+        def fail():
+            raise ValueError("bad message")
+        
+        failed = scheduler.submit("sandbox-1", fail)
+        
+        with self.assertRaises(ValueError):
+            failed.result(5)
+        self.assertEqual(scheduler.run("sandbox-1", lambda: "next"), "next")
+        scheduler.shutdown()
+
+if __name__ == "__main__":
+    unittest.main()
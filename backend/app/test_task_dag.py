@@ -0,0 +1,96 @@
+import time
+import threading
+import unittest
+from app.services.caching import LRUCache
+from app.services.task_dag import DagExecutor, parse_plan
+
+PLAN = """```json
+{"subtasks": [
+    {"id": "write", "agent": "Writer", "task": "Write it up", "depends_on": ["research", "numbers"]},
+    {"id": "research", "agent": "Researcher", "task": "Find sources", "depends_on": []},
+    {"id": "numbers", "agent": "Analyst", "task": "Crunch numbers"}
+]}
+```"""
+
+AGENTS = ["Researcher", "Analyst", "Writer"]
+
+class TestParsePlan(unittest.TestCase):
+    def test_dependencies_come_first(self):
+        """Test that a plan in a code block is parsed with every subtask after its dependencies."""
+        subtasks = parse_plan(PLAN, AGENTS)
+        
+        self.assertEqual([subtask.id for subtask in subtasks][-1], "write")
+        self.assertEqual(subtasks[-1].depends_on, ["research", "numbers"])
+    
+    def test_invalid_plans_are_rejected(self):
+        """Test that cycles, unknown agents, unknown dependencies and bad JSON raise ValueError."""
+        plans = [
+            '[{"id": "a", "agent": "Writer", "task": "x", "depends_on": ["b"]},'
+            ' {"id": "b", "agent": "Writer", "task": "y", "depends_on": ["a"]}]',
+            '[{"id": "a", "agent": "Nobody", "task": "x"}]',
+            '[{"id": "a", "agent": "Writer", "task": "x", "depends_on": ["missing"]}]',
+            'Sure! Here is the plan.'
+        ]
+        for plan in plans:
+            with self.assertRaises(ValueError):
+                parse_plan(plan, AGENTS)
+
+class TestDagExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = DagExecutor(max_workers=4, cache=LRUCache())
+    
+    def tearDown(self):
+        self.executor.shutdown()
+    
+    def test_independent_subtasks_run_in_parallel_and_pass_outputs(self):
+        """Test that independent subtasks overlap and dependents get their outputs."""
+        received = {}
+        
+        def run_subtask(subtask, inputs):
+            received[subtask.id] = inputs
+            time.sleep(0.2)
+            return f"{subtask.id} done"
+        
+        dag_run = self.executor.run(parse_plan(PLAN, AGENTS), run_subtask)
+        
+        self.assertEqual(received["write"], {"research": "research done", "numbers": "numbers done"})
+        self.assertEqual([subtask.id for subtask in dag_run.sinks()], ["write"])
+        self.assertLess(dag_run.elapsed, 0.55)
+        self.assertEqual(dag_run.timings["write"]["status"], "completed")
+        self.assertGreaterEqual(dag_run.timings["write"]["run_ms"], 150)
+    
+    def test_failed_subtask_skips_its_dependents(self):
+        """Test that a failure skips the subtasks depending on it but not the others."""
+        def run_subtask(subtask, inputs):
+            if subtask.id == "numbers":
+                raise RuntimeError("no data")
+            return subtask.id
+        
+        dag_run = self.executor.run(parse_plan(PLAN, AGENTS), run_subtask)
+        
+        self.assertEqual(dag_run.outputs, {"research": "research"})
+        self.assertIn("numbers", dag_run.errors)
+        self.assertEqual(dag_run.timings["write"]["status"], "skipped")
+    
+    def test_replan_reuses_unchanged_subtasks(self):
+        """Test that a re-plan only runs the subtasks whose task or inputs changed."""
+        calls = []
+        lock = threading.Lock()
+        
+        def run_subtask(subtask, inputs):
+            with lock:
+                calls.append(subtask.id)
+            return subtask.task
+        
+        self.executor.run(parse_plan(PLAN, AGENTS), run_subtask, scope="sandbox 1")
+        calls.clear()
+        
+        dag_run = self.executor.run(parse_plan(PLAN.replace("Write it up", "Write it shorter"), AGENTS),
+                                    run_subtask, scope="sandbox 1")
+        
+        self.assertEqual(calls, ["write"])
+        self.assertEqual(dag_run.timings["research"]["status"], "cached")
+        self.assertEqual(self.executor.get_stats()["cached"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
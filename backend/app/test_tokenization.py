@@ -0,0 +1,111 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+from app.services.tokenization import HeuristicEncoder, TokenCounter, model_family
+
+class TestHeuristicEncoder(unittest.TestCase):
+    def setUp(self):
+        self.encoder = HeuristicEncoder()
+    
+    def test_english_text(self):
+        """Test that English prose costs about a token per word."""
+        text = "The quick brown fox jumps over the lazy dog."
+        self.assertEqual(self.encoder.count(text), 10)
+    
+    def test_cjk_text_costs_a_token_per_character(self):
+        """Test that CJK text is not undercounted like len(text) // 4 does."""
+        text = "今日は良い天気です"
+        self.assertEqual(self.encoder.count(text), len(text))
+        self.assertGreater(self.encoder.count(text), len(text) // 4)
+    
+    def test_code_counts_symbols_and_indentation(self):
+        """Test that punctuation-heavy code costs more than prose of the same length."""
+        code = "def f(x):\n    return {'a': x[0], 'b': x[1]}\n"
+        prose = "a" * len(code)
+        self.assertGreater(self.encoder.count(code), self.encoder.count(prose))
+    
+    def test_empty_text(self):
+        """Test that empty text has no tokens."""
+        self.assertEqual(self.encoder.count(""), 0)
+
+class TestTokenCounter(unittest.TestCase):
+    def test_model_family(self):
+        """Test model family detection from provider and model names."""
+        self.assertEqual(model_family("OpenRouter", "openai/gpt-4o"), "openai")
+        self.assertEqual(model_family("Anthropic", "claude-3-haiku-20240307"), "claude")
+        self.assertEqual(model_family("Gemini", "gemini-1.5-flash"), "gemini")
+        self.assertEqual(model_family("DeepSeek", "deepseek-chat"), "deepseek")
+        self.assertIsNone(model_family("Custom", "unknown"))
+    
+    def test_counts_are_memoized(self):
+        """Test that repeated strings are only encoded once."""
+        counter = TokenCounter()
+        long_text = "system instructions " * 50
+        
+        with patch.object(counter.heuristic, "count", wraps=counter.heuristic.count) as mock_count:
+            first = counter.count(long_text, "Gemini")
+            second = counter.count(long_text, "Gemini")
+        
+        self.assertEqual(first, second)
+        self.assertEqual(mock_count.call_count, 1)
+        self.assertEqual(counter.get_stats()["cache"]["hits"], 1)
+    
+    def test_count_batch_encodes_only_uncached(self):
+        """Test that batch counting reuses cached counts."""
+        counter = TokenCounter()
+        counter.count("cached text", "Gemini")
+        
+        with patch.object(counter.heuristic, "count_batch", wraps=counter.heuristic.count_batch) as mock_batch:
+            counts = counter.count_batch(["cached text", "new text", ""], "Gemini")
+        
+        mock_batch.assert_called_once_with(["new text"])
+        self.assertEqual(counts, [counter.count("cached text", "Gemini"), counter.count("new text", "Gemini"), 0])
+    
+    @patch("app.services.tokenization.tiktoken", MagicMock())
+    def test_failed_vocabulary_load_is_retried_after_backoff(self):
+        """Test that a vocabulary that fails to download is estimated for a while, then retried."""
+        counter = TokenCounter()
+        encoder = MagicMock(name="cl100k_base")
+        
+        with patch("app.services.tokenization.TiktokenEncoder",
+                   side_effect=[OSError("offline"), encoder]) as mock_encoder, \
+             patch("time.monotonic", return_value=100.0):
+            self.assertIs(counter.encoder_for("DeepSeek"), counter.heuristic)
+            self.assertIs(counter.encoder_for("DeepSeek"), counter.heuristic)
+            self.assertEqual(mock_encoder.call_count, 1)
+        
+        with patch("app.services.tokenization.TiktokenEncoder", return_value=encoder), \
+             patch("time.monotonic", return_value=100.0 + TokenCounter.RETRY_BACKOFF):
+            self.assertIs(counter.encoder_for("DeepSeek"), encoder)
+    
+    @patch("app.services.tokenization.tiktoken", MagicMock())
+    def test_vocabulary_load_does_not_block_other_counts(self):
+        """Test that a slow vocabulary download is shared and doesn't hold up other models."""
+        counter = TokenCounter()
+        encoder = MagicMock(name="cl100k_base")
+        downloading = threading.Event()
+        release = threading.Event()
+        
+        def slow_download(name):
+            downloading.set()
+            release.wait(5)
+            return encoder
+        
+        with patch("app.services.tokenization.TiktokenEncoder", side_effect=slow_download) as mock_encoder:
+            loader = threading.Thread(target=counter.encoder_for, args=("DeepSeek",))
+            loader.start()
+            self.assertTrue(downloading.wait(5))
+            
+            self.assertEqual(counter.count("Hello there", "Gemini"), 2)
+            waiter_result = []
+            waiter = threading.Thread(target=lambda: waiter_result.append(counter.encoder_for("Grok")))
+            waiter.start()
+            release.set()
+            loader.join(5)
+            waiter.join(5)
+        
+        self.assertEqual(mock_encoder.call_count, 1)
+        self.assertEqual(waiter_result, [encoder])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.services.caching import LRUCache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Scripts written without spaces, where each character is roughly one token
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+
+_CJK_CHARACTER = re.compile(f"[{_CJK}]")
+
+_PIECE_PATTERN = re.compile(
+    rf"[{_CJK}]|[^\W\d_{_CJK}]+|\d+|\n|[ \t]+|[^\w\s]+|_+",
+    re.UNICODE
+)
+
+class HeuristicEncoder:
+    """Approximate BPE token counts for models without a local tokenizer.
+    
+    Text is split the way BPE pre-tokenizers split it, and each piece is
+    costed by kind: English words are about one token per five characters,
+    other alphabets about one per two, CJK about one per character, numbers
+    one per three digits and runs of indentation one token each.
+    """
+    
+    name = "heuristic"
+    
+    def count(self, text: str) -> int:
+        """Estimate the number of tokens in a string."""
+        tokens = 0
+        for match in _PIECE_PATTERN.finditer(text):
+            piece = match.group()
+            first = piece[0]
+            
+            if first == "\n":
+                tokens += 1
+            elif first in " \t":
+                # A single space is merged into the following word
+                tokens += 0 if piece == " " else 1
+            elif first.isdigit():
+                tokens += (len(piece) + 2) // 3
+            elif first.isalpha():
+                if _CJK_CHARACTER.match(piece):
+                    tokens += 1
+                elif piece.isascii():
+                    tokens += (len(piece) + 4) // 5
+                else:
+                    tokens += (len(piece) + 1) // 2
+            else:
+                tokens += (len(piece) + 1) // 2
+        
+        return tokens
+    
+    def count_batch(self, texts: Sequence[str]) -> List[int]:
+        """Estimate the number of tokens in each string."""
+        return [self.count(text) for text in texts]
+
+class TiktokenEncoder:
+    """Exact BPE token counts using a tiktoken encoding."""
+    
+    def __init__(self, encoding_name: str):
+        self.name = encoding_name
+        self.encoding = tiktoken.get_encoding(encoding_name)
+    
+    def count(self, text: str) -> int:
+        """Count the tokens in a string."""
+        # Special token strings in user text are counted as plain text, not rejected
+        return len(self.encoding.encode(text, disallowed_special=()))
+    
+    def count_batch(self, texts: Sequence[str]) -> List[int]:
+        """Count the tokens in each string, encoding them in parallel."""
+        return [len(tokens) for tokens in self.encoding.encode_batch(list(texts), disallowed_special=())]
+
+# (pattern matched against "provider/model", family, tiktoken encoding or None)
+MODEL_FAMILIES = [
+    (r"gpt-4o|\bo[13]\b|o[13]-", "openai", "o200k_base"),
+    (r"gpt-|openai", "openai", "cl100k_base"),
+    # DeepSeek and Grok use their own BPE vocabularies; cl100k is the closest public one
+    (r"deepseek", "deepseek", "cl100k_base"),
+    (r"grok", "grok", "cl100k_base"),
+    (r"claude|anthropic", "claude", None),
+    (r"gemini", "gemini", None),
+    (r"mistral|mixtral", "mistral", None),
+    (r"llama|falcon|pplx|perplexity|ollama|hugging", "llama", None),
+]
+
+def _family_spec(provider_name: str = None, model: str = None):
+    key = f"{provider_name or ''}/{model or ''}".lower()
+    for pattern, family, encoding in MODEL_FAMILIES:
+        if re.search(pattern, key):
+            return family, encoding
+    
+    return None, None
+
+def model_family(provider_name: str = None, model: str = None) -> Optional[str]:
+    """Get the tokenizer family of a provider's model, if it is known."""
+    return _family_spec(provider_name, model)[0]
+
+class TokenCounter:
+    """Count tokens with the encoder of each model family.
+    
+    Counts are memoized, since the same system instructions and prompt
+    templates are counted on every request. Families without a local
+    tokenizer, or without tiktoken installed, use HeuristicEncoder.
+    
+    A tiktoken vocabulary is loaded once, by the first caller that needs it.
+    If it can't be loaded, as when tiktoken can't download it, counts are
+    estimated until a retry after a backoff.
+    """
+    
+    # Strings longer than this are cached under a digest rather than verbatim
+    MAX_VERBATIM_KEY = 256
+    # Seconds before retrying a vocabulary that failed to load, doubling up to the maximum
+    RETRY_BACKOFF = 30.0
+    MAX_RETRY_BACKOFF = 3600.0
+    # How long a caller waits for another thread loading the same vocabulary
+    LOAD_WAIT = 10.0
+    
+    def __init__(self, cache_size: int = 4096):
+        self.cache = LRUCache(max_entries=cache_size, sizeof=None)
+        self.heuristic = HeuristicEncoder()
+        self._encoders = {}
+        self._loading = {}  # encoding name -> Future of the load in progress
+        self._failures = {}  # encoding name -> (failed loads, monotonic time of the next retry)
+        self._lock = threading.Lock()
+    
+    def encoder_for(self, provider_name: str = None, model: str = None):
+        """Get the encoder used for a provider's model."""
+        _, encoding_name = _family_spec(provider_name, model)
+        if encoding_name is None or tiktoken is None:
+            return self.heuristic
+        
+        with self._lock:
+            encoder = self._encoders.get(encoding_name)
+            if encoder is not None:
+                return encoder
+            
+            failures, retry_at = self._failures.get(encoding_name, (0, 0.0))
+            if time.monotonic() < retry_at:
+                return self.heuristic
+            
+            future = self._loading.get(encoding_name)
+            loading = future is None
+            if loading:
+                future = self._loading[encoding_name] = Future()
+        
+        if not loading:
+            try:
+                return future.result(timeout=self.LOAD_WAIT)
+            except Exception:
+                return self.heuristic
+        
+        # Built outside the lock, since tiktoken downloads its vocabulary on first use
+        try:
+            encoder = TiktokenEncoder(encoding_name)
+        except Exception as e:
+            backoff = min(self.RETRY_BACKOFF * 2 ** failures, self.MAX_RETRY_BACKOFF)
+            logging.warning(f"Estimating token counts for {encoding_name} for {backoff:.0f}s: {str(e)}")
+            with self._lock:
+                self._failures[encoding_name] = (failures + 1, time.monotonic() + backoff)
+                del self._loading[encoding_name]
+            future.set_exception(e)
+            return self.heuristic
+        
+        with self._lock:
+            self._encoders[encoding_name] = encoder
+            self._failures.pop(encoding_name, None)
+            del self._loading[encoding_name]
+        future.set_result(encoder)
+        
+        return encoder
+    
+    def _cache_key(self, encoder, text: str):
+        if len(text) <= self.MAX_VERBATIM_KEY:
+            return encoder.name, text
+        
+        return encoder.name, len(text), hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    
+    def count(self, text: str, provider_name: str = None, model: str = None) -> int:
+        """Count the tokens in a string for a provider's model."""
+        if not text:
+            return 0
+        
+        encoder = self.encoder_for(provider_name, model)
+        key = self._cache_key(encoder, text)
+        
+        tokens = self.cache.get(key)
+        if tokens is None:
+            tokens = encoder.count(text)
+            self.cache.set(key, tokens)
+        
+        return tokens
+    
+    def count_batch(self, texts: Sequence[str], provider_name: str = None,
+                    model: str = None) -> List[int]:
+        """Count the tokens in each string, encoding only the ones not cached."""
+        encoder = self.encoder_for(provider_name, model)
+        keys = [self._cache_key(encoder, text) if text else None for text in texts]
+        counts = [0 if key is None else self.cache.get(key) for key in keys]
+        
+        missing = [index for index, count in enumerate(counts) if count is None]
+        if missing:
+            for index, tokens in zip(missing, encoder.count_batch([texts[i] for i in missing])):
+                counts[index] = tokens
+                self.cache.set(keys[index], tokens)
+        
+        return counts
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache counters and the encoders in use."""
+        with self._lock:
+            encoders = {name: encoder.name for name, encoder in self._encoders.items()}
+        
+        return {"cache": self.cache.get_stats(), "encoders": encoders, "tiktoken": tiktoken is not None}
+
+_default_counter = None
+_default_counter_lock = threading.Lock()
+
+def get_token_counter() -> TokenCounter:
+    """Get the process-wide token counter."""
+    global _default_counter
+    
+    with _default_counter_lock:
+        if _default_counter is None:
+            _default_counter = TokenCounter()
+        
+        return _default_counter
+
+def count_tokens(text: str, provider_name: str = None, model: str = None) -> int:
+    """Count the tokens in a string for a provider's model."""
+    return get_token_counter().count(text, provider_name, model)